@@ -17,11 +17,18 @@
 Classes: Connections
 """
 from abc import ABC, abstractmethod
+from collections import deque
 from enum import Enum, auto
-from typing import Callable, Optional, Any, Dict
+from threading import Lock, Thread
+from typing import Callable, Optional, Any, Dict, NamedTuple, Tuple
 import logging
+import traceback
 # workaround circular import connection <=> utils, import only file but not the method/object
 from core import utils
+from core.metrics import PublishStats
+from core.offline_buffer import OfflineBuffer
+from core.rate_limit import RateLimiter
+from core.publish_queue import PublishQueue, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST
 
 # connection sub directory constants
 CONF_COMM_CONN = 'comm_conn'
@@ -35,6 +42,13 @@ VAL_TIMEOUT = 'Timeout'
 VAL_RESUME_STATE = 'ResumeLastState'
 VAL_LAST_STATE = 'LastState'
 
+# send queue size if only 'SendQueueCoalesce' is configured
+DEFAULT_COALESCE_QUEUE_SIZE = 100
+# default size of the persistent offline buffer in MB
+DEFAULT_OFFLINE_BUFFER_SIZE = 16
+# seconds to wait for the replay thread on disconnect
+REPLAY_JOIN_TIMEOUT = 5
+
 class ConnState(Enum):
     """ connection state constants """
     INIT = auto()
@@ -44,6 +58,17 @@ class ConnState(Enum):
     PRE_ONLINE = auto()
     ONLINE = auto()
 
+class Route(NamedTuple):
+    """ Pre-resolved destinations of one output of a sensor or actuator,
+        created once per comm_conn and output_name by Connection.get_route().
+        An empty destinations tuple means the output isn't published.
+    """
+    destinations:Tuple[str, ...] = ()
+    retain:bool = False
+    qos:int = 0
+    # seconds until the broker discards the message, 0 = never (MQTT v5)
+    expiry:int = 0
+
 class Connection(ABC):
     """ Parent class that all connections must implement. It provides a default
         implementation for all methods except publish which must be overridden.
@@ -67,8 +92,40 @@ class Connection(ABC):
         self.state = ConnState.INIT
         self.value_send_buff:Dict[int, Any] = {}
         self.online_offline_act:Dict[int, Any] = {}
+        # routes by (id(comm_conn), output_name), see get_route()
+        self.routes:Dict[Tuple[int, Optional[str]], Route] = {}
+        # comm_conns by id, keeps them alive so the ids in self.routes stay unique
+        self.route_comms:Dict[int, Dict[str, Any]] = {}
         utils.set_log_level(conn_cfg, self.log)
 
+        # optional persistent store for the readings collected while offline,
+        # replaces self.value_send_buff
+        self.offline_buffer:Optional[OfflineBuffer] = None
+        if 'OfflineBufferFile' in conn_cfg:
+            self.offline_buffer = OfflineBuffer(
+                conn_cfg['OfflineBufferFile'],
+                int(float(conn_cfg.get('OfflineBufferSize', DEFAULT_OFFLINE_BUFFER_SIZE))
+                    * 1024 * 1024))
+        # replays the offline buffer after reconnecting, see _start_replay()
+        self.replay_lock = Lock()
+        self.replay_thread:Optional[Thread] = None
+        self.replay_pending = False
+
+        self.publish_stats = PublishStats()
+        self.send_queue:Optional[PublishQueue] = None
+        coalesce = bool(conn_cfg.get('SendQueueCoalesce', False))
+        queue_size = int(conn_cfg.get('SendQueueSize',
+                                      DEFAULT_COALESCE_QUEUE_SIZE if coalesce else 0))
+        if queue_size > 0:
+            policy = conn_cfg.get('SendQueuePolicy', POLICY_DROP_OLDEST)
+            if policy not in [POLICY_DROP_OLDEST, POLICY_DROP_NEWEST]:
+                raise ValueError(f"Unknown SendQueuePolicy '{policy}', expected "
+                                 f"'{POLICY_DROP_OLDEST}' or '{POLICY_DROP_NEWEST}'")
+            self.send_queue = PublishQueue(conn_cfg.get('Name', type(self).__name__),
+                                           self._process_publish, queue_size,
+                                           policy, self.publish_stats, coalesce)
+        self.rate_limiter = RateLimiter(conn_cfg, self._send_message, self.publish_stats)
+
     @abstractmethod
     def publish(self,
                 message:str,
@@ -95,9 +152,11 @@ class Connection(ABC):
                         message:str,
                         comm_conn:Dict[str, Any],
                         output_name:Optional[str] = None) -> None:
-        """ Internal method to store messages in case the connection is offline.
-            If a sensor doesn't has 'ConnectionOnReconnect' configured, send messages
-            get dropped while the connection is offline.
+        """ Internal method called by sensors and actuators to publish a message.
+            Messages exceeding a configured rate limit are dropped or delayed.
+            If 'SendQueueSize' is configured the message is put into the send queue
+            and published by the sender thread, so the caller never blocks on
+            network I/O. Otherwise the message is processed immediately.
 
         Arguments:
         - message:     the message to process / publish
@@ -111,6 +170,29 @@ class Connection(ABC):
                            <connection_name>:
                                 <output_name>:
         """
+        if self.rate_limiter.allow(message, comm_conn, output_name):
+            self._send_message(message, comm_conn, output_name)
+
+    def _send_message(self,
+                      message:str,
+                      comm_conn:Dict[str, Any],
+                      output_name:Optional[str] = None) -> None:
+        """ Puts the message into the send queue, if configured,
+            or processes it immediately.
+        """
+        if self.send_queue is not None:
+            self.send_queue.put(message, comm_conn, output_name)
+        else:
+            self._process_publish(message, comm_conn, output_name)
+
+    def _process_publish(self,
+                         message:str,
+                         comm_conn:Dict[str, Any],
+                         output_name:Optional[str] = None) -> None:
+        """ Stores messages in case the connection is offline, otherwise publishes them.
+            If a sensor doesn't has 'ConnectionOnReconnect' configured, send messages
+            get dropped while the connection is offline.
+        """
         ### Store sensor messages if offline ###
         # Create ID for communication dictionary to find same sensor/actuator later on
         comm_id = id(comm_conn)
@@ -123,16 +205,19 @@ class Connection(ABC):
                                                     ].get(VAL_SEND_READINGS, False)
                 number_readings_to_send = comm_conn[utils.CONF_ON_RECONNECT \
                                                     ].get(VAL_NO_OF_READINGS, 1)
-                if pub_values_on_reconnect:
+                if pub_values_on_reconnect and self.offline_buffer is not None:
+                    self.offline_buffer.append(comm_conn, output_name, message)
+                    self.log.debug("OFFLINE: Stored msg '%s' for output '%s' "
+                                   "in offline buffer", message, output_name)
+                elif pub_values_on_reconnect:
                     # Create new entry in send_buff dict if comm_conn ID not present
                     if comm_id not in self.value_send_buff:
                         self.value_send_buff[comm_id] = { CONF_COMM_CONN : comm_conn }
-                    # Create empty array if output_name is not in send_buff
+                    # Create ring buffer if output_name is not in send_buff,
+                    # it drops the first stored message if No. of readings length is reached
                     if output_name not in self.value_send_buff[comm_id]:
-                        self.value_send_buff[comm_id][output_name] = []
-                    # Remove first stored message if No. of readings length reached
-                    if len(self.value_send_buff[comm_id][output_name]) >= number_readings_to_send:
-                        self.value_send_buff[comm_id][output_name].pop(0)
+                        self.value_send_buff[comm_id][output_name] = \
+                            deque(maxlen=max(number_readings_to_send, 0))
                     # Store sensor reading, with ID of comm_conn
                     self.value_send_buff[comm_id][output_name].append(message)
                     self.log.debug("OFFLINE: Appended msg '%s' for output '%s' "
@@ -142,8 +227,8 @@ class Connection(ABC):
                     # <ID of sensor/actuator's comm_conn>:
                     #     conn_comm:
                     #         <published communication dictionary>
-                    #     <output_name1>: [ <array of resent sensor readings> ]
-                    #     <output_name2>: [ <array of resent sensor readings> ]
+                    #     <output_name1>: deque([ <resent sensor readings> ])
+                    #     <output_name2>: deque([ <resent sensor readings> ])
         if self.state in [ConnState.OFFLINE, ConnState.PRE_ONLINE, ConnState.PRE_OFFLINE]:
             # Only publish messages when ONLINE or in INIT state
             return
@@ -160,6 +245,53 @@ class Connection(ABC):
 
         self.publish(message, comm_conn, output_name)
 
+    def get_route(self,
+                  comm_conn:Dict[str, Any],
+                  output_name:Optional[str] = None) -> Route:
+        """ Returns the route for comm_conn and output_name. The route is
+            created by _build_route() on the first call and cached afterwards,
+            so the connection doesn't have to parse comm_conn for every message.
+        """
+        key = (id(comm_conn), output_name)
+        route = self.routes.get(key)
+        if route is None:
+            route = self._build_route(comm_conn, output_name)
+            self.route_comms[id(comm_conn)] = comm_conn
+            self.routes[key] = route
+        return route
+
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves comm_conn and output_name into a Route.
+            Connections using get_route() override this method, the default
+            route has no destinations.
+        """
+        return Route()
+
+    def compile_routes(self) -> None:
+        """ Creates the routes for all registered sensors and actuators and
+            their outputs. Called after all connections, sensors and actuators
+            are created. Routes of devices which don't register are created on
+            their first message.
+            Routes cached before are rebuilt, since devices publish their
+            initial state before configure_device_channel adds the output
+            channels to comm_conn.
+        """
+        if type(self)._build_route is Connection._build_route:
+            # connection doesn't use routes
+            return
+        routes:Dict[Tuple[int, Optional[str]], Route] = {}
+        for comm_conn in list(self.route_comms.values()):
+            routes[(id(comm_conn), None)] = self._build_route(comm_conn, None)
+            for (output_name, local_comm) in comm_conn.items():
+                if isinstance(local_comm, dict):
+                    routes[(id(comm_conn), output_name)] = \
+                        self._build_route(comm_conn, output_name)
+        # replace the cache at once, event driven devices might already publish
+        self.routes = routes
+        self.log.debug("Compiled %d routes", len(self.routes))
+
     def publish_device_properties(self) -> None:
         """ Method is intended for connections with auto discover of sensors
             and actuators. Such a connection can place the necessary code for auto
@@ -177,9 +309,21 @@ class Connection(ABC):
     def prepare_disconnect(self) -> None:
         """ Internal method to disable offline action before intentional disconnect request.
             Offline actions won't get trigger if self.state is already offline.
+            Messages delayed by the rate limit and messages in the send queue
+            are published before disconnecting.
         """
+        self.rate_limiter.stop()
+        if self.send_queue is not None:
+            self.send_queue.stop()
         self.state = ConnState.OFFLINE
         self.disconnect()
+        replay_thread = self.replay_thread
+        if replay_thread is not None:
+            # the replay stops since the connection is offline
+            replay_thread.join(REPLAY_JOIN_TIMEOUT)
+        if self.offline_buffer is not None:
+            self.offline_buffer.close()
+            self.offline_buffer = None
 
     @abstractmethod
     def register(self,
@@ -217,6 +361,9 @@ class Connection(ABC):
                          if None the registration of a sensor is assumed.
                          Handler must accept one string input parameter.
         """
+        # remember comm_conn for compile_routes()
+        self.route_comms[id(comm_conn)] = comm_conn
+
         # Only process actuators
         if handler is not None:
             # init variables
@@ -343,8 +490,10 @@ class Connection(ABC):
                     handler(str(target_state))
 
         self.state = ConnState.ONLINE
-        if last_state in [ConnState.INIT, ConnState.ONLINE]:
-            # don't run on initial connect or when set online state twice
+        if last_state == ConnState.ONLINE or \
+        (last_state == ConnState.INIT and not self.offline_buffer):
+            # don't run on initial connect or when set online state twice,
+            # except for readings stored in the offline buffer before a restart
             return
 
         ###          Send stored sensor readings                 ###
@@ -353,8 +502,8 @@ class Connection(ABC):
         # <ID of sensor/actuator's comm_conn>:
         #     conn_comm:
         #         <published communication dictionary>
-        #     <output_name1>: [ <array of resent sensor readings> ]
-        #     <output_name2>: [ <array of resent sensor readings> ]
+        #     <output_name1>: deque([ <resent sensor readings> ])
+        #     <output_name2>: deque([ <resent sensor readings> ])
         for entry in self.value_send_buff.values():
             comm_conn = entry.pop(CONF_COMM_CONN)
             # after popping CONF_COMM_CONN the dict only contains output_names with readings
@@ -363,3 +512,63 @@ class Connection(ABC):
                     self.publish(msg, comm_conn, output_name)
         # empty send buffer, since all messages got sent
         self.value_send_buff.clear()
+
+        if self.offline_buffer is not None:
+            self._start_replay()
+
+    def _start_replay(self) -> None:
+        """ Replays the offline buffer in a separate thread, so the thread
+            reporting the connection state isn't blocked, e.g. the network
+            thread of paho. If a replay is still running, it runs once more.
+        """
+        with self.replay_lock:
+            self.replay_pending = True
+            if self.replay_thread is None:
+                self.replay_thread = Thread(target=self._replay, daemon=True,
+                                            name=f"OfflineReplay-{type(self).__name__}")
+                self.replay_thread.start()
+
+    def _replay(self) -> None:
+        """ Replay thread, publishes the readings of the offline buffer one
+            after the other. A reading is removed from the buffer only after
+            _replay_publish reported it as delivered, so the readings not
+            delivered before the connection got lost again stay in the buffer.
+        """
+        while True:
+            with self.replay_lock:
+                if not self.replay_pending or self.offline_buffer is None:
+                    self.replay_thread = None
+                    return
+                self.replay_pending = False
+                offline_buffer = self.offline_buffer
+            try:
+                for (comm_conn, output_name, msg) in offline_buffer.replay(
+                        self._number_of_readings):
+                    if self.state != ConnState.ONLINE or \
+                    not self._replay_publish(msg, comm_conn, output_name):
+                        # connection lost again, the rest stays in the offline buffer
+                        break
+            # an error must not leave the replay_thread set
+            except:
+                self.log.error("Error replaying the offline buffer: %s",
+                               traceback.format_exc())
+
+    def _replay_publish(self,
+                        message:str,
+                        comm_conn:Dict[str, Any],
+                        output_name:Optional[str]) -> bool:
+        """ Publishes a reading of the offline buffer. Returns False if it
+            wasn't delivered because the connection got lost.
+            Connections which publish asynchronously override this method to
+            wait until the reading was sent, so the replay doesn't queue the
+            whole buffer in memory.
+        """
+        self.publish(message, comm_conn, output_name)
+        return self.state == ConnState.ONLINE
+
+    @staticmethod
+    def _number_of_readings(comm_conn:Dict[str, Any]) -> int:
+        """ Returns the number of readings to store while offline
+            configured in 'ConnectionOnReconnect' of comm_conn.
+        """
+        return comm_conn.get(utils.CONF_ON_RECONNECT, {}).get(VAL_NO_OF_READINGS, 1)
@@ -0,0 +1,196 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Counters and histograms to measure the run time behavior of sensor_reporter.
+
+    Updating a counter or a histogram is not atomic. The poll and edge
+    statistics have a single writer and no lock, e.g. the poll statistics of a
+    sensor are only written by the thread running the poll, which is guaranteed
+    since a poll is skipped while the sensor is still running. The publish
+    statistics are written by the sensor, sender and network threads of a
+    connection, so they are only updated with their lock held. Readers without
+    the lock might see a slightly outdated value, which is fine for statistics.
+
+Classes:
+    - Histogram    : Counts values in fixed buckets
+    - PollStats    : Statistics of the polls of one sensor
+    - PublishStats : Statistics of the outbound messages of a connection
+    - EdgeStats    : Statistics of the GPIO edge event queue of a sensor
+"""
+from bisect import bisect_left
+from threading import Lock
+from typing import Any, Dict, List, Sequence
+
+# Bucket upper bounds in seconds used for durations and delays
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+# Bucket upper bounds in bytes used for message sizes
+SIZE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 4096)
+
+class Histogram():
+    """ Counts values in buckets with fixed upper bounds. Values larger than
+        the last bound are counted in an additional overflow bucket.
+    """
+
+    def __init__(self,
+                 bounds:Sequence[float] = TIME_BUCKETS) -> None:
+        """ Parameter:
+            - bounds : sorted upper bounds (inclusive) of the buckets
+        """
+        self.bounds = list(bounds)
+        self.buckets:List[int] = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self,
+            value:float) -> None:
+        """ Counts the value in the matching bucket. """
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self) -> Dict[str, Any]:
+        """ Returns the histogram as dictionary, suitable to be published as JSON.
+            The bucket names are the upper bounds, '+Inf' for the overflow bucket.
+        """
+        names = [str(bound) for bound in self.bounds] + ['+Inf']
+        return {'count' : self.count,
+                'sum'   : round(self.sum, 6),
+                'max'   : round(self.max, 6),
+                'buckets' : dict(zip(names, self.buckets))}
+
+class PollStats():
+    """ Statistics of the polls of one sensor:
+        - polls    : number of started polls
+        - skipped  : number of polls skipped because the sensor was still running
+        - errors   : number of polls that raised an exception
+        - lag      : histogram of the delay between the scheduled and the actual
+                     start of the poll in seconds
+        - duration : histogram of the run time of check_state in seconds
+    """
+
+    def __init__(self) -> None:
+        self.polls = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lag = Histogram()
+        self.duration = Histogram()
+        # scheduled start (time.monotonic) of the current poll,
+        # set by the polling loop
+        self.due = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        """ Returns the statistics as dictionary, suitable to be published as JSON. """
+        return {'polls'    : self.polls,
+                'skipped'  : self.skipped,
+                'errors'   : self.errors,
+                'lag'      : self.lag.as_dict(),
+                'duration' : self.duration.as_dict()}
+
+class PublishStats():
+    """ Statistics of the outbound messages of a connection:
+        - queued   : number of messages put into the send queue
+        - sent     : number of messages handed to the connection's publish
+        - dropped  : number of messages dropped because the send queue was full
+        - coalesced : number of messages replaced by a newer message for the
+                      same destination before they were sent
+        - limited  : number of messages dropped or replaced because a rate
+                     limit was exceeded
+        - deferred : number of messages sent delayed because of a rate limit
+        - retries  : number of failed sends retried by the connection
+        - acked    : number of QoS 1/2 messages acknowledged by the broker
+        - unacked  : number of QoS 1/2 messages not acknowledged before
+                     disconnecting or dropped from the tracking
+        - inflight : current number of QoS 1/2 messages waiting for the ack
+        - latency  : histogram of the time between queueing a message and
+                     the return of the connection's publish in seconds
+        - ack_latency : histogram of the time between publishing a QoS 1/2
+                        message and the ack of the broker in seconds
+        - queue_depth : current number of messages in the send queue
+        - wire_bytes   : estimated number of bytes sent, including the
+                         protocol overhead (MQTT only)
+        - message_size : histogram of the estimated size of the sent
+                         messages on the wire in bytes (MQTT only)
+        Written by several threads, update the statistics with lock held.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.limited = 0
+        self.deferred = 0
+        self.retries = 0
+        self.acked = 0
+        self.unacked = 0
+        self.inflight = 0
+        self.latency = Histogram()
+        self.ack_latency = Histogram()
+        self.queue_depth = 0
+        self.wire_bytes = 0
+        self.message_size = Histogram(SIZE_BUCKETS)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """ Returns the statistics as dictionary, suitable to be published as JSON. """
+        with self.lock:
+            return self._as_dict()
+
+    def _as_dict(self) -> Dict[str, Any]:
+        return {'queued'      : self.queued,
+                'sent'        : self.sent,
+                'dropped'     : self.dropped,
+                'coalesced'   : self.coalesced,
+                'limited'     : self.limited,
+                'deferred'    : self.deferred,
+                'retries'     : self.retries,
+                'acked'       : self.acked,
+                'unacked'     : self.unacked,
+                'inflight'    : self.inflight,
+                'queue_depth' : self.queue_depth,
+                'latency'     : self.latency.as_dict(),
+                'ack_latency' : self.ack_latency.as_dict(),
+                'wire_bytes'  : self.wire_bytes,
+                'message_size' : self.message_size.as_dict()}
+
+class EdgeStats():
+    """ Statistics of the GPIO edge event queue of a sensor:
+        - queued    : number of edge events put into the queue
+        - dropped   : number of events dropped because the queue was full
+        - processed : number of events handled by the consumer
+        - max_depth : highest number of events waiting in the queue
+        - latency   : histogram of the time between the edge and the
+                      handling of the event in seconds
+        queued, dropped and max_depth are written by the thread reporting
+        the edges, processed and latency by the consumer.
+    """
+
+    def __init__(self) -> None:
+        self.queued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.max_depth = 0
+        self.latency = Histogram()
+
+    def as_dict(self) -> Dict[str, Any]:
+        """ Returns the statistics as dictionary, suitable to be published as JSON. """
+        return {'queued'      : self.queued,
+                'dropped'     : self.dropped,
+                'processed'   : self.processed,
+                'queue_depth' : max(0, self.queued - self.dropped - self.processed),
+                'max_depth'   : self.max_depth,
+                'latency'     : self.latency.as_dict()}
@@ -0,0 +1,294 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the persistent store for sensor readings collected while a
+    connection is offline.
+
+    The readings are stored in a memory mapped ring file of fixed size:
+
+    header: magic 'SRBF' | version u32 | head u64 | tail u64 | count u64
+    record: length u32 | crc32 u32 | payload (JSON: [dest key, output_name, message])
+
+    head points to the oldest record, tail to the end of the newest record.
+    A record never wraps around the end of the file, if it doesn't fit the
+    remaining space is skipped and the record is written to the start of the
+    data area. If the file is full the oldest records are overwritten.
+    The header is updated after the record is written, so a crash never leaves
+    the header pointing to a partially written record. Records with a wrong
+    checksum end the replay. The replay removes a record only after it was
+    delivered, so readings not sent before the connection dropped again stay
+    in the buffer.
+
+    The comm_conn dictionaries of the destinations are stored in a small JSON
+    side file '<file>.dest', so readings can be replayed after a restart.
+
+Classes: OfflineBuffer
+"""
+import os
+import json
+import mmap
+import struct
+import logging
+import zlib
+from threading import Lock
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+MAGIC = b'SRBF'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQ')
+RECORD = struct.Struct('<II')
+# record length marking the rest of the data area as unused
+WRAP = 0xFFFFFFFF
+
+class OfflineBuffer():
+    """ Persistent FIFO of (comm_conn, output_name, message) entries backed by
+        a memory mapped ring file. All methods are thread safe.
+    """
+
+    def __init__(self,
+                 path:str,
+                 size:int) -> None:
+        """ Opens or creates the ring file. Existing records are kept if the
+            file is valid and has the same size, otherwise the file is reset.
+
+            Parameters:
+            - path : path of the ring file
+            - size : size of the ring file in bytes
+        """
+        self.log = logging.getLogger(type(self).__name__)
+        self.path = path
+        self.dest_path = path + '.dest'
+        self.size = size
+        self.lock = Lock()
+        # comm_conn dictionaries by destination key, live objects of this run
+        # or loaded from the side file
+        self.dests:Dict[str, Dict[str, Any]] = {}
+        # destination key cache by id(comm_conn), avoids serializing comm_conn per message
+        self.keys:Dict[int, str] = {}
+        # number of removed records, tells the replay if append dropped its record
+        self.removed = 0
+
+        if size <= HEADER.size + RECORD.size:
+            raise ValueError(f"Offline buffer size {size} is too small")
+        with open(path, 'a+b') as file:
+            if os.path.getsize(path) != size:
+                file.truncate(size)
+                file.seek(0)
+                file.write(bytes(HEADER.size))
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+        (magic, version, self.head, self.tail, self.count) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or not self._valid_pos(self.head) \
+        or not self._valid_pos(self.tail):
+            self._reset()
+        else:
+            self._load_dests()
+            self._check()
+        if self.count:
+            self.log.info("Offline buffer %s contains %d stored readings",
+                          path, self.count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _valid_pos(self,
+                   pos:int) -> bool:
+        """ Checks if pos is inside the data area. """
+        return HEADER.size <= pos <= self.size
+
+    def _reset(self) -> None:
+        """ Clears the buffer. """
+        self.head = self.tail = HEADER.size
+        self.count = 0
+        self._write_header()
+
+    def _write_header(self) -> None:
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.head, self.tail, self.count)
+
+    def _load_dests(self) -> None:
+        """ Reads the comm_conn dictionaries stored by a previous run. """
+        try:
+            with open(self.dest_path, 'r', encoding='utf-8') as file:
+                self.dests = json.load(file)
+        except (OSError, ValueError):
+            self.dests = {}
+
+    def _save_dests(self) -> None:
+        with open(self.dest_path, 'w', encoding='utf-8') as file:
+            json.dump(self.dests, file, default=str)
+
+    def _next(self,
+              pos:int) -> Tuple[int, Optional[bytes]]:
+        """ Reads the record at pos. Returns the position after the record
+            and the payload, None as payload if the record is invalid.
+        """
+        if pos + RECORD.size > self.size:
+            pos = HEADER.size
+        (length, crc) = RECORD.unpack_from(self.map, pos)
+        if length == WRAP:
+            pos = HEADER.size
+            (length, crc) = RECORD.unpack_from(self.map, pos)
+        end = pos + RECORD.size + length
+        if end > self.size:
+            return (pos, None)
+        payload = self.map[pos + RECORD.size:end]
+        if zlib.crc32(payload) != crc:
+            return (pos, None)
+        return (end, payload)
+
+    def _check(self) -> None:
+        """ Verifies the checksums of all records after a restart. The buffer
+            is truncated at the first invalid record.
+        """
+        pos = self.head
+        for i in range(self.count):
+            (end, payload) = self._next(pos)
+            if payload is None:
+                self.log.warning("Offline buffer %s is corrupt, dropping %d of %d records",
+                                 self.path, self.count - i, self.count)
+                self.tail = pos
+                self.count = i
+                self._write_header()
+                return
+            pos = end
+
+    def _drop_oldest(self) -> None:
+        """ Removes the oldest record to make room for a new one. """
+        (self.head, _) = self._next(self.head)
+        self.count -= 1
+        self.removed += 1
+        if self.count == 0:
+            self.head = self.tail = HEADER.size
+
+    def _dest_key(self,
+                  comm_conn:Dict[str, Any]) -> str:
+        """ Returns a key for comm_conn which is the same after a restart. """
+        key = self.keys.get(id(comm_conn))
+        if key is None:
+            key = f"{zlib.crc32(json.dumps(comm_conn, sort_keys=True, default=str).encode()):08x}"
+            self.keys[id(comm_conn)] = key
+            known = key in self.dests
+            # prefer the live comm_conn over the one loaded from the side file
+            self.dests[key] = comm_conn
+            if not known:
+                self._save_dests()
+        return key
+
+    def append(self,
+               comm_conn:Dict[str, Any],
+               output_name:Optional[str],
+               message:str) -> None:
+        """ Stores a message, overwrites the oldest messages if the file is full. """
+        with self.lock:
+            payload = json.dumps([self._dest_key(comm_conn), output_name, message]).encode()
+            needed = RECORD.size + len(payload)
+            if HEADER.size + needed + RECORD.size > self.size:
+                self.log.warning("Message %s is too large for the offline buffer", message)
+                return
+
+            pos = self.tail
+            if pos + needed > self.size:
+                # doesn't fit at the end, continue at the start of the data area
+                while self.count and self.head >= pos:
+                    self._drop_oldest()
+                if pos + RECORD.size <= self.size:
+                    RECORD.pack_into(self.map, pos, WRAP, 0)
+                pos = HEADER.size
+            # drop old records which would be overwritten
+            while self.count and pos <= self.head < pos + needed:
+                self._drop_oldest()
+
+            RECORD.pack_into(self.map, pos, len(payload), zlib.crc32(payload))
+            self.map[pos + RECORD.size:pos + needed] = payload
+            if self.count == 0:
+                self.head = pos
+            self.tail = pos + needed
+            self.count += 1
+            self._write_header()
+
+    def _records(self) -> Iterator[Tuple[str, Optional[str], str]]:
+        """ Yields the decoded records from the oldest to the newest. """
+        pos = self.head
+        for _ in range(self.count):
+            (pos, payload) = self._next(pos)
+            if payload is None:
+                return
+            yield tuple(json.loads(payload))
+
+    def replay(self,
+               max_readings:Callable[[Dict[str, Any]], int]) \
+               -> Iterator[Tuple[Dict[str, Any], Optional[str], str]]:
+        """ Yields the stored (comm_conn, output_name, message) entries in the
+            order they were stored. For each comm_conn and output_name only
+            the newest max_readings(comm_conn) messages are yielded.
+            An entry is removed from the buffer when the next one is requested,
+            so if the caller stops the iteration because the connection was
+            lost, the entry not delivered and the newer ones are kept.
+            The lock is not held while an entry is yielded, so readings can be
+            appended meanwhile.
+        """
+        with self.lock:
+            # first pass: count the records per destination
+            counts:Dict[Tuple[str, Optional[str]], int] = {}
+            for (key, output_name, _) in self._records():
+                counts[(key, output_name)] = counts.get((key, output_name), 0) + 1
+            remaining = self.count
+
+            # skip the oldest records exceeding max_readings
+            skip = {}
+            for ((key, output_name), count) in counts.items():
+                if key in self.dests:
+                    skip[(key, output_name)] = count - max(max_readings(self.dests[key]), 0)
+
+        try:
+            # records appended during the replay are left for the next replay
+            while remaining > 0:
+                remaining -= 1
+                with self.lock:
+                    if not self.count:
+                        return
+                    (_, payload) = self._next(self.head)
+                    if payload is None:
+                        self.log.warning("Offline buffer %s is corrupt, dropping %d records",
+                                         self.path, self.count)
+                        self._reset()
+                        return
+                    (key, output_name, message) = json.loads(payload)
+                    removed = self.removed
+                    entry = None
+                    if key not in self.dests:
+                        self.log.warning("Dropping stored message %s for unknown destination %s",
+                                         message, key)
+                    elif skip.get((key, output_name), 0) > 0:
+                        skip[(key, output_name)] -= 1
+                    else:
+                        entry = (self.dests[key], output_name, message)
+                if entry is not None:
+                    yield entry
+                with self.lock:
+                    # append may have dropped the record while it was yielded
+                    if self.removed == removed:
+                        self._drop_oldest()
+                        self._write_header()
+        finally:
+            with self.lock:
+                self.map.flush()
+
+    def close(self) -> None:
+        """ Writes the buffer to disk and closes the file. """
+        with self.lock:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
@@ -14,29 +14,83 @@
 
 """ Contains the PollManager class, the class that drives the sensor_reporter.
 
-Classes: PollManager
+Classes:
+    - PollManager     : Runs the polling loop
+    - PollStatsSensor : Publishes the poll statistics of all sensors
 """
 import time
-from threading import Thread
+import heapq
+import random
+import zlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Lock
+from queue import Queue, Full
 import traceback
 import logging
-from typing import Dict, List, Callable, TYPE_CHECKING
+import json
+from typing import (Any, Awaitable, Dict, List, Set, Tuple, Callable, Optional,
+                    TYPE_CHECKING)
 if TYPE_CHECKING:
     # Fix circular imports needed for the type checker
-    from core import connection, actuator, sensor
+    from core import connection, actuator
+from core import sensor
+from core.metrics import PollStats
+
+# Polling engines
+ENGINE_THREAD = "thread"
+ENGINE_ASYNCIO = "asyncio"
+
+# Spreading of the first poll
+SPREAD_NONE = "none"
+SPREAD_HASH = "hash"
+SPREAD_EVEN = "even"
+
+# Section name of the sensor publishing the poll statistics
+STATS_SENSOR = "PollStats"
 
 class PollManager:
     """ Manages spawning Processes to call a sensor's check method each configured
         polling period. Calling stop will end the polling loop and clean up all the
         resources from the connections, sensors and actuators. When calling report,
         the most recent reading of the sensor is published/republished.
+
+        The polling loop keeps a min-heap of the next due time of every polling
+        sensor and sleeps until the earliest one is due, so the cost of a wake up
+        doesn't depend on the number of configured sensors.
+
+        By default every poll runs in a new thread. If "Workers" is configured
+        in the PollManager section the polls are handed to a fixed number of
+        worker threads through a bounded queue instead. With "Engine: asyncio"
+        the polls run as tasks of an asyncio event loop, calling the
+        async_check_state coroutine of the sensors.
     """
 
     def __init__(self,
                  connections:Dict[str, 'connection.Connection'],
                  sensors:Dict[str, 'sensor.Sensor'],
-                 actuators:List['actuator.Actuator']) -> None:
-        """ Prepares the manager to start the polling loop. """
+                 actuators:List['actuator.Actuator'],
+                 poll_cfg:Optional[Dict[str, Any]] = None) -> None:
+        """ Prepares the manager to start the polling loop.
+
+        Arguments:
+        - poll_cfg: optional, the PollManager section of the yaml file:
+            - "Workers":   number of worker threads to run the polls,
+                           if 0 (default) every poll runs in a new thread
+            - "QueueSize": maximum number of polls waiting for a worker,
+                           default is four times the number of workers
+            - "Engine":    "thread" (default) or "asyncio", with asyncio
+                           "Workers" sets the number of executor threads
+                           for sensors without native async implementation
+            - "Spread":    delay of the first poll of each sensor, "none" (default)
+                           polls all sensors at start, "hash" derives the delay
+                           from the section name, "even" spreads sensors with
+                           the same poll period evenly across the period
+            - "StatsConnections": Connections section (same layout as for a
+                           sensor) to publish the poll statistics to
+            - "StatsInterval": interval in seconds to publish the statistics,
+                           default is 60
+        """
         self.log = logging.getLogger(type(self).__name__)
         self.connections = connections
         self.sensors = sensors
@@ -44,38 +98,327 @@ class PollManager:
         self.stop_poll = False
         self.threads:Dict[str, Thread] = {}
 
+        poll_cfg = poll_cfg or {}
+        self.num_workers = int(poll_cfg.get("Workers", 0))
+        self.engine = str(poll_cfg.get("Engine", ENGINE_THREAD)).lower()
+        if self.engine not in (ENGINE_THREAD, ENGINE_ASYNCIO):
+            self.log.error("Unknown polling engine %s, using %s instead",
+                           self.engine, ENGINE_THREAD)
+            self.engine = ENGINE_THREAD
+        self.spread = str(poll_cfg.get("Spread", SPREAD_NONE)).lower()
+        if self.spread not in (SPREAD_NONE, SPREAD_HASH, SPREAD_EVEN):
+            self.log.error("Unknown poll spread %s, using %s instead",
+                           self.spread, SPREAD_NONE)
+            self.spread = SPREAD_NONE
+        self.workers:List[Thread] = []
+        # keys of the sensors queued or running in the worker pool
+        self.running:Set[str] = set()
+        self.running_lock = Lock()
+        self.poll_queue:Optional['Queue[Optional[str]]'] = None
+        if self.num_workers > 0 and self.engine == ENGINE_THREAD:
+            queue_size = int(poll_cfg.get("QueueSize", self.num_workers * 4))
+            self.poll_queue = Queue(maxsize=queue_size)
+            self.log.info("Polling with %d workers, queue size %d",
+                          self.num_workers, queue_size)
+        # Condition to interrupt the wait for the next due poll
+        self.wakeup = Condition()
+        # heap entries: (deadline as time.monotonic(), sequence no., sensor key,
+        #                deadline without jitter)
+        self.schedule:List[Tuple[float, int, str, float]] = []
+        # publish poll statistics as if it were a regular sensor
+        if "StatsConnections" in poll_cfg:
+            self._add_stats_sensor(poll_cfg)
+        self.stats = {key:PollStats() for key in self.sensors}
+        # asyncio engine
+        self.loop:asyncio.AbstractEventLoop
+        self.poll_task:'asyncio.Task[None]'
+        self.executor:ThreadPoolExecutor
+        self.loop_thread:Optional[Thread] = None
+        self.tasks:Dict[str, 'asyncio.Future[None]'] = {}
+
+    def _add_stats_sensor(self,
+                          poll_cfg:Dict[str, Any]) -> None:
+        """ Creates the PollStatsSensor and adds it to the polled sensors. """
+        stats_comm:Dict[str, Any] = poll_cfg["StatsConnections"]
+        try:
+            publishers = {c:self.connections[c] for c in stats_comm}
+        except KeyError as ex:
+            self.log.error("Can't publish poll statistics!"
+                           " Probably the name of the connection %s is misspelled.", ex)
+            return
+        stats_cfg = {'Name': 'PollStats',
+                     'Connections': stats_comm,
+                     'Poll': poll_cfg.get("StatsInterval", 60)}
+        self.sensors[STATS_SENSOR] = PollStatsSensor(publishers, stats_cfg, self)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """ Returns the poll statistics of all sensors as dictionary
+            with the sensor section name as key, see core.metrics.PollStats.
+            The publish statistics of the connections are added with
+            'Connection_<name>' as key, see core.metrics.PublishStats.
+            Sensors with an edge event queue add its statistics with the
+            key 'edges', see core.metrics.EdgeStats.
+        """
+        stats = {key:stats.as_dict() for (key, stats) in self.stats.items()}
+        for (key, sen) in self.sensors.items():
+            edge_stats = getattr(sen, 'edge_stats', None)
+            if edge_stats is not None and key in stats:
+                stats[key]['edges'] = edge_stats.as_dict()
+        for (name, conn) in self.connections.items():
+            stats[f"Connection_{name}"] = conn.publish_stats.as_dict()
+        return stats
+
     def start(self) -> None:
         """ Kicks off the polling loop. This method will not return until stop()
             is called from a separate thread.
         """
         self.log.info("Starting polling loop")
 
+        with self.wakeup:
+            self._init_schedule()
+
+        if self.engine == ENGINE_ASYNCIO:
+            self._start_async()
+            return
+
+        if self.poll_queue is not None:
+            self.workers = [Thread(target=self._worker, args=(self.poll_queue,),
+                                   name=f"PollWorker-{i}")
+                            for i in range(self.num_workers)]
+            for worker in self.workers:
+                worker.start()
+
         while not self.stop_poll:
-            for key, sen in {key:sen for (key, sen) in self.sensors.items()
-                             if sen.poll > 0
-                             and (not sen.last_poll or
-                                  (time.time() - sen.last_poll) > sen.poll)}.items():
-                if key in self.threads and self.threads[key].is_alive():
-                    self.log.warning("Sensor %s is still running! Skipping poll.",
-                                     key)
-                else:
-                    # Wrap the call so we can catch and report exceptions.
-                    def runner(target:Callable[[], None], key:str) -> None:
-                        try:
-                            target()
-                        # TODO create a special exception to catch
-                        except:
-                            self.log.error("Error in checking sensor %s: %s", key,
-                                           traceback.format_exc())
-
-                    sen.last_poll = time.time()
-                    thread = Thread(target=runner,
-                                    args=(sen.check_state, key))
-                    self.threads[key] = thread
-                    thread.start()
-            # TODO measure the time for the fill loop and warn if it continues
-            # to grow.
-            time.sleep(0.5)
+            with self.wakeup:
+                timeout, key = self._pop_due()
+                if key is None:
+                    # timeout is None if there are no polling sensors,
+                    # in that case wait until stop() is called
+                    self.wakeup.wait(timeout)
+                    continue
+
+            self._run_sensor(key, self.sensors[key])
+
+    def _init_schedule(self) -> None:
+        """ Fills the heap with the first poll of every polling sensor. """
+        now = time.monotonic()
+        offsets = self._first_poll_offsets()
+        self.schedule = []
+        # the sequence number keeps the heap stable for equal deadlines
+        for (seq, (key, sen)) in enumerate(self.sensors.items()):
+            if sen.poll > 0:
+                base = now + offsets.get(key, 0)
+                self.schedule.append((base + self._jitter(sen), seq, key, base))
+        heapq.heapify(self.schedule)
+
+    def _first_poll_offsets(self) -> Dict[str, float]:
+        """ Calculates the delay of the first poll for every polling sensor
+            depending on the configured "Spread" so the sensors don't poll
+            all at the same time.
+
+            Returns a dictionary with sensor key and offset in seconds
+        """
+        polling = {key:sen for (key, sen) in self.sensors.items() if sen.poll > 0}
+        if self.spread == SPREAD_HASH:
+            # same offset for the same section name, also after a reload
+            return {key:zlib.crc32(key.encode()) / 2**32 * sen.poll
+                    for (key, sen) in polling.items()}
+        if self.spread == SPREAD_EVEN:
+            # spread sensors with the same poll period evenly across the period
+            by_period:Dict[float, List[str]] = {}
+            for (key, sen) in polling.items():
+                by_period.setdefault(sen.poll, []).append(key)
+            return {key:i / len(keys) * period
+                    for (period, keys) in by_period.items()
+                    for (i, key) in enumerate(keys)}
+        return {}
+
+    @staticmethod
+    def _jitter(sen:'sensor.Sensor') -> float:
+        """ Returns a random delay between 0 and the PollJitter of the sensor. """
+        return random.uniform(0, sen.poll_jitter) if sen.poll_jitter > 0 else 0
+
+    def _pop_due(self) -> Tuple[Optional[float], Optional[str]]:
+        """ Checks the earliest deadline of the heap, must be called with
+            self.wakeup acquired.
+
+            Returns:
+            - (None, key) if the sensor with key is due, the next poll of the
+              sensor is pushed to the heap
+            - (timeout, None) with the seconds until the next sensor is due,
+              timeout is None if there is no polling sensor
+        """
+        if not self.schedule:
+            return None, None
+        deadline, seq, key, base = self.schedule[0]
+        now = time.monotonic()
+        if deadline > now:
+            return deadline - now, None
+
+        # Schedule the next poll relative to the last deadline without jitter,
+        # so the poll period doesn't drift. If we fell behind more than one
+        # period, don't try to catch up with a burst of polls.
+        self.stats[key].due = deadline
+        sen = self.sensors[key]
+        next_base = base + sen.poll
+        if next_base <= now:
+            next_base = now + sen.poll
+        heapq.heapreplace(self.schedule,
+                          (next_base + self._jitter(sen), seq, key, next_base))
+        return None, key
+
+    def _start_async(self) -> None:
+        """ Runs the polling loop as asyncio task in a separate thread and
+            waits until stop() is called. Using a separate thread for the event
+            loop allows stop() to be called from a signal handler in this thread.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers or None,
+                                           thread_name_prefix="PollExecutor")
+        self.loop.set_default_executor(self.executor)
+        self.poll_task = self.loop.create_task(self._async_poll())
+        self.loop_thread = Thread(target=self._async_main, name="PollLoop")
+        self.loop_thread.start()
+
+        with self.wakeup:
+            while not self.stop_poll:
+                self.wakeup.wait()
+
+    def _async_main(self) -> None:
+        """ Thread target running the asyncio event loop until the
+            polling task got cancelled by stop().
+        """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.poll_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+            self.executor.shutdown(wait=True)
+
+    async def _async_poll(self) -> None:
+        """ The asyncio version of the polling loop. Calls async_check_state of
+            every due sensor as a separate task.
+        """
+        try:
+            while not self.stop_poll:
+                with self.wakeup:
+                    timeout, key = self._pop_due()
+                if key is None:
+                    # sleep until cancelled by stop() if there is no polling sensor
+                    await asyncio.sleep(timeout if timeout is not None else 3600)
+                    continue
+                self._run_sensor_async(key, self.sensors[key])
+        except asyncio.CancelledError:
+            self.log.info("Waiting for all the polling tasks")
+            pending = [task for task in self.tasks.values() if not task.done()]
+            if pending:
+                await asyncio.wait(pending)
+
+    def _run_sensor_async(self,
+                          key:str,
+                          sen:'sensor.Sensor') -> None:
+        """ Starts async_check_state of the sensor as a task, unless the
+            sensor is still running from the last poll.
+        """
+        task = self.tasks.get(key)
+        if task is not None and not task.done():
+            self.log.warning("Sensor %s is still running! Skipping poll.", key)
+            self.stats[key].skipped += 1
+            return
+
+        sen.last_poll = time.time()
+        self.tasks[key] = asyncio.ensure_future(self._async_runner(sen.async_check_state,
+                                                                   key))
+
+    async def _async_runner(self,
+                            target:Callable[[], Awaitable[None]],
+                            key:str) -> None:
+        """ Wrap the coroutine so we can catch and report exceptions. """
+        stats = self.stats[key]
+        start = time.monotonic()
+        stats.polls += 1
+        stats.lag.add(max(0.0, start - stats.due))
+        try:
+            await target()
+        # TODO create a special exception to catch
+        except:
+            stats.errors += 1
+            self.log.error("Error in checking sensor %s: %s", key,
+                           traceback.format_exc())
+        stats.duration.add(time.monotonic() - start)
+
+    def _run_sensor(self,
+                    key:str,
+                    sen:'sensor.Sensor') -> None:
+        """ Calls check_state of the sensor in a separate thread, unless the
+            sensor is still running from the last poll.
+        """
+        if self.poll_queue is not None:
+            self._queue_sensor(self.poll_queue, key, sen)
+            return
+
+        if key in self.threads and self.threads[key].is_alive():
+            self.log.warning("Sensor %s is still running! Skipping poll.", key)
+            self.stats[key].skipped += 1
+            return
+
+        sen.last_poll = time.time()
+        thread = Thread(target=self._runner, args=(sen.check_state, key))
+        thread.start()
+        self.threads[key] = thread
+
+    def _queue_sensor(self,
+                      poll_queue:'Queue[Optional[str]]',
+                      key:str,
+                      sen:'sensor.Sensor') -> None:
+        """ Hands the poll of the sensor to the worker pool, unless the
+            sensor is still queued or running from the last poll.
+        """
+        with self.running_lock:
+            if key in self.running:
+                self.log.warning("Sensor %s is still running! Skipping poll.", key)
+                self.stats[key].skipped += 1
+                return
+            try:
+                poll_queue.put_nowait(key)
+            except Full:
+                self.log.warning("All poll workers are busy! Skipping poll of"
+                                 " sensor %s.", key)
+                self.stats[key].skipped += 1
+                return
+            self.running.add(key)
+        sen.last_poll = time.time()
+
+    def _worker(self,
+                poll_queue:'Queue[Optional[str]]') -> None:
+        """ Runs the queued sensor polls until it receives None. """
+        while True:
+            key = poll_queue.get()
+            if key is None:
+                return
+            self._runner(self.sensors[key].check_state, key)
+            with self.running_lock:
+                self.running.discard(key)
+
+    def _runner(self,
+                target:Callable[[], None],
+                key:str) -> None:
+        """ Wrap the call so we can catch and report exceptions. """
+        stats = self.stats[key]
+        start = time.monotonic()
+        stats.polls += 1
+        stats.lag.add(max(0.0, start - stats.due))
+        try:
+            target()
+        # TODO create a special exception to catch
+        except:
+            stats.errors += 1
+            self.log.error("Error in checking sensor %s: %s", key,
+                           traceback.format_exc())
+        stats.duration.add(time.monotonic() - start)
 
     def stop(self) -> None:
         """ Sets a flag to stop the polling loop. Cancels any outstanding
@@ -84,12 +427,24 @@ class PollManager:
         """
         # Stop the polling loop
         # TODO add an Event object that we can use to interrupt sleeps in sensors
-        self.stop_poll = True
-        time.sleep(0.5)
+        with self.wakeup:
+            self.stop_poll = True
+            self.wakeup.notify_all()
+
+        if self.loop_thread is not None:
+            # the polling task waits for the running sensor tasks when cancelled
+            self.loop.call_soon_threadsafe(self.poll_task.cancel)
+            self.loop_thread.join()
 
         self.log.info("Waiting for all the polling threads")
-        for thread in self.threads.values():
+        for thread in list(self.threads.values()):
             thread.join()
+        if self.poll_queue is not None:
+            # the workers finish the queued polls before they get the stop signal
+            for _ in self.workers:
+                self.poll_queue.put(None)
+            for worker in self.workers:
+                worker.join()
 
         self.log.info("Cleaning up the sensors")
         for sen in self.sensors.values():
@@ -110,3 +465,31 @@ class PollManager:
 
         for act in self.actuators:
             act.publish_actuator_state()
+
+class PollStatsSensor(sensor.Sensor):
+    """ Publishes the poll statistics of all sensors as JSON message.
+        Created by the PollManager if "StatsConnections" is configured.
+    """
+
+    def __init__(self,
+                 publishers:Dict[str, 'connection.Connection'],
+                 dev_cfg:Dict[str, Any],
+                 poll_mgr:PollManager) -> None:
+        """ Parameters:
+            - publishers : the connections to publish to
+            - dev_cfg    : generated device config with Name, Connections and Poll
+            - poll_mgr   : the PollManager to get the statistics from
+        """
+        super().__init__(publishers, dev_cfg)
+        self.poll_mgr = poll_mgr
+        # Homie and Home Assistant sections need a Name, which is optional here,
+        # a section without parameters is None
+        for (conn, comm_conn) in self.comm.items():
+            comm_conn = comm_conn or {}
+            comm_conn['Name'] = comm_conn.get('Name', self.name)
+            self.comm[conn] = comm_conn
+        self.log.info("Publishing poll statistics every %s seconds", self.poll)
+
+    def publish_state(self) -> None:
+        """ Publishes the current poll statistics. """
+        self._send(json.dumps(self.poll_mgr.get_stats()), self.comm)
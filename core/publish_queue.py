@@ -0,0 +1,169 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the outbound message queue used by connections, so sensors and
+    actuators don't block on network I/O while publishing.
+
+Classes: PublishQueue
+"""
+import time
+import logging
+import traceback
+from collections import deque
+from threading import Thread, Condition
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from core.metrics import PublishStats
+
+# Policies when the queue is full
+POLICY_DROP_OLDEST = 'DropOldest'
+POLICY_DROP_NEWEST = 'DropNewest'
+
+# queue entry: [message, comm_conn, output_name, time.monotonic() when queued]
+# a list, so a coalesced message can be replaced in place
+Entry = List[Any]
+# destination of a message: (id(comm_conn), output_name)
+Destination = Tuple[int, Optional[str]]
+
+class PublishQueue():
+    """ Bounded FIFO queue of outbound messages with a dedicated sender thread.
+        The sender thread calls the handler for each message in the order the
+        messages were queued.
+
+        In coalescing mode only the latest message per destination is kept:
+        a new message replaces a queued message for the same comm_conn and
+        output_name at its position in the queue, so the queue never holds
+        more entries than there are destinations.
+    """
+
+    def __init__(self,
+                 name:str,
+                 handler:Callable[[str, Dict[str, Any], Optional[str]], None],
+                 max_size:int,
+                 policy:str,
+                 stats:PublishStats,
+                 coalesce:bool = False) -> None:
+        """ Starts the sender thread.
+
+            Parameters:
+            - name     : name of the connection, used for the log and the thread name
+            - handler  : called with message, comm_conn and output_name for
+                         every message in the queue
+            - max_size : maximum number of messages in the queue
+            - policy   : what to do if the queue is full, POLICY_DROP_OLDEST
+                         replaces the oldest message, POLICY_DROP_NEWEST
+                         drops the new message
+            - stats    : the statistics to update
+            - coalesce : if True a new message replaces a queued message
+                         for the same destination
+        """
+        self.log = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.handler = handler
+        self.max_size = max_size
+        self.policy = policy
+        self.stats = stats
+        self.coalesce = coalesce
+        self.queue:Deque[Entry] = deque()
+        # queued entries by destination, only used in coalescing mode
+        self.pending:Dict[Destination, Entry] = {}
+        self.cond = Condition()
+        self.stopped = False
+        self.thread = Thread(target=self._run, name=f"{name}-sender", daemon=True)
+        self.thread.start()
+
+    def put(self,
+            message:str,
+            comm_conn:Dict[str, Any],
+            output_name:Optional[str]) -> None:
+        """ Adds a message to the queue, never blocks. If the queue is full the
+            configured policy decides which message gets dropped.
+        """
+        with self.cond:
+            if self.coalesce:
+                dest = (id(comm_conn), output_name)
+                entry = self.pending.get(dest)
+                if entry is not None:
+                    self.log.debug("%s replacing queued message %s with %s",
+                                   self.name, entry[0], message)
+                    entry[0] = message
+                    with self.stats.lock:
+                        self.stats.queued += 1
+                        self.stats.coalesced += 1
+                    return
+            if len(self.queue) >= self.max_size:
+                with self.stats.lock:
+                    self.stats.dropped += 1
+                if self.policy == POLICY_DROP_NEWEST:
+                    self.log.warning("%s send queue is full, dropping message %s",
+                                     self.name, message)
+                    return
+                dropped = self.queue.popleft()
+                self._forget(dropped)
+                self.log.warning("%s send queue is full, dropping oldest message %s",
+                                 self.name, dropped[0])
+            entry = [message, comm_conn, output_name, time.monotonic()]
+            self.queue.append(entry)
+            if self.coalesce:
+                self.pending[(id(comm_conn), output_name)] = entry
+            with self.stats.lock:
+                self.stats.queued += 1
+                self.stats.queue_depth = len(self.queue)
+            self.cond.notify()
+
+    def _run(self) -> None:
+        """ Sender thread, publishes queued messages until stop() is called
+            and the queue is empty.
+        """
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                entry = self.queue.popleft()
+                self._forget(entry)
+                (message, comm_conn, output_name, queued) = entry
+                with self.stats.lock:
+                    self.stats.queue_depth = len(self.queue)
+            try:
+                self.handler(message, comm_conn, output_name)
+            # a failing message must not stop the sender thread
+            except:
+                self.log.error("%s error publishing message %s: %s",
+                               self.name, message, traceback.format_exc())
+            with self.stats.lock:
+                self.stats.sent += 1
+                self.stats.latency.add(time.monotonic() - queued)
+
+    def _forget(self,
+                entry:Entry) -> None:
+        """ Removes an entry taken from the queue from the pending destinations,
+            so the next message for that destination gets queued again.
+            Must be called with self.cond locked.
+        """
+        if self.coalesce:
+            del self.pending[(id(entry[1]), entry[2])]
+
+    def stop(self,
+             timeout:float = 5) -> None:
+        """ Stops the sender thread after the queued messages are sent.
+            Waits at most timeout seconds.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.log.warning("%s send queue not empty after %s seconds,"
+                             " %d messages lost", self.name, timeout, len(self.queue))
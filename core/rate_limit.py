@@ -0,0 +1,254 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the token bucket rate limiter for outbound messages of a connection.
+
+Classes:
+    - TokenBucket : Classic token bucket
+    - RateLimiter : Applies the rate limits of a connection and its destinations
+"""
+import time
+import logging
+import traceback
+from collections import deque
+from threading import Condition, Thread
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from core.metrics import PublishStats
+from core import timers
+
+# Policies when the rate limit is exceeded
+POLICY_COALESCE = 'Coalesce'
+POLICY_DROP = 'Drop'
+
+PARAM_RATE = 'RateLimit'
+PARAM_BURST = 'RateBurst'
+
+class TokenBucket():
+    """ Allows on average rate messages per second and bursts of up to
+        burst messages.
+    """
+
+    def __init__(self,
+                 rate:float,
+                 burst:Optional[float] = None) -> None:
+        """ Parameters:
+            - rate  : tokens added per second
+            - burst : maximum number of tokens, default is max(rate, 1)
+        """
+        if rate <= 0:
+            raise ValueError(f"{PARAM_RATE} must be greater than 0, got {rate}")
+        self.rate = rate
+        self.burst = max(float(burst if burst is not None else rate), 1.0)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def wait_time(self,
+                  now:float) -> float:
+        """ Returns the seconds until a token is available, 0 if one is available now. """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """ Removes one token, call only if wait_time() returned 0. """
+        self.tokens -= 1
+
+# destination of a message: (id(comm_conn), output_name)
+Destination = Tuple[int, Optional[str]]
+
+class RateLimiter():
+    """ Applies the rate limit of the whole connection ('RateLimit' and
+        'RateBurst' in the connection section) and the rate limits of single
+        destinations (same parameters in the sensor's connection section or
+        in the output sub-section).
+
+        If a limit is exceeded the message is either dropped (policy 'Drop')
+        or sent as soon as the limit allows, replaced by newer messages for
+        the same destination in the meantime (policy 'Coalesce').
+        The delayed messages are sent from a sender thread of the limiter,
+        the shared timer service only hands them over, so a slow connection
+        doesn't delay the other timers.
+    """
+
+    def __init__(self,
+                 conn_cfg:Dict[str, Any],
+                 send:Callable[[str, Dict[str, Any], Optional[str]], None],
+                 stats:PublishStats) -> None:
+        """ Parameters:
+            - conn_cfg : the connection config
+            - send     : called with message, comm_conn and output_name to send
+                         a coalesced message once the limit allows it,
+                         called from the sender thread of the limiter
+            - stats    : the statistics to update
+        """
+        self.log = logging.getLogger(type(self).__name__)
+        self.send = send
+        self.stats = stats
+        self.policy = conn_cfg.get('RateLimitPolicy', POLICY_COALESCE)
+        if self.policy not in [POLICY_COALESCE, POLICY_DROP]:
+            raise ValueError(f"Unknown RateLimitPolicy '{self.policy}', expected "
+                             f"'{POLICY_COALESCE}' or '{POLICY_DROP}'")
+        self.conn_bucket:Optional[TokenBucket] = None
+        if PARAM_RATE in conn_cfg:
+            self.conn_bucket = TokenBucket(float(conn_cfg[PARAM_RATE]),
+                                           conn_cfg.get(PARAM_BURST))
+        self.lock = Condition()
+        # bucket of each destination, None if the destination has no limit
+        self.buckets:Dict[Destination, Optional[TokenBucket]] = {}
+        # coalesced messages waiting for the limit: [message, comm_conn, output_name]
+        self.pending:Dict[Destination, List[Any]] = {}
+        self.handles:Dict[Destination, timers.TimerHandle] = {}
+        # destinations whose pending message is due, sent by the sender thread
+        # (the message stays in pending until then, so newer messages replace it)
+        self.ready:Deque[Destination] = deque()
+        self.sender:Optional[Thread] = None
+        self.stopping = False
+
+    @staticmethod
+    def _dest_bucket(comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Optional[TokenBucket]:
+        """ Creates the bucket of a destination from the parameters in the
+            output sub-section or in comm_conn.
+        """
+        local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
+        rate = local_comm.get(PARAM_RATE, comm_conn.get(PARAM_RATE))
+        if rate is None:
+            return None
+        return TokenBucket(float(rate),
+                           local_comm.get(PARAM_BURST, comm_conn.get(PARAM_BURST)))
+
+    def _wait_time(self,
+                   bucket:Optional[TokenBucket]) -> float:
+        """ Returns the seconds until the destination bucket and the
+            connection bucket have a token.
+        """
+        now = time.monotonic()
+        wait = bucket.wait_time(now) if bucket else 0.0
+        if self.conn_bucket:
+            wait = max(wait, self.conn_bucket.wait_time(now))
+        return wait
+
+    def _take(self,
+              bucket:Optional[TokenBucket]) -> None:
+        if bucket:
+            bucket.take()
+        if self.conn_bucket:
+            self.conn_bucket.take()
+
+    def allow(self,
+              message:str,
+              comm_conn:Dict[str, Any],
+              output_name:Optional[str]) -> bool:
+        """ Returns True if the message can be sent now. Otherwise the
+            message is dropped or kept to be sent later, depending on the policy.
+        """
+        dest = (id(comm_conn), output_name)
+        with self.lock:
+            try:
+                bucket = self.buckets[dest]
+            except KeyError:
+                bucket = self.buckets[dest] = self._dest_bucket(comm_conn, output_name)
+            if bucket is None and self.conn_bucket is None:
+                return True
+
+            entry = self.pending.get(dest)
+            if entry is not None:
+                # keep the order, the waiting message gets replaced by the new one
+                entry[0] = message
+                with self.stats.lock:
+                    self.stats.limited += 1
+                return False
+
+            wait = self._wait_time(bucket)
+            if wait == 0:
+                self._take(bucket)
+                return True
+
+            if self.policy == POLICY_DROP:
+                with self.stats.lock:
+                    self.stats.limited += 1
+                self.log.debug("Rate limit exceeded, dropping message %s", message)
+                return False
+            self.pending[dest] = [message, comm_conn, output_name]
+            self._schedule(dest, wait)
+            return False
+
+    def _schedule(self,
+                  dest:Destination,
+                  wait:float) -> None:
+        """ Schedules sending the pending message of dest after wait seconds.
+            Call with self.lock held.
+        """
+        self.handles[dest] = timers.call_later(wait, self._flush, dest)
+        self.stopping = False
+        if self.sender is None:
+            self.sender = Thread(target=self._send_ready, daemon=True,
+                                 name=f"{type(self).__name__}-sender")
+            self.sender.start()
+
+    def _flush(self,
+               dest:Destination) -> None:
+        """ Called by the timer service, hands the pending message of dest to
+            the sender thread if the limits allow it, otherwise waits again.
+        """
+        with self.lock:
+            if dest not in self.pending:
+                return
+            bucket = self.buckets[dest]
+            wait = self._wait_time(bucket)
+            if wait > 0:
+                # the connection limit was used up by other destinations
+                self._schedule(dest, wait)
+                return
+            self._take(bucket)
+            del self.handles[dest]
+            self.ready.append(dest)
+            self.lock.notify()
+
+    def _send_ready(self) -> None:
+        """ Sender thread, sends the due pending messages until stop() is called. """
+        while True:
+            with self.lock:
+                while not self.ready and not self.stopping:
+                    self.lock.wait()
+                if not self.ready:
+                    self.sender = None
+                    return
+                entry = self.pending.pop(self.ready.popleft(), None)
+                if entry is None:
+                    continue
+                with self.stats.lock:
+                    self.stats.deferred += 1
+            try:
+                self.send(*entry)
+            # an error of one message must not stop the sender thread
+            except:
+                self.log.error("Error sending rate limited message: %s",
+                               traceback.format_exc())
+
+    def stop(self) -> None:
+        """ Cancels the timers and sends the pending messages immediately. """
+        with self.lock:
+            for handle in self.handles.values():
+                handle.cancel()
+            self.handles.clear()
+            self.ready.clear()
+            pending = list(self.pending.values())
+            self.pending.clear()
+            self.stopping = True
+            self.lock.notify()
+        for entry in pending:
+            self.send(*entry)
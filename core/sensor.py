@@ -18,6 +18,7 @@ Classes: Sensor
 """
 
 from abc import ABC
+import asyncio
 import logging
 from typing import Any, Union, Optional, Dict, TYPE_CHECKING
 from core import utils
@@ -37,7 +38,8 @@ class Sensor(ABC):
         """
         Sets all the passed in arguments as data members. If params("Poll")
         exists self.poll will be set to that. If not it is initialized to -1.
-        self.last_poll is initialized to None.
+        If params("PollJitter") exists each poll is delayed by a random time
+        up to that many seconds. self.last_poll is initialized to None.
 
         Arguments:
         - publishers: Dictionary of connection-instances,
@@ -50,6 +52,7 @@ class Sensor(ABC):
                      contains connection named dictionaries for each connection
         - self.log: The log instance for this device
         - self.poll: The poll interval in seconds
+        - self.poll_jitter: The maximum random delay of a poll in seconds
         - self.name: device name, useful for log entries
         """
         self.log = logging.getLogger(type(self).__name__)
@@ -59,6 +62,7 @@ class Sensor(ABC):
         #Sensor Name is specified in sensor_reporter.py > creat_device()
         self.name = str(dev_cfg.get('Name'))
         self.poll = float(dev_cfg.get("Poll", -1))
+        self.poll_jitter = float(dev_cfg.get("PollJitter", 0))
 
         self.last_poll:Optional[float] = None
         utils.set_log_level(dev_cfg, self.log)
@@ -78,6 +82,15 @@ class Sensor(ABC):
         """
         self.publish_state()
 
+    async def async_check_state(self) -> None:
+        """Called instead of check_state when the PollManager uses the asyncio
+        engine. If not overridden it calls check_state() in the executor of
+        the event loop. I/O-bound sensors should override this with a native
+        asyncio implementation so they don't block an executor thread.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.check_state)
+
     def publish_state(self) -> None:
         """Called to publish the current state to the publishers. The default
         implementation is a pass.
@@ -103,17 +116,17 @@ class Sensor(ABC):
                            <connection_name>:
                                 <output_name>:
         """
-        #accept regular messages directly
-        if not isinstance(message, dict):
-            msg:str = message
-
-        for conn in comm.keys():
+        if isinstance(message, dict):
             #if message is a value_dict from get_msg_from_values, grab the current conn message
             #use list in default section if conn section is not present
-            if isinstance(message, dict):
-                msg = message.get(conn, message[utils.DEFAULT_SECTION])
-
-            self.publishers[conn].prepare_publish(msg, comm[conn], output_name)
+            default = message[utils.DEFAULT_SECTION]
+            for (conn, comm_conn) in comm.items():
+                self.publishers[conn].prepare_publish(message.get(conn, default),
+                                                      comm_conn, output_name)
+        else:
+            #accept regular messages directly
+            for (conn, comm_conn) in comm.items():
+                self.publishers[conn].prepare_publish(message, comm_conn, output_name)
 
     def cleanup(self) -> None:
         """Called when shutting down the sensor, give it a chance to clean up
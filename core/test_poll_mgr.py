@@ -0,0 +1,45 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests of the poll statistics sensor.
+
+    Run from the sensor_reporter directory:
+    bin/python -m unittest core.test_poll_mgr
+"""
+import json
+import unittest
+from typing import Any, List, Tuple
+from unittest import mock
+from core.poll_mgr import PollManager, STATS_SENSOR
+from mqtt.test_homie_conn import create_connection
+
+class TestPollStatsSensor(unittest.TestCase):
+    """ Tests of PollStatsSensor. """
+
+    def test_homie_connection(self) -> None:
+        """ A Homie section without Name publishes to a node named like the sensor. """
+        (conn, _) = create_connection()
+        published:List[Tuple[str, str]] = []
+        def publish_full_topic(message:str, full_topic:str, *args:Any) -> None:
+            published.append((full_topic, message))
+        poll_mgr = PollManager({'homie': conn}, {}, [],
+                               {'StatsConnections': {'homie': None}})
+        with mock.patch.object(conn, '_publish_full_topic', publish_full_topic):
+            poll_mgr.sensors[STATS_SENSOR].publish_state()
+        self.assertEqual([topic for (topic, _) in published],
+                         ['homie/test/pollstats/cmd', 'homie/test/pollstats/state'])
+        self.assertIn("Connection_homie", json.loads(published[0][1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains a shared timer service, so delayed calls cost a heap entry
+    instead of a threading.Timer thread each.
+
+Classes:
+    - TimerHandle  : Returned by call_later, used to cancel the call
+    - TimerService : Runs the delayed calls from one thread
+
+Functions:
+    - call_later   : Schedules a call on the shared TimerService
+"""
+import heapq
+import itertools
+import logging
+import time
+import traceback
+from threading import Condition, Thread
+from typing import Any, Callable, List, Optional, Tuple
+
+class TimerHandle():
+    """ Handle of a scheduled call, see TimerService.call_later. """
+
+    def __init__(self,
+                 deadline:float,
+                 func:Callable[..., Any],
+                 args:Tuple[Any, ...]) -> None:
+        self.deadline = deadline
+        self.func:Optional[Callable[..., Any]] = func
+        self.args = args
+
+    def cancel(self) -> None:
+        """ Cancels the call. Does nothing if it already ran. The entry stays
+            in the heap until its deadline, but is skipped.
+        """
+        self.func = None
+
+    @property
+    def cancelled(self) -> bool:
+        """ True if cancel() was called or the call already ran. """
+        return self.func is None
+
+class TimerService():
+    """ Runs delayed calls from a single daemon thread, ordered by a heap of
+        deadlines (time.monotonic). The calls must return quickly, since they
+        delay all following calls. Long running work should be handed to
+        another thread.
+    """
+
+    def __init__(self,
+                 name:str = "TimerService") -> None:
+        self.log = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.cond = Condition()
+        # (deadline, sequence number, handle), the sequence keeps the heap
+        # from comparing handles with the same deadline
+        self.heap:List[Tuple[float, int, TimerHandle]] = []
+        self.seq = itertools.count()
+        self.thread:Optional[Thread] = None
+
+    def call_later(self,
+                   delay:float,
+                   func:Callable[..., Any],
+                   *args:Any) -> TimerHandle:
+        """ Calls func(*args) after delay seconds from the timer thread.
+            Returns a handle to cancel the call.
+        """
+        handle = TimerHandle(time.monotonic() + delay, func, args)
+        with self.cond:
+            heapq.heappush(self.heap, (handle.deadline, next(self.seq), handle))
+            # start the thread on first use, so importing this module has no side effects
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            # only wake up the thread if the new call is the next one due
+            if self.heap[0][2] is handle:
+                self.cond.notify()
+        return handle
+
+    def _run(self) -> None:
+        """ Timer thread, waits for the next deadline and runs the due calls. """
+        while True:
+            with self.cond:
+                while True:
+                    # drop cancelled calls, so they don't cause useless wake ups
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        handle = heapq.heappop(self.heap)[2]
+                        break
+                    self.cond.wait(timeout)
+            func = handle.func
+            if func is None:
+                continue
+            handle.func = None
+            try:
+                func(*handle.args)
+            # an error of one call must not stop the timer thread
+            except:
+                self.log.error("Error in timer call %s: %s", func, traceback.format_exc())
+
+# shared instance used by the connections
+_service = TimerService()
+
+def call_later(delay:float,
+               func:Callable[..., Any],
+               *args:Any) -> TimerHandle:
+    """ Calls func(*args) after delay seconds from the shared timer thread.
+        Returns a handle to cancel the call.
+    """
+    return _service.call_later(delay, func, *args)
@@ -16,6 +16,7 @@
     poll and reports the results.
 """
 import subprocess
+import asyncio
 from typing import Any, Dict, TYPE_CHECKING
 import time
 import yaml
@@ -72,6 +73,34 @@ class ExecSensor(Sensor):
 
         self.publish_state()
 
+    async def async_check_state(self) -> None:
+        """ Asyncio version of check_state, runs the script as asyncio
+            subprocess so no thread is blocked while waiting for the result.
+        """
+        self.log.debug("%s executed with arguments %s", self.name, self.cmd_args)
+
+        proc = await asyncio.create_subprocess_exec(*self.cmd_args,
+                                                    stdout=asyncio.subprocess.PIPE)
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=self.poll)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            self.log.error("%s command took longer than %d to complete!",
+                           self.name, self.poll)
+            self.results = "ERROR"
+        else:
+            output = stdout.decode()
+            if proc.returncode:
+                self.log.error("%s command returned an error code %s\n%s",
+                               self.name, proc.returncode, output)
+            else:
+                self.results = output.rstrip()
+                self.log.info("%s command results %s",
+                              self.name, self.results)
+
+        self.publish_state()
+
     def publish_state(self) -> None:
         """ Publishes the most recent results from the script."""
         self._send(self.results, self.comm)
@@ -0,0 +1,238 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains a shared GPIO chip service, so the sensors of a chip use one
+    chip handle and polled inputs are read with one group read per tick
+    instead of one gpio_read per pin.
+
+Classes:
+    - GpioChip        : One opened GPIO chip and its polled inputs
+    - GpioChipService : Opens the chips and polls the inputs from one thread
+
+Functions:
+    - open_chip       : Returns the shared handle of a chip
+    - close_chip      : Releases the shared handle of a chip
+    - add_input       : Adds a pin to the polled inputs of a chip
+    - remove_input    : Removes a pin from the polled inputs of a chip
+"""
+import logging
+import time
+import traceback
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional
+import lgpio            # https://abyz.me.uk/lg/py_lgpio.html
+
+# called with (chip handle, gpio, level, timestamp in ns since the epoch)
+InputCallback = Callable[[int, int, int, int], None]
+
+class GpioChip():
+    """ An opened GPIO chip. The polled inputs are claimed as one lgpio group
+        per pull up/down setting, since all pins of a group share the flags.
+    """
+
+    def __init__(self,
+                 chip:int) -> None:
+        self.chip = chip
+        self.handle:int = lgpio.gpiochip_open(chip)
+        self.users = 0
+        # pull up/down flags => pins of the group, the first pin is the group leader
+        self.groups:Dict[int, List[int]] = {}
+        self.callbacks:Dict[int, InputCallback] = {}
+        self.levels:Dict[int, int] = {}
+
+    def claim_group(self,
+                    pud:int,
+                    pins:List[int]) -> None:
+        """ Claims pins as a new group, frees the old group with the same
+            flags first. An empty list only frees the old group.
+        """
+        old_pins = self.groups.pop(pud, [])
+        if old_pins:
+            lgpio.group_free(self.handle, old_pins[0])
+        if pins:
+            lgpio.group_claim_input(self.handle, pins, pud)
+            self.groups[pud] = pins
+
+    def read(self) -> Dict[int, int]:
+        """ Reads all polled inputs, one lgpio call per group.
+            Returns the pins which changed and their new level.
+        """
+        changed:Dict[int, int] = {}
+        for pins in self.groups.values():
+            (_, bits) = lgpio.group_read(self.handle, pins[0])
+            for (index, pin) in enumerate(pins):
+                level = (bits >> index) & 1
+                if self.levels.get(pin) != level:
+                    self.levels[pin] = level
+                    changed[pin] = level
+        return changed
+
+class GpioChipService():
+    """ Opens each GPIO chip once and polls the added inputs from a single
+        daemon thread. The tick interval is the shortest interval of the
+        added inputs. The callbacks are called from the poll thread and must
+        return quickly, since they delay the next tick.
+    """
+
+    def __init__(self,
+                 name:str = "GpioChipService") -> None:
+        self.log = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.lock = Lock()
+        self.chips:Dict[int, GpioChip] = {}
+        # pin => requested interval, per chip
+        self.intervals:Dict[int, Dict[int, float]] = {}
+        self.interval = 0.0
+        self.wake = Event()
+        self.thread:Optional[Thread] = None
+
+    def open_chip(self,
+                  chip:int) -> int:
+        """ Returns the handle of the chip, opens it on first use.
+            Raises lgpio.error if the chip can't be opened.
+        """
+        with self.lock:
+            if chip not in self.chips:
+                self.chips[chip] = GpioChip(chip)
+            self.chips[chip].users += 1
+            return self.chips[chip].handle
+
+    def close_chip(self,
+                   chip:int) -> None:
+        """ Closes the chip when the last user released it. """
+        with self.lock:
+            gpio_chip = self.chips.get(chip)
+            if gpio_chip is None:
+                return
+            gpio_chip.users -= 1
+            if gpio_chip.users <= 0:
+                del self.chips[chip]
+                lgpio.gpiochip_close(gpio_chip.handle)
+
+    def add_input(self,
+                  chip:int,
+                  pin:int,
+                  pud:int,
+                  interval:float,
+                  callback:InputCallback) -> int:
+        """ Claims pin of the opened chip as polled input with the pull
+            up/down flags pud. callback gets called when the level of the
+            pin changed. Returns the current level of the pin.
+            Raises lgpio.error if the pin can't be claimed.
+        """
+        with self.lock:
+            gpio_chip = self.chips[chip]
+            pins = gpio_chip.groups.get(pud, [])
+            try:
+                gpio_chip.claim_group(pud, pins + [pin])
+            except lgpio.error:
+                # restore the group without the new pin
+                gpio_chip.claim_group(pud, pins)
+                raise
+            gpio_chip.callbacks[pin] = callback
+            gpio_chip.levels[pin] = lgpio.gpio_read(gpio_chip.handle, pin)
+            self.intervals.setdefault(chip, {})[pin] = interval
+            self._update_interval()
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            self.log.debug("Polling %d inputs of chip %d every %s seconds",
+                           len(gpio_chip.callbacks), chip, self.interval)
+            return gpio_chip.levels[pin]
+
+    def remove_input(self,
+                     chip:int,
+                     pin:int) -> None:
+        """ Frees the polled input pin, the chip stays open. """
+        with self.lock:
+            gpio_chip = self.chips.get(chip)
+            if gpio_chip is None or pin not in gpio_chip.callbacks:
+                return
+            del gpio_chip.callbacks[pin]
+            gpio_chip.levels.pop(pin, None)
+            self.intervals[chip].pop(pin, None)
+            for (pud, pins) in list(gpio_chip.groups.items()):
+                if pin in pins:
+                    gpio_chip.claim_group(pud, [p for p in pins if p != pin])
+            self._update_interval()
+        # let the thread exit if nothing is left to poll
+        self.wake.set()
+
+    def _update_interval(self) -> None:
+        """ Sets the tick interval to the shortest requested interval. """
+        intervals = [i for pins in self.intervals.values() for i in pins.values()]
+        self.interval = min(intervals) if intervals else 0.0
+
+    def _run(self) -> None:
+        """ Poll thread, reads all inputs each tick and calls the callbacks
+            of the changed pins.
+        """
+        deadline = time.monotonic()
+        while True:
+            calls = []
+            with self.lock:
+                if not self.interval:
+                    self.thread = None
+                    return
+                interval = self.interval
+                timestamp = time.time_ns()
+                for gpio_chip in self.chips.values():
+                    try:
+                        changed = gpio_chip.read()
+                    except lgpio.error as err:
+                        self.log.error("Could not read the inputs of GPIO chip %d: %s",
+                                       gpio_chip.chip, err)
+                        continue
+                    calls += [(gpio_chip.callbacks[pin], gpio_chip.handle, pin, level)
+                              for (pin, level) in changed.items()]
+            for (callback, handle, pin, level) in calls:
+                try:
+                    callback(handle, pin, level, timestamp)
+                # an error of one sensor must not stop the poll thread
+                except:
+                    self.log.error("Error in GPIO callback for pin %d: %s",
+                                   pin, traceback.format_exc())
+            # keep the ticks on a fixed schedule, skip ticks if a tick took too long
+            deadline += interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            self.wake.wait(deadline - now)
+            self.wake.clear()
+
+# shared instance used by the GPIO sensors
+_service = GpioChipService()
+
+def open_chip(chip:int) -> int:
+    """ Returns the shared handle of the GPIO chip, see GpioChipService.open_chip. """
+    return _service.open_chip(chip)
+
+def close_chip(chip:int) -> None:
+    """ Releases the shared handle of the GPIO chip. """
+    _service.close_chip(chip)
+
+def add_input(chip:int,
+              pin:int,
+              pud:int,
+              interval:float,
+              callback:InputCallback) -> int:
+    """ Polls pin of chip every interval seconds with a group read,
+        see GpioChipService.add_input.
+    """
+    return _service.add_input(chip, pin, pud, interval, callback)
+
+def remove_input(chip:int,
+                 pin:int) -> None:
+    """ Stops polling pin of chip. """
+    _service.remove_input(chip, pin)
@@ -0,0 +1,162 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contains the GPIO edge event queues, so the lgpio callback thread only
+    stores the edges and a consumer thread publishes them.
+
+Classes:
+    - EdgeQueue      : Bounded queue of the edge events of one sensor
+    - EdgeDispatcher : Handles the events of all queues from one thread
+
+Functions:
+    - create_queue   : Creates a queue handled by the shared EdgeDispatcher
+"""
+import logging
+import time
+import traceback
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Callable, Deque, List, Optional, Tuple
+from core.metrics import EdgeStats
+
+# default maximum number of edge events waiting per sensor
+DEFAULT_QUEUE_SIZE = 256
+
+# called with (gpio, level, timestamp in ns since the epoch)
+EdgeHandler = Callable[[int, int, int], None]
+
+class EdgeQueue():
+    """ Bounded queue of (gpio, level, timestamp) edge events. put() is called
+        from the lgpio callback thread and only appends to a deque, which is
+        thread safe without a lock. If the queue is full the oldest event is
+        dropped, so the latest level of the pin is never lost.
+    """
+
+    def __init__(self,
+                 handler:EdgeHandler,
+                 maxlen:int,
+                 wake:Event) -> None:
+        """ Parameters:
+            - handler : called by the consumer for each event
+            - maxlen  : maximum number of waiting events
+            - wake    : set to wake up the consumer
+        """
+        self.handler = handler
+        self.maxlen = maxlen
+        self.events:Deque[Tuple[int, int, int]] = deque(maxlen=maxlen)
+        self.wake = wake
+        self.stats = EdgeStats()
+        # dropped events already logged by the consumer
+        self.logged_drops = 0
+
+    def put(self,
+            gpio:int,
+            level:int,
+            timestamp:Optional[int] = None) -> None:
+        """ Adds an edge event, timestamp defaults to now. """
+        if timestamp is None:
+            timestamp = time.time_ns()
+        depth = len(self.events)
+        if depth >= self.maxlen:
+            self.stats.dropped += 1
+        elif depth + 1 > self.stats.max_depth:
+            self.stats.max_depth = depth + 1
+        self.events.append((gpio, level, timestamp))
+        self.stats.queued += 1
+        self.wake.set()
+
+class EdgeDispatcher():
+    """ Handles the events of all edge queues from a single daemon thread.
+        The events of one queue are handled in order, so the handler of a
+        sensor is never called concurrently.
+    """
+
+    def __init__(self,
+                 name:str = "GpioEdgeDispatcher") -> None:
+        self.log = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.lock = Lock()
+        self.queues:List[EdgeQueue] = []
+        self.wake = Event()
+        self.thread:Optional[Thread] = None
+
+    def create_queue(self,
+                     handler:EdgeHandler,
+                     maxlen:int = DEFAULT_QUEUE_SIZE) -> EdgeQueue:
+        """ Returns a new queue whose events are passed to handler. """
+        queue = EdgeQueue(handler, maxlen, self.wake)
+        with self.lock:
+            self.queues.append(queue)
+            # start the thread on first use, so importing this module has no side effects
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+        return queue
+
+    def remove_queue(self,
+                     queue:EdgeQueue) -> None:
+        """ Stops handling the events of queue, waiting events are discarded.
+            The thread ends when the last queue is removed.
+        """
+        with self.lock:
+            if queue in self.queues:
+                self.queues.remove(queue)
+        self.wake.set()
+
+    def _run(self) -> None:
+        """ Consumer thread, handles the waiting events of all queues. """
+        while True:
+            self.wake.wait()
+            # clear before reading the queues, so an event added meanwhile
+            # wakes the thread again
+            self.wake.clear()
+            with self.lock:
+                if not self.queues:
+                    self.thread = None
+                    return
+                queues = list(self.queues)
+            for queue in queues:
+                self._drain(queue)
+
+    def _drain(self,
+               queue:EdgeQueue) -> None:
+        """ Passes the waiting events of queue to its handler. """
+        stats = queue.stats
+        while queue.events:
+            (gpio, level, timestamp) = queue.events.popleft()
+            stats.processed += 1
+            stats.latency.add(max(0.0, time.time_ns() - timestamp) / 1e9)
+            try:
+                queue.handler(gpio, level, timestamp)
+            # an error of one sensor must not stop the consumer
+            except:
+                self.log.error("Error handling the edge of GPIO %d: %s",
+                               gpio, traceback.format_exc())
+        dropped = stats.dropped
+        if dropped > queue.logged_drops:
+            self.log.warning("Edge queue full, dropped %d oldest events, increase 'EdgeQueueSize'",
+                             dropped - queue.logged_drops)
+            queue.logged_drops = dropped
+
+# shared instance used by the GPIO sensors
+_dispatcher = EdgeDispatcher()
+
+def create_queue(handler:EdgeHandler,
+                 maxlen:int = DEFAULT_QUEUE_SIZE) -> EdgeQueue:
+    """ Returns an edge queue handled by the shared dispatcher thread. """
+    return _dispatcher.create_queue(handler, maxlen)
+
+def remove_queue(queue:EdgeQueue) -> None:
+    """ Removes queue from the shared dispatcher. """
+    _dispatcher.remove_queue(queue)
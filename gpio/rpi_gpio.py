@@ -27,6 +27,7 @@ import lgpio            # https://abyz.me.uk/lg/py_lgpio.html
 from core.sensor import Sensor
 from core.actuator import Actuator
 from core import utils
+from gpio import chip_service, edge_queue
 if TYPE_CHECKING:
     # Fix circular imports needed for the type checker
     from core import connection
@@ -79,7 +80,13 @@ class RpiGpioSensor(Sensor):
                 - "EventDetection": when set instead of depending on sensor_reporter
                                     to poll it will relay on the event detection built into the GPIO
                                     library. Valid values are "RISING", "FALLING" and "BOTH".
-                                    When not defined "Poll" must be set to a positive value.
+                                    When not defined "Poll" or "SharedPoll" must be set to a
+                                    positive value.
+                - "SharedPoll"    : poll interval in seconds, instead of polling the pin
+                                    itself, the pin is read by the shared chip service
+                                    together with the other pins of the chip.
+                - "EdgeQueueSize" : maximum number of pin changes waiting to be published,
+                                    default 256
         """
         super().__init__(publishers, dev_cfg)
 
@@ -87,18 +94,13 @@ class RpiGpioSensor(Sensor):
 
         self.pin = int(dev_cfg["Pin"])
         gpio_chip = int(dev_cfg["GpioChip"])
+        self.gpio_chip = gpio_chip
+        self.shared_poll = float(dev_cfg.get("SharedPoll", -1))
 
         # Allow users to override the 0/1 pin values.
         self.values = utils.parse_values(self, self.publishers, ["OPEN", "CLOSED"])
 
         self.pud:int = lgpio.SET_PULL_UP if dev_cfg.get("PUD") == "UP" else lgpio.SET_PULL_DOWN
-        try:
-            self.chip_handle:int = lgpio.gpiochip_open(gpio_chip)
-        except lgpio.error as err:
-            self.log.error("%s could not setup GPIO chip %d. "
-                           "Make sure the chip number is correct. Error Message: %s",
-                           self.name, gpio_chip,err)
-
         # Set up event detection.
         try:
             event_detection:str = dev_cfg["EventDetection"]
@@ -113,13 +115,41 @@ class RpiGpioSensor(Sensor):
                 event_detection = "NONE"
         except KeyError:
             self.log.info("No event detection specified, falling back to polling "
-                          "with interval %s", self.poll)
+                          "with interval %s",
+                          self.shared_poll if self.shared_poll > 0 else self.poll)
             event_detection = "NONE"
 
+        # check the config before the chip, the pin and the edge queue get allocated
+        if self.shared_poll > 0 and (self.poll > 0 or event_detection != "NONE"):
+            raise ValueError("SharedPoll can't be combined with Poll or EventDetection")
+        if self.poll < 0 and self.shared_poll <= 0 and event_detection == "NONE":
+            raise ValueError("Event detection is NONE but polling is OFF")
+        if self.poll > 0 and event_detection != "NONE":
+            raise ValueError(f'Event detection is {event_detection} but polling is {self.poll}')
+
+        try:
+            # the sensors of a chip share one handle
+            self.chip_handle:int = chip_service.open_chip(gpio_chip)
+        except lgpio.error as err:
+            self.log.error("%s could not setup GPIO chip %d. "
+                           "Make sure the chip number is correct. Error Message: %s",
+                           self.name, gpio_chip,err)
+
+        # the lgpio callback only queues the edges, they get published
+        # by the consumer thread of the edge queue
+        self.edges = edge_queue.create_queue(
+            self.process_edge,
+            int(dev_cfg.get("EdgeQueueSize", edge_queue.DEFAULT_QUEUE_SIZE)))
+        self.edge_stats = self.edges.stats
+
         # Store callback handle for cleanup
         self.cb_handle:Optional[lgpio.callback] = None
         try:
-            if event_detection == "NONE":
+            if event_detection == "NONE" and self.shared_poll > 0:
+                # read with the other polled pins of the chip by one group read per tick
+                chip_service.add_input(gpio_chip, self.pin, self.pud,
+                                       self.shared_poll, self.gpio_event_cbf)
+            elif event_detection == "NONE":
                 lgpio.gpio_claim_input(self.chip_handle, self.pin, self.pud)
             else:
                 # setup event detection
@@ -134,11 +164,6 @@ class RpiGpioSensor(Sensor):
 
         self.state:int = lgpio.gpio_read(self.chip_handle, self.pin)
 
-        if self.poll < 0 and event_detection == "NONE":
-            raise ValueError("Event detection is NONE but polling is OFF")
-        if self.poll > 0 and event_detection != "NONE":
-            raise ValueError(f'Event detection is {event_detection} but polling is {self.poll}')
-
         self.btn = ButtonPressCfg(dev_cfg, self)
 
         # verify that defined output channels in Connections section are valid!
@@ -176,12 +201,13 @@ class RpiGpioSensor(Sensor):
                        _chip:Optional[int],
                        gpio:int,
                        level:int,
-                       _timestamp:Optional[int]) -> None:
-        """ Receives the current gpio pin state (level)
-            and if it's different from the
-            last state publishes it.
+                       timestamp:Optional[int]) -> None:
+        """ Receives the current gpio pin state (level) and queues it for
+            process_edge. Returns immediately, so a slow connection doesn't
+            delay the following edges.
             With event detection this method gets called
-            when the GPIO pin changed states (via lgpio callback).
+            when the GPIO pin changed states (via lgpio callback),
+            with SharedPoll from the thread of the chip service.
 
             Parameters:
             _chip        : The GPIO-Chip of the Pin that changed (unused)
@@ -190,7 +216,19 @@ class RpiGpioSensor(Sensor):
                             0 - LOW
                             1 - HIGH
                             2 - watchdog timeout
-            _timestamp    : Time stamp of the change event (unused)
+            timestamp    : Time stamp of the change event in nanoseconds
+                           since the epoch, None for now
+        """
+        self.edges.put(gpio, level, timestamp)
+
+    def process_edge(self,
+                     gpio:int,
+                     level:int,
+                     timestamp:int) -> None:
+        """ Called by the consumer of the edge queue with the queued pin
+            state (level), if it's different from the last state publishes it.
+            The button press duration is measured with the timestamps of
+            the edges, so a delayed consumer doesn't change the result.
         """
         # NOTE: Events triggered by Event_dectection only RISING / FALLING won't
         #       get processed since the level doesn't change.
@@ -204,7 +242,7 @@ class RpiGpioSensor(Sensor):
                           level, self.values[utils.DEFAULT_SECTION][not level])
             self.state = level
             self.publish_state()
-            self.btn.check_button_press(self)
+            self.btn.check_button_press(self, timestamp)
 
     def publish_state(self) -> None:
         """ Publishes the current state of the pin."""
@@ -212,9 +250,16 @@ class RpiGpioSensor(Sensor):
         self._send(msg, self.comm, OUT_SWITCH)
 
     def publish_button_state(self,
-                             is_short_press:bool) -> None:
-        """ Send update to destination depending on button press duration"""
-        curr_time_iso = datetime.datetime.now().isoformat()
+                             is_short_press:bool,
+                             timestamp:Optional[int] = None) -> None:
+        """ Send update to destination depending on button press duration.
+            timestamp is the time of the release in nanoseconds since the epoch,
+            default is now.
+        """
+        if timestamp is None:
+            curr_time_iso = datetime.datetime.now().isoformat()
+        else:
+            curr_time_iso = datetime.datetime.fromtimestamp(timestamp / 1e9).isoformat()
         if is_short_press:
             self._send(curr_time_iso, self.comm, OUT_SHORT_PRESS)
         else:
@@ -226,8 +271,12 @@ class RpiGpioSensor(Sensor):
                        self.name, self.pin)
         if self.cb_handle:
             self.cb_handle.cancel()
-        lgpio.gpio_free(self.chip_handle, self.pin)
-        lgpio.gpiochip_close(self.chip_handle)
+        edge_queue.remove_queue(self.edges)
+        if self.shared_poll > 0:
+            chip_service.remove_input(self.gpio_chip, self.pin)
+        else:
+            lgpio.gpio_free(self.chip_handle, self.pin)
+        chip_service.close_chip(self.gpio_chip)
 
 class ButtonPressCfg():
     """ Stores all button related parameters """
@@ -240,7 +289,8 @@ class ButtonPressCfg():
             - dev_cfg : the dictionary that stores the config values for a sensor
             - caller     : the object of the calling sensor
         """
-        self.high_time:Optional[datetime.datetime] = None
+        # time the contact closed in nanoseconds since the epoch
+        self.high_time:Optional[int] = None
         # Expect threshold in seconds
         # Set default for Short_Press-Threshold to 2ms,
         # lgpio edge detection reacts very sensitive to bouncy buttons
@@ -267,34 +317,36 @@ class ButtonPressCfg():
                         highlow_to_str(self.state_when_pressed))
 
     def check_button_press(self,
-                           caller:RpiGpioSensor) -> None:
+                           caller:RpiGpioSensor,
+                           timestamp:int) -> None:
         """ Checks the duration the contact was closed and
             rises the event configured with that duration
 
             Parameter:
-                 - caller : the object of the caller
-                            so self.log and self.publish_button_state can be accessed
+                 - caller    : the object of the caller
+                               so self.log and self.publish_button_state can be accessed
+                 - timestamp : time of the edge in nanoseconds since the epoch
          """
         # get time during button was closed
         if caller.state == self.state_when_pressed:
-            self.high_time = datetime.datetime.now()
+            self.high_time = timestamp
         elif self.high_time is None:
             caller.log.warning("%s expected contact closed before release."
                                " 'Btn_Pressed_State' is probably configured wrong"
                                " for Pin: %s", caller.name, caller.pin)
         else:
-            time_delta_seconds = (datetime.datetime.now() - self.high_time).total_seconds()
+            time_delta_seconds = (timestamp - self.high_time) / 1e9
             if time_delta_seconds > self.short_press_time:
                 if self.long_press_time != 0 and time_delta_seconds > self.long_press_time:
                     caller.log.info("%s long button press occurred on Pin %s"
                                   " was pressed for %s seconds",
                                   caller.name, caller.pin, time_delta_seconds)
-                    caller.publish_button_state(is_short_press = False)
+                    caller.publish_button_state(is_short_press = False, timestamp = timestamp)
                 else:
                     caller.log.info("%s short button press occurred on Pin %s"
                                   " was pressed for %s seconds",
                                   caller.name, caller.pin, time_delta_seconds)
-                    caller.publish_button_state(is_short_press = True)
+                    caller.publish_button_state(is_short_press = True, timestamp = timestamp)
 
 class RpiGpioActuator(Actuator):
     """ Allows for setting a GPIO pin to high or low on command.
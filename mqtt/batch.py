@@ -0,0 +1,115 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collects sensor readings and publishes them as one message per interval.
+
+Classes: Batch
+
+Functions: get_encoder
+"""
+import json
+import logging
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+from core import timers
+
+FORMAT_JSON = "json"
+FORMAT_CBOR = "cbor"
+FORMAT_MSGPACK = "msgpack"
+
+def get_encoder(fmt:str) -> Callable[[Dict[str, Any]], bytes]:
+    """ Returns the function encoding a batch in the format fmt.
+        CBOR and MessagePack need the optional python packages cbor2 or msgpack.
+    """
+    if fmt == FORMAT_JSON:
+        return lambda batch: json.dumps(batch, separators=(',', ':')).encode()
+    if fmt == FORMAT_CBOR:
+        try:
+            import cbor2
+        except ImportError as ex:
+            raise ImportError("BatchFormat 'cbor' requires the python package 'cbor2'") from ex
+        return cbor2.dumps
+    if fmt == FORMAT_MSGPACK:
+        try:
+            import msgpack
+        except ImportError as ex:
+            raise ImportError("BatchFormat 'msgpack' requires the python package 'msgpack'") from ex
+        return lambda batch: msgpack.packb(batch, use_bin_type=True)
+    raise ValueError(f"Unknown BatchFormat '{fmt}', expected "
+                     f"'{FORMAT_JSON}', '{FORMAT_CBOR}' or '{FORMAT_MSGPACK}'")
+
+class Batch():
+    """ Collects the latest reading of each field and publishes all of them
+        as one message, interval seconds after the first reading arrived.
+        The message is a map of the field names to {"v": reading, "t": time
+        of the reading in seconds since the epoch}.
+    """
+
+    def __init__(self,
+                 interval:float,
+                 fmt:str,
+                 publish:Callable[[bytes], bool]) -> None:
+        """ Parameters:
+            - interval : seconds to collect the readings
+            - fmt      : encoding of the message, json, cbor or msgpack
+            - publish  : called with the encoded message from the thread of
+                         the timer service, returns False if the message
+                         couldn't be sent, the readings are kept then
+        """
+        self.log = logging.getLogger(type(self).__name__)
+        self.interval = interval
+        self.encode = get_encoder(fmt)
+        self.publish = publish
+        self.lock = Lock()
+        self.readings:Dict[str, Dict[str, Any]] = {}
+        self.handle:Optional[timers.TimerHandle] = None
+
+    def add(self,
+            field:str,
+            message:str) -> None:
+        """ Adds a reading, replaces an older reading of the same field. """
+        with self.lock:
+            self.readings[field] = {"v": message, "t": round(time.time(), 3)}
+            if self.handle is None:
+                self.handle = timers.call_later(self.interval, self.flush)
+
+    def flush(self) -> None:
+        """ Publishes the collected readings. """
+        with self.lock:
+            self.handle = None
+            if not self.readings:
+                return
+            readings = self.readings
+            self.readings = {}
+        if self.publish(self.encode(readings)):
+            self.log.debug("Published batch of %d readings", len(readings))
+            return
+        with self.lock:
+            # keep the readings, unless they got newer in the meantime
+            readings.update(self.readings)
+            self.readings = readings
+            if self.handle is None:
+                self.handle = timers.call_later(self.interval, self.flush)
+
+    def stop(self) -> None:
+        """ Cancels the timer and publishes the collected readings. """
+        with self.lock:
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+            readings = self.readings
+            self.readings = {}
+        if readings:
+            self.publish(self.encode(readings))
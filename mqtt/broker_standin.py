@@ -0,0 +1,203 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Minimal MQTT 3.1.1 broker to test the failover and split mode of the
+   mqtt.mqtt_conn.MqttConnection without mosquitto. Prints the received
+   messages, acknowledges QoS 1/2, forwards messages to subscribers (QoS 0),
+   keeps retained messages and publishes the last will of clients that
+   disconnect without DISCONNECT. Accepts any login.
+
+   Run two instances from the sensor_reporter directory:
+   bin/python -m mqtt.broker_standin --port 1883
+   bin/python -m mqtt.broker_standin --port 1884
+   and set 'Brokers: [localhost:1883, localhost:1884]' in the connection
+   section. Stop one instance with Ctrl-C to watch the failover.
+"""
+import argparse
+import socketserver
+import struct
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+CONNECT = 1
+PUBLISH = 3
+PUBREL = 6
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+# subscriptions: client handler => set of topic filters
+subscriptions:Dict['MqttHandler', Set[str]] = {}
+# retained messages: topic => payload
+retained:Dict[str, bytes] = {}
+lock = Lock()
+
+def topic_matches(topic_filter:str, topic:str) -> bool:
+    """ Returns True if topic matches the filter with wildcards + and #. """
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for (index, level) in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(levels) or level not in ('+', levels[index]):
+            return False
+    return len(filter_levels) == len(levels)
+
+def encode_length(length:int) -> bytes:
+    """ Encodes the remaining length of a packet. """
+    data = bytearray()
+    while True:
+        (length, byte) = divmod(length, 128)
+        data.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(data)
+
+def encode_string(text:str) -> bytes:
+    data = text.encode()
+    return struct.pack('>H', len(data)) + data
+
+def read_string(body:bytes, pos:int) -> Tuple[bytes, int]:
+    """ Returns the length prefixed bytes at pos and the position after them. """
+    (length,) = struct.unpack_from('>H', body, pos)
+    return (body[pos + 2:pos + 2 + length], pos + 2 + length)
+
+class MqttHandler(socketserver.StreamRequestHandler):
+    """ Handles one MQTT client. """
+
+    def setup(self) -> None:
+        super().setup()
+        self.write_lock = Lock()
+        self.client_id = ''
+        self.will:Optional[Tuple[str, bytes, bool]] = None
+
+    def send(self, packet:bytes) -> None:
+        with self.write_lock:
+            self.wfile.write(packet)
+
+    def read_packet(self) -> Tuple[int, int, bytes]:
+        """ Returns type, flags and body of the next packet. """
+        header = self.rfile.read(1)
+        if not header:
+            raise ConnectionError("client closed the connection")
+        (length, shift) = (0, 0)
+        while True:
+            byte = self.rfile.read(1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = self.rfile.read(length)
+        return (header[0] >> 4, header[0] & 0x0F, body)
+
+    def handle(self) -> None:
+        try:
+            while True:
+                (ptype, flags, body) = self.read_packet()
+                if ptype == DISCONNECT:
+                    self.will = None
+                    return
+                self.on_packet(ptype, flags, body)
+        except (ConnectionError, IndexError, OSError):
+            pass
+        finally:
+            with lock:
+                subscriptions.pop(self, None)
+            print(f"Client '{self.client_id}' disconnected")
+            if self.will:
+                distribute(*self.will)
+
+    def on_packet(self, ptype:int, flags:int, body:bytes) -> None:
+        if ptype == CONNECT:
+            self.on_connect(body)
+        elif ptype == PUBLISH:
+            self.on_publish(flags, body)
+        elif ptype == PUBREL:
+            self.send(b'\x70\x02' + body[:2])
+        elif ptype == SUBSCRIBE:
+            self.on_subscribe(body)
+        elif ptype == UNSUBSCRIBE:
+            self.send(b'\xb0\x02' + body[:2])
+        elif ptype == PINGREQ:
+            self.send(b'\xd0\x00')
+
+    def on_connect(self, body:bytes) -> None:
+        (_, pos) = read_string(body, 0)
+        connect_flags = body[pos + 1]
+        (client_id, pos) = read_string(body, pos + 4)
+        self.client_id = client_id.decode()
+        if connect_flags & 0x04:
+            (will_topic, pos) = read_string(body, pos)
+            (will_msg, pos) = read_string(body, pos)
+            self.will = (will_topic.decode(), will_msg, bool(connect_flags & 0x20))
+        print(f"Client '{self.client_id}' connected")
+        self.send(b'\x20\x02\x00\x00')
+
+    def on_publish(self, flags:int, body:bytes) -> None:
+        qos = (flags >> 1) & 0x03
+        (topic, pos) = read_string(body, 0)
+        packet_id = body[pos:pos + 2]
+        payload = body[pos + 2:] if qos else body[pos:]
+        print(f"{self.client_id:20} {topic.decode():40} qos={qos} {payload.decode(errors='replace')}")
+        if qos == 1:
+            self.send(b'\x40\x02' + packet_id)
+        elif qos == 2:
+            self.send(b'\x50\x02' + packet_id)
+        distribute(topic.decode(), payload, bool(flags & 0x01))
+
+    def on_subscribe(self, body:bytes) -> None:
+        packet_id = body[:2]
+        (pos, granted, filters) = (2, b'', [])
+        while pos < len(body):
+            (topic_filter, pos) = read_string(body, pos)
+            filters.append(topic_filter.decode())
+            pos += 1
+            granted += b'\x00'
+        with lock:
+            subscriptions.setdefault(self, set()).update(filters)
+            messages = [(topic, payload) for (topic, payload) in retained.items()
+                        if any(topic_matches(f, topic) for f in filters)]
+        self.send(b'\x90' + encode_length(2 + len(granted)) + packet_id + granted)
+        for (topic, payload) in messages:
+            self.send_publish(topic, payload, True)
+
+    def send_publish(self, topic:str, payload:bytes, retain:bool) -> None:
+        data = encode_string(topic) + payload
+        self.send(bytes([0x31 if retain else 0x30]) + encode_length(len(data)) + data)
+
+def distribute(topic:str, payload:bytes, retain:bool) -> None:
+    """ Forwards a message to all subscribers, stores retained messages. """
+    with lock:
+        if retain:
+            if payload:
+                retained[topic] = payload
+            else:
+                retained.pop(topic, None)
+        receivers = [handler for (handler, filters) in subscriptions.items()
+                     if any(topic_matches(f, topic) for f in filters)]
+    for handler in receivers:
+        try:
+            handler.send_publish(topic, payload, False)
+        except OSError:
+            pass
+
+parser = argparse.ArgumentParser(description='Minimal MQTT broker for testing.')
+parser.add_argument('--port', type=int, default=1883,
+                    help='port to listen on (default 1883)')
+args = parser.parse_args()
+
+socketserver.ThreadingTCPServer.allow_reuse_address = True
+with socketserver.ThreadingTCPServer(('', args.port), MqttHandler) as server:
+    server.daemon_threads = True
+    print(f"Listening on port {args.port}, stop with Ctrl-C")
+    server.serve_forever()
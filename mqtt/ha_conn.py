@@ -0,0 +1,259 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contains the Home Assistant MQTT discovery connection class.
+
+Classes: HomeAssistantConnection
+"""
+import json
+import re
+from threading import Lock, Thread
+from typing import Callable, Optional, Any, Dict, Tuple
+import paho.mqtt.client as mqtt
+from mqtt.mqtt_conn import MqttConnection, ONLINE, OFFLINE
+from mqtt.retained import RetainedCollector
+from core.connection import Route
+from core.utils import ChanType, ChanConst, OUT, IN
+
+OUT_STATE = "state"
+IN_CMD_SET = "set"
+PARA_CMD_SRC = "CommandSrc"
+DEFAULT_DISCOVERY_PREFIX = "homeassistant"
+# default seconds to wait for the retained discovery configs after connecting
+DEFAULT_DISCOVERY_TIMEOUT = 10
+
+def object_id(name:str) -> str:
+    """ Returns name in the form allowed in discovery topics: a-z, 0-9, _ and -. """
+    return re.sub(r'[^a-z0-9_-]', '_', name.lower())
+
+class HomeAssistantConnection(MqttConnection):
+    """ Publishes the sensors and actuators via MQTT and makes them available in
+        Home Assistant using MQTT discovery. The discovery configs are created
+        from the channel properties every device sets with
+        core.utils.configure_device_channel, like for the HomieConnection.
+    """
+
+    def __init__(self,
+                 msg_processor:Callable[[str], None],
+                 conn_cfg:Dict[str, Any]) -> None:
+        """ Establishes the MQTT connection and starts the MQTT thread.
+            Additionally to the MQTT parameters expects:
+            - "DeviceID": id of the device in Home Assistant
+            - "DiscoveryPrefix": optional discovery prefix of Home Assistant,
+                                 default homeassistant
+            - "DiscoveryTimeout": optional seconds to wait for the retained
+                                  discovery configs after connecting, default 10
+            RootTopic defaults to sensor_reporter/<DeviceID>
+        """
+        self.device_id = object_id(conn_cfg["DeviceID"])
+        conn_cfg["RootTopic"] = conn_cfg.get("RootTopic", f"sensor_reporter/{self.device_id}")
+        #overwrite conn_cfg["Client"] if not present
+        conn_cfg["Client"] = conn_cfg.get("Client", self.device_id)
+        self.prefix = conn_cfg.get("DiscoveryPrefix", DEFAULT_DISCOVERY_PREFIX)
+
+        # discovery configs of the registered channels, config topic => JSON payload
+        self.configs:Dict[str, str] = {}
+        self.existing_configs:Dict[str, str] = {}
+        self.discovery_requested = False
+        self.collection_done = False
+        self.discovery_done = False
+        self.discovery_lock = Lock()
+        self.collector = RetainedCollector(
+            f"{self.prefix}/+/{self.device_id}/#",
+            f"sensor_reporter/{conn_cfg['Client']}/sentinel",
+            float(conn_cfg.get("DiscoveryTimeout", DEFAULT_DISCOVERY_TIMEOUT)),
+            self._configs_collected)
+
+        super().__init__(msg_processor, conn_cfg)
+        self.device = {"identifiers": [f"sensor_reporter_{self.device_id}"],
+                       "name": conn_cfg["DeviceID"],
+                       "manufacturer": "sensor_reporter"}
+
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves the state topic and retain flag of the output.
+            States are retained by default, so Home Assistant shows them
+            after a restart.
+        """
+        if 'Name' not in comm_conn:
+            return Route()
+        #if output_name is in the communication dict parse it's contents
+        local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
+        return Route((self._state_topic(comm_conn['Name'], output_name),),
+                     local_comm.get('Retain', True),
+                     self._check_qos(local_comm.get('QoS', self.default_qos)),
+                     int(local_comm.get('MessageExpiry', self.default_expiry)))
+
+    def _state_topic(self,
+                     node:str,
+                     output_name:Optional[str]) -> str:
+        """ Returns the full state topic of an output of a device. """
+        return f"{self.root_topic}/{object_id(node)}/{object_id(output_name or OUT_STATE)}"
+
+    def register(self,
+                 comm_conn:Dict[str, Any],
+                 handler:Optional[Callable[[str], None]]) -> None:
+        """ Registers actuators and sensors with the connection.
+            Actuators have to provide a handler to be called on messages received.
+            If no handler is provided the registration of a sensor is assumed.
+            Creates the discovery configs from the channel properties.
+
+        expects following device config:
+        Connections:
+            ha_conn:
+                Name: <device_name>
+                DeviceClass: <optional Home Assistant device class>
+        """
+        if 'Name' not in comm_conn:
+            # e.g. the refresh topic of the connection
+            super().register(comm_conn, handler)
+            return
+        node = comm_conn['Name']
+        #set command source for actuators
+        if handler and PARA_CMD_SRC not in comm_conn:
+            comm_conn[PARA_CMD_SRC] = f"{object_id(node)}/{IN_CMD_SET}"
+
+        super().register(comm_conn, handler)
+
+        if IN in comm_conn:
+            self._add_config(node, None, comm_conn, comm_conn[IN], True)
+        elif OUT in comm_conn:
+            self._add_config(node, None, comm_conn, comm_conn[OUT], False)
+        else:
+            for (output, local_comm) in comm_conn.items():
+                if isinstance(local_comm, dict) and OUT in local_comm:
+                    self._add_config(node, output, local_comm, local_comm[OUT], False)
+
+    def _add_config(self,
+                    node:str,
+                    output_name:Optional[str],
+                    local_comm:Dict[str, Any],
+                    props:Dict[str, Any],
+                    is_input:bool) -> None:
+        """ Creates the discovery config of one channel. """
+        channel = object_id(output_name or OUT_STATE)
+        (component, config) = self.get_config(props, is_input)
+        config.update({"name": f"{node} {props.get(ChanConst.NAME, channel)}",
+                       "unique_id": f"{self.device_id}_{object_id(node)}_{channel}",
+                       "state_topic": self._state_topic(node, output_name),
+                       "availability_topic": f"{self.root_topic}/{self.lwt}",
+                       "payload_available": ONLINE,
+                       "payload_not_available": OFFLINE,
+                       "device": self.device})
+        if is_input:
+            # actuators get registered a second time without handler
+            command_src = local_comm.get(PARA_CMD_SRC, f"{object_id(node)}/{IN_CMD_SET}")
+            config["command_topic"] = f"{self.root_topic}/{command_src}"
+        if "DeviceClass" in local_comm:
+            config["device_class"] = local_comm["DeviceClass"]
+        topic = f"{self.prefix}/{component}/{self.device_id}/{object_id(node)}_{channel}/config"
+        self.configs[topic] = json.dumps(config, sort_keys=True, separators=(',', ':'))
+
+    @staticmethod
+    def get_config(props:Dict[str, Any],
+                   is_input:bool) -> Tuple[str, Dict[str, Any]]:
+        """ Returns the Home Assistant component and the component specific
+            part of the discovery config for the channel properties created by
+            utils.configure_device_channel.
+        """
+        datatype = props.get(ChanConst.DATATYPE, ChanType.STRING)
+        unit = props.get(ChanConst.UNIT)
+        fmt = props.get(ChanConst.FORMAT) or ""
+        config:Dict[str, Any] = {}
+        if unit:
+            config["unit_of_measurement"] = unit
+        options = [option for option in fmt.split(",") if option]
+
+        if datatype == ChanType.BOOLEAN:
+            config.update({"payload_on": "true", "payload_off": "false"})
+            return ("switch" if is_input else "binary_sensor", config)
+        if is_input:
+            if datatype == ChanType.ENUM and "ON" in options and "OFF" in options:
+                config.update({"payload_on": "ON", "payload_off": "OFF"})
+                return ("switch", config)
+            if datatype == ChanType.ENUM:
+                config["options"] = options
+                return ("select", config)
+            if datatype in (ChanType.INTEGER, ChanType.FLOAT):
+                if ":" in fmt:
+                    (minimum, maximum) = fmt.split(":", 1)
+                    config.update({"min": float(minimum), "max": float(maximum)})
+                if datatype == ChanType.FLOAT:
+                    config["step"] = 0.1
+                return ("number", config)
+            return ("text", config)
+        if datatype in (ChanType.INTEGER, ChanType.FLOAT):
+            config["state_class"] = "measurement"
+        elif datatype == ChanType.ENUM and options:
+            config.update({"device_class": "enum", "options": options})
+        return ("sensor", config)
+
+    def on_connect(self,
+                   client:mqtt.Client,
+                   userdata:Any,
+                   flags:Dict[str, int],
+                   retcode:int,
+                   properties:Any = None) -> None:
+        """ Called when the client connects to the broker. On the first connect
+            the discovery configs of this device known by the broker get
+            collected, so only changed configs are published.
+        """
+        super().on_connect(client, userdata, flags, retcode, properties)
+        if self.discovery_done:
+            return
+        self.collection_done = False
+        self.collector.start(self.client)
+
+    def _configs_collected(self,
+                           topics:Dict[str, str]) -> None:
+        """ Called by the collector when all retained discovery configs of the
+            device arrived, publishes the configs if already requested.
+        """
+        self.existing_configs = topics
+        self.collection_done = True
+        if self.discovery_requested:
+            # don't block the network thread of paho with the discovery messages,
+            # the shared timer thread isn't used since the calls must be short
+            Thread(target=self._publish_discovery, daemon=True,
+                   name=f"HaDiscovery-{self.device_id}").start()
+
+    def publish_device_properties(self) -> None:
+        """ Publishes the discovery configs of all registered sensors and
+            actuators. If the retained configs are not collected yet, the
+            configs are published as soon as the collection is done.
+        """
+        self.discovery_requested = True
+        if self.collection_done:
+            self._publish_discovery()
+
+    def _publish_discovery(self) -> None:
+        """ Publishes changed discovery configs and deletes the configs of
+            removed channels.
+        """
+        with self.discovery_lock:
+            if self.discovery_done or not self.connected:
+                return
+            self.discovery_done = True
+        published = 0
+        for (topic, payload) in self.configs.items():
+            if self.existing_configs.get(topic) != payload:
+                self._publish_full_topic(payload, topic, True)
+                published += 1
+        for topic in self.existing_configs.keys() - self.configs.keys():
+            self.log.debug("deleting unused discovery config: %s", topic)
+            self._publish_full_topic('', topic, True)
+        self.log.info("Made %d channels available for Home Assistant discovery,"
+                      " published %d changed configs", len(self.configs), published)
+        self.existing_configs.clear()
@@ -17,17 +17,27 @@
 
 Classes: HomieConnection
 """
-from typing import Callable, Optional, Any, Dict, List, cast
+import hashlib
+import json
+import os
+from threading import Lock, Thread
+from typing import Callable, Optional, Any, Dict, List, Set, Tuple, cast
 from homie_spec import Node, Property, Device
 from homie_spec.properties import Datatype
 import paho.mqtt.client as mqtt
 from mqtt.mqtt_conn import MqttConnection, REFRESH
+from mqtt.retained import RetainedCollector
+from core.connection import Route
 from core.utils import ChanType, ChanConst, OUT, IN
 
 OUT_STATE = "state"
 IN_CMD_SET = "set"
 IN_CMD = "cmd"
 PARA_CMD_SRC = "CommandSrc"
+# default seconds to wait for the retained topics after connecting
+DEFAULT_DISCOVERY_TIMEOUT = 10
+# group of the device attributes in the discovery cache, the nodes use their id
+DEVICE_GROUP = "$device"
 
 class HomieConnection(MqttConnection):
     """ Connects to and enables subscription and publishing to MQTT via Homie convention.
@@ -49,6 +59,12 @@ class HomieConnection(MqttConnection):
                  conn_cfg:Dict[str, Any]) -> None:
         """ Establishes the MQTT connection and starts the MQTT thread.
             will announce the registered devices to the homie standard
+            Optional parameter:
+            - "DiscoveryCache": file to store the hashes of the published
+                                nodes, so unchanged nodes aren't published
+                                again after a restart
+            - "DiscoveryTimeout": seconds to wait for the retained topics of
+                                  the device after connecting, default 10
         """
         self.device_id = conn_cfg["DeviceID"].lower()
         self.name = self.device_id + "-sensor_reporter"
@@ -65,18 +81,25 @@ class HomieConnection(MqttConnection):
         self.refresh_comm = { 'Name':'conn',
                              'CommandSrc':f"conn/{REFRESH}/set"
                              }
+        #publish LTW to homie
+        self.will = (f"{conn_cfg['RootTopic']}/$state", 'lost')
+
+        #existing retained topics and their payload get collected after connecting,
+        #see on_connect, while the sensors and actuators are created
+        self.existing_topics:Dict[str, str] = {}
+        self.cache_file:Optional[str] = conn_cfg.get("DiscoveryCache")
+        self.discovery_requested = False
+        self.collection_done = False
+        self.discovery_done = False
+        self.discovery_lock = Lock()
+        self.collector = RetainedCollector(
+            f"{conn_cfg['RootTopic']}/#",
+            f"sensor_reporter/{conn_cfg['Client']}/sentinel",
+            float(conn_cfg.get("DiscoveryTimeout", DEFAULT_DISCOVERY_TIMEOUT)),
+            self._topics_collected)
 
         super().__init__(msg_processor, conn_cfg)
 
-        #get all topic of this device known by the mqtt server
-        self.topics_to_delete:List[str] = []
-        device_topic = f"{self.root_topic}/#"
-        self.client.subscribe(device_topic, qos=0)
-        self.client.message_callback_add(device_topic, self.collect_existing_topics)
-
-        #publish LTW to homie
-        self.client.will_set(f"{self.root_topic}/$state", 'lost', qos=2, retain=True)
-
         #add conneciton properties
         conn_prop = Node(
                 name="connection",
@@ -89,40 +112,27 @@ class HomieConnection(MqttConnection):
                     })
         self.device.nodes["conn"] = conn_prop
 
-    def publish(self,
-                message:str,
-                comm_conn:Dict[str, Any],
-                output_name:Optional[str] = None) -> None:
-        """ Publishes message to destination, logging if there is an error.
-
-        Arguments:
-        - message:     the message to process / publish
-        - comm_conn:   dictionary containing only the parameters for the called connection,
-                       e. g. information where to publish
-        - output_name: optional, the output channel to publish the message to,
-                       defines the subdirectory in comm_conn to look for the return topic.
-                       When defined the output_name must be present
-                       in the sensor YAML configuration:
-                       Connections:
-                           <connection_name>:
-                                <output_name>:
-        """
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves the homie topics and retain flag of the output. """
         #if output_name is in the communication dict parse it's contens
         local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
 
         #build destination for homie devices
         #homie expects for recieved commands that the IN_CMD topic is updated
-        destination = comm_conn['Name'] + "/" + ( output_name if output_name else IN_CMD )
+        destinations = [comm_conn['Name'] + "/" + ( output_name if output_name else IN_CMD )]
+        if output_name is None:
+            destinations.append(comm_conn['Name'] + "/" + OUT_STATE)
 
         retain = True
+        qos = self.default_qos
         if OUT in local_comm.keys():
             retain = local_comm[OUT].get('Retain', True)
+            qos = self._check_qos(local_comm[OUT].get('QoS', qos))
         #homie expects topic in lower case
-        self._publish_mqtt(message, destination.lower(), retain)
-
-        if output_name is None:
-            destination = comm_conn['Name'] + "/" + OUT_STATE
-            self._publish_mqtt(message, destination.lower(), retain)
+        return Route(tuple(f"{self.root_topic}/{dest.lower()}" for dest in destinations),
+                     retain, qos, self.default_expiry)
 
     def register(self,
                  comm_conn:Dict[str, Any],
@@ -209,63 +219,155 @@ class HomieConnection(MqttConnection):
                         settable = p_settable, get=dummy_getter,
                         unit = p_unit, retained=p_retained, formatOf=p_format)
 
-    #pylint: disable=unused-argument
-    def collect_existing_topics(self,
-                                client:mqtt.Client,
-                                userdata:Any,
-                                msg:mqtt.MQTTMessage) -> None:
-        """ read out existing topics for this connection and
-            collect them in a list
+    def on_connect(self,
+                   client:mqtt.Client,
+                   userdata:Any,
+                   flags:Dict[str, int],
+                   retcode:int,
+                   properties:Any = None) -> None:
+        """ Called when the client connects to the broker. On the first connect
+            all topics of this device known by the broker get collected, so the
+            unused ones can be deleted when the device properties are published.
         """
-        if msg.retain and msg.topic not in self.topics_to_delete:
-            self.topics_to_delete.append(msg.topic)
-            #self.log.debug(f"collected topic: {msg.topic}")
-    #pylint: enable=unused-argument
+        super().on_connect(client, userdata, flags, retcode, properties)
+        if self.discovery_done:
+            return
+        #get all topic of this device known by the mqtt server
+        self.collection_done = False
+        self.collector.start(self.client)
+
+    def _topics_collected(self,
+                          topics:Dict[str, str]) -> None:
+        """ Called by the collector when all retained topics of the device
+            arrived, publishes the device properties if already requested.
+        """
+        self.existing_topics = topics
+        self.collection_done = True
+        if self.discovery_requested:
+            # don't block the network thread of paho with the discovery messages,
+            # the shared timer thread isn't used since the calls must be short
+            Thread(target=self._publish_discovery, daemon=True,
+                   name=f"HomieDiscovery-{self.device_id}").start()
 
     def publish_device_properties(self) -> None:
         """ Method is intended for connections with auto discover of sensors
             and actuators. Such a connection can place the necessary code for auto
             discover inside this method. It is called after all connections, sensors
             and actuators are created and running.
+            If the retained topics of the device are not collected yet, the
+            properties are published as soon as the collection is done.
         """
-        state_topic = "$state"
-        prop_topic = "$properties"
-        #remove and unsubscribe from device messages, was only used to get existing topics
-        device_topic = f"{self.root_topic}/#"
-        self.client.message_callback_remove(device_topic)
-        self.client.unsubscribe(device_topic)
-
+        self.discovery_requested = True
+        if self.collection_done:
+            self._publish_discovery()
+
+    def _load_cache(self) -> Dict[str, str]:
+        """ Returns the node hashes of the last discovery, empty if unknown. """
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file, encoding="utf-8") as file:
+                cache = json.load(file)
+            return cache if isinstance(cache, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            self.log.warning("Ignoring invalid discovery cache %s: %s", self.cache_file, ex)
+            return {}
+
+    def _save_cache(self,
+                    cache:Dict[str, str]) -> None:
+        """ Stores the node hashes, replaces the old file only when complete. """
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file + ".tmp", "w", encoding="utf-8") as file:
+                json.dump(cache, file, indent=1, sort_keys=True)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except OSError as ex:
+            self.log.warning("Can't write discovery cache %s: %s", self.cache_file, ex)
+
+    def _discovery_groups(self) -> Tuple[Dict[str, Dict[str, Tuple[str, bool]]], Set[str]]:
+        """ Returns the discovery messages grouped by node (DEVICE_GROUP for the
+            device attributes) as {group: {topic: (payload, retained)}} and the
+            topics of the property values, which must not be deleted.
+        """
+        groups:Dict[str, Dict[str, Tuple[str, bool]]] = {}
+        value_topics:Set[str] = set()
+        prefix_len = len(self.root_topic) + 1
         for msg in self.device.messages():
-            #remove used topics from delete list
-            if msg.topic in self.topics_to_delete:
-                self.topics_to_delete.remove(msg.topic)
-
-            if msg.topic.endswith(prop_topic):
-                for prop in msg.payload.split(','):
-                    property_path = msg.topic.replace(prop_topic, prop)
-                    if property_path in self.topics_to_delete:
-                        self.topics_to_delete.remove(property_path)
-
-            #omit $state = ready message so unused topics can get deleted
-            if not (msg.topic.endswith(state_topic) and msg.payload == 'ready'):
+            group = msg.topic[prefix_len:].split("/", 1)[0]
+            if group.startswith("$"):
+                group = DEVICE_GROUP
+            groups.setdefault(group, {})[msg.topic] = (msg.payload, msg.retained)
+            if msg.topic.endswith("/$properties"):
+                node_topic = msg.topic[:-len("$properties")]
+                value_topics.update(node_topic + prop for prop in msg.payload.split(",") if prop)
+        return (groups, value_topics)
+
+    def _publish_discovery(self) -> None:
+        """ Publishes the device properties and deletes unused topics.
+            Attributes the broker already has retained with the same payload
+            are not published again. A node is skipped completely if its hash
+            matches the discovery cache and the broker kept the device topics.
+            If something changed, $state is init while the attributes are
+            published and ready afterwards, like homie_spec's messages().
+        """
+        with self.discovery_lock:
+            if self.discovery_done or not self.connected:
+                return
+            self.discovery_done = True
+        state_topic = "$state"
+        full_state_topic = f"{self.root_topic}/{state_topic}"
+
+        (groups, value_topics) = self._discovery_groups()
+        cache = self._load_cache()
+        new_cache:Dict[str, str] = {}
+        # without the retained $state the broker lost the topics of the device
+        broker_state = self.existing_topics.get(full_state_topic)
+        wanted_topics:Set[str] = set()
+        changed:List[Tuple[str, str, bool]] = []
+        skipped = 0
+        for (group, messages) in groups.items():
+            wanted_topics.update(messages)
+            digest = hashlib.sha1(json.dumps(sorted(messages.items())).encode()).hexdigest()
+            new_cache[group] = digest
+            if broker_state is not None and cache.get(group) == digest:
+                skipped += len(messages)
+                continue
+            for (topic, (payload, retained)) in messages.items():
+                #$state is published around the changed attributes
+                if topic == full_state_topic or \
+                (retained and self.existing_topics.get(topic) == payload):
+                    skipped += 1
+                    continue
+                changed.append((topic, payload, retained))
+        unused = self.existing_topics.keys() - wanted_topics - value_topics
+        self.existing_topics.clear()
+
+        if changed or unused:
+            self._publish_mqtt('init', state_topic, True)
+            for (topic, payload, retained) in changed:
                 #remove root topic since publish_mqtt will add it again
-                self._publish_mqtt(msg.payload,
-                                   msg.topic.replace(f"{self.root_topic}/",""),
-                                   msg.retained)
-
-        for topic in self.topics_to_delete:
-            self.log.debug("deleting unused topic: %s", topic)
-            #Devices can remove old properties and nodes by
-            #publishing a zero-length payload on the respective topics.
-            self._publish_mqtt('', topic.replace(f"{self.root_topic}/",""), True)
-
-        self._publish_mqtt('ready', state_topic, True)
+                self._publish_mqtt(payload, topic.replace(f"{self.root_topic}/", ""), retained)
+            for topic in unused:
+                self.log.debug("deleting unused topic: %s", topic)
+                #Devices can remove old properties and nodes by
+                #publishing a zero-length payload on the respective topics.
+                self._publish_mqtt('', topic.replace(f"{self.root_topic}/",""), True)
+            self._publish_mqtt('ready', state_topic, True)
+        elif broker_state != 'ready':
+            # e.g. lost or disconnected from the last run
+            self._publish_mqtt('ready', state_topic, True)
+        self._save_cache(new_cache)
 
         node_keys = ""
         # 'self.device.nodes' could be None
         if isinstance(self.device.nodes, dict):
             node_keys = ", ".join(self.device.nodes.keys())
         self.log.info("Made following devices available for homie auto discover: %s", node_keys)
+        self.log.debug("Published %d discovery messages, %d were unchanged",
+                       len(changed), skipped)
 
     def disconnect(self) -> None:
         """ publish homie connection state &
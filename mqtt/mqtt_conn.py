@@ -16,16 +16,103 @@
 
 Classes: MqttConnection
 """
+import queue
+import random
 import socket
+import time
 import traceback
-from time import sleep
-from typing import Callable, Optional, Any, Tuple, Dict
+import zlib
+from threading import Condition, Lock, Thread
+from typing import Callable, Optional, Any, List, Tuple, Dict, Union, cast
 import paho.mqtt.client as mqtt
-from core.connection import Connection
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from core.connection import Connection, ConnState, Route
+from mqtt.batch import Batch, FORMAT_JSON
 
 REFRESH = "refresh"
 ONLINE = "ONLINE"
 OFFLINE = "OFFLINE"
+# paho's default number of unacknowledged QoS 1/2 messages
+DEFAULT_MAX_INFLIGHT = 20
+# default number of QoS 1/2 messages tracked until the broker acks them
+DEFAULT_MAX_UNACKED = 1000
+# seconds to wait on disconnect for the acks of in-flight messages
+ACK_TIMEOUT = 2
+# seconds between the connection checks while a replayed message is sent
+REPLAY_WAIT = 1
+# BrokerMode values
+BROKER_MODE_FAILOVER = "failover"
+BROKER_MODE_SPLIT = "split"
+# seconds to wait for a broker to accept a TCP connection on failover
+PROBE_TIMEOUT = 2
+# supported values of the Protocol parameter
+PROTOCOLS = {"3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5, "5.0": mqtt.MQTTv5}
+# size of the MQTT v5 publish properties: identifier + value
+SIZE_TOPIC_ALIAS = 3
+SIZE_MESSAGE_EXPIRY = 5
+
+def varint_size(value:int) -> int:
+    """ Returns the bytes needed to encode value as MQTT variable byte integer. """
+    size = 1
+    while value >= 128:
+        value //= 128
+        size += 1
+    return size
+
+def publish_size(topic:str,
+                 payload:bytes,
+                 qos:int,
+                 properties_size:Optional[int]) -> int:
+    """ Returns the size of a PUBLISH packet on the wire in bytes, without
+        TCP/TLS overhead. properties_size is None for MQTT 3.1.1.
+    """
+    remaining = 2 + len(topic.encode()) + len(payload) + (2 if qos else 0)
+    if properties_size is not None:
+        remaining += varint_size(properties_size) + properties_size
+    return 1 + varint_size(remaining) + remaining
+
+def parse_brokers(conn_cfg:Dict[str, Any]) -> List[Tuple[str, int]]:
+    """ Returns the (host, port) of the brokers in the 'Brokers' list of
+        conn_cfg, or of 'Host' and 'Port' if 'Brokers' isn't configured.
+        A broker is either a "host:port" string or a dict with Host and Port,
+        the port defaults to 'Port' of the connection or 1883.
+    """
+    if "Brokers" not in conn_cfg:
+        return [(conn_cfg["Host"], int(conn_cfg["Port"]))]
+    default_port = int(conn_cfg.get("Port", 1883))
+    brokers = []
+    for broker in conn_cfg["Brokers"]:
+        if isinstance(broker, dict):
+            brokers.append((broker["Host"], int(broker.get("Port", default_port))))
+        else:
+            (host, _, port) = str(broker).partition(":")
+            brokers.append((host, int(port) if port else default_port))
+    if not brokers:
+        raise ValueError("Brokers must contain at least one broker")
+    return brokers
+
+def probe_brokers(brokers:List[Tuple[str, int]],
+                  timeout:float) -> Optional[int]:
+    """ Tries to open a TCP connection to all brokers at the same time.
+        Returns the index of the first broker that accepted the connection,
+        None if no broker answered within timeout seconds.
+    """
+    answered:'queue.Queue[int]' = queue.Queue()
+
+    def probe(index:int, host:str, port:int) -> None:
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                answered.put(index)
+        except OSError:
+            pass
+
+    for (index, (host, port)) in enumerate(brokers):
+        Thread(target=probe, args=(index, host, port), daemon=True).start()
+    try:
+        return answered.get(timeout=timeout)
+    except queue.Empty:
+        return None
 
 class MqttConnection(Connection):
     """ Connects to and enables subscription and publishing to MQTT."""
@@ -37,6 +124,12 @@ class MqttConnection(Connection):
             Expects the following parameters in params:
             - "Host": hostname or IP address of the MQTT broker
             - "Port": port for the MQTT broker
+            - "Brokers": optional list of brokers "host:port" replacing Host
+                         and Port, the first one is used on start up
+            - "BrokerMode": optional, 'failover' (default) switches to the
+                            broker answering first if the connection fails,
+                            'split' connects to all brokers and spreads the
+                            published topics across them
             - "Client": client ID to register with the MQTT broker, must be unique
             - "RootTopic": root topic that will be the vase of the topic hierarchy
                         this connection subscribes and publishes to.
@@ -50,8 +143,25 @@ class MqttConnection(Connection):
             - "Password": MQTT broker login password
             - "Keepalive": MQTT keepalive parameter
 
-        If the connection fails, it will keep retrying every five seconds until
-        the connection is successful.
+            - "ReconnectMin": optional minimum delay between reconnect attempts
+            - "ReconnectMax": optional maximum delay between reconnect attempts
+            - "QoS": optional default QoS of published messages, default 0
+            - "MaxInflight": optional maximum number of unacknowledged QoS 1/2
+                             messages, further messages are queued by paho
+            - "MaxUnacked": optional maximum number of QoS 1/2 messages tracked
+                            until acknowledged, default 1000
+            - "Protocol": optional MQTT version, "3.1.1" (default) or "5"
+            - "MessageExpiry": optional default message expiry interval in
+                               seconds of published messages (MQTT 5 only)
+            - "BatchTopic": optional topic to publish the readings of all
+                            outputs as one message every BatchInterval seconds
+            - "BatchInterval": optional seconds to collect readings, default 10
+            - "BatchFormat": optional encoding of the batch, json (default),
+                             cbor or msgpack
+
+        The connection is established in the background. If it fails, it will
+        keep retrying with a delay doubling from ReconnectMin up to ReconnectMax
+        seconds. Until then messages are stored in the offline buffer.
 
         RootTopic/status is the LWT topic and will have ONLINE/OFFLINE published
         as a retained message to indicate the online status of this connection.
@@ -66,72 +176,141 @@ class MqttConnection(Connection):
             self.refresh_comm = { 'CommandSrc':REFRESH }
 
         # Get the parameters, raises KeyError if one doesn't exist
-        self.host = conn_cfg["Host"]
-        self.port = int(conn_cfg["Port"])
+        self.brokers = parse_brokers(conn_cfg)
+        (self.host, self.port) = self.brokers[0]
+        self.broker_mode = conn_cfg.get("BrokerMode", BROKER_MODE_FAILOVER)
+        if self.broker_mode not in [BROKER_MODE_FAILOVER, BROKER_MODE_SPLIT]:
+            raise ValueError(f"Unknown BrokerMode '{self.broker_mode}', expected "
+                             f"'{BROKER_MODE_FAILOVER}' or '{BROKER_MODE_SPLIT}'")
+        # probes the brokers after the connection failed, see _failover
+        self.failover_lock = Lock()
+        self.failover_thread:Optional[Thread] = None
         client_name = conn_cfg["Client"]
         self.root_topic = conn_cfg["RootTopic"]
-
-        #optional parameters
-        tls = conn_cfg.get("TLS", False)
-        ca_cert = conn_cfg.get("CAcert", None)
-        tls_insecure = conn_cfg.get("TLSinsecure", False)
-
-        user = conn_cfg["User"]
-        passwd = conn_cfg["Password"]
         self.keepalive = int(conn_cfg["Keepalive"])
 
         self.msg_processor = msg_processor
 
+        self.default_qos = self._check_qos(conn_cfg.get("QoS", 0))
+        protocol = str(conn_cfg.get("Protocol", "3.1.1"))
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown Protocol '{protocol}', expected '3.1.1' or '5'")
+        self.protocol = PROTOCOLS[protocol]
+        self.default_expiry = int(conn_cfg.get("MessageExpiry", 0))
+        # MQTT v5 topic aliases of each client: id(client) => {full_topic: alias},
+        # replaced on every connect since the broker forgets them
+        self.aliases:Dict[int, Dict[str, int]] = {}
+        # maximum number of topic aliases the broker accepts from each client
+        self.alias_max:Dict[int, int] = {}
+        # keeps the decision to send only the alias and the publish together
+        self.alias_lock = Lock()
+
+        # optional batch of the readings, outputs with 'Batch: no' are
+        # published immediately. full topics of the batched outputs => field name
+        self.batch:Optional[Batch] = None
+        self.batch_fields:Dict[str, str] = {}
+        if "BatchTopic" in conn_cfg:
+            self.batch_topic = f"{self.root_topic}/{conn_cfg['BatchTopic']}"
+            self.batch = Batch(float(conn_cfg.get("BatchInterval", 10)),
+                               conn_cfg.get("BatchFormat", FORMAT_JSON),
+                               self._publish_batch)
+        # QoS 1/2 messages waiting for the ack of the broker by (id(client), mid):
+        # [publish time, MQTTMessageInfo, message, comm_conn, output_name]
+        self.inflight:Dict[Tuple[int, int], List[Any]] = {}
+        self.inflight_cond = Condition()
+        # acks of not yet tracked messages by (id(client), mid): time of the ack,
+        # also contains QoS 0 messages, limited to the newest MaxUnacked entries
+        self.early_acks:Dict[Tuple[int, int], float] = {}
+        self.max_unacked = int(conn_cfg.get("MaxUnacked", DEFAULT_MAX_UNACKED))
+
+        self.reconnect_min = float(conn_cfg.get("ReconnectMin", 1))
+        self.reconnect_max = float(conn_cfg.get("ReconnectMax", 120))
+
         # Initialize the client
-        self.client = mqtt.Client(client_id=client_name, clean_session=True)
-        if tls:
-            self.log.debug("TLS is true, CA cert is: {}".format(ca_cert))
-            if ca_cert:
-                self.client.tls_set(ca_cert)
-            else:
-                self.client.tls_set()
-            self.log.debug("TLS insecure is {}".format(tls_insecure))
-            self.client.tls_insecure_set(tls_insecure)
+        self.client = self._create_client(client_name, conn_cfg)
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_subscribe = self.on_subscribe
-        self.client.on_publish = self.on_publish
-        self.client.username_pw_set(user, passwd)
-
-        self.log.info(
-            "Attempting to connect to MQTT broker at %s:%s", self.host, self.port
-        )
-        self.connected = False
-        self._connect()
+        self.client.on_connect_fail = self.on_connect_fail
+
+        # in split mode the sensor readings are published by one client per broker,
+        # self.client also handles the subscriptions and the LWT
+        self.split_clients = [self.client]
+        if self.broker_mode == BROKER_MODE_SPLIT:
+            for (index, (host, port)) in enumerate(self.brokers[1:], 1):
+                client = self._create_client(f"{client_name}-{index}", conn_cfg)
+                client.on_connect = self.on_split_connect
+                client.on_disconnect = self.on_split_disconnect
+                client.connect_async(host, port=port, keepalive=self.keepalive)
+                client.loop_start()
+                self.split_clients.append(client)
 
         lwtt = "{}/{}".format(self.root_topic, self.lwt)
         ref = "{}/{}".format(self.root_topic, REFRESH)
+        #use LWT topic and message of child class if defined
+        if not hasattr(self, 'will'):
+            self.will = (lwtt, OFFLINE)
 
         self.log.info(
-            "LWT topic is %s, subscribing to refresh topic %s", lwtt, ref)
-        self.client.will_set(lwtt, OFFLINE, qos=2, retain=True)
+            "LWT topic is %s, subscribing to refresh topic %s", self.will[0], ref)
+        # the will has to be set before connecting
+        self.client.will_set(self.will[0], self.will[1], qos=2, retain=True)
+        self.connected = False
         self.register(self.refresh_comm, msg_processor)
 
+        # Don't block the start up if the broker is not available,
+        # connecting and reconnecting is done by the network thread of paho
+        self.log.info(
+            "Attempting to connect to MQTT broker at %s:%s", self.host, self.port
+        )
+        self.client.connect_async(self.host, port=self.port, keepalive=self.keepalive)
         self.client.loop_start()
 
         # ONLINE state for lwtt and the base class will be set
         # after fully connected in on_connect()
 
-    def _connect(self) -> None:
-        while not self.connected:
-            try:
-                self.client.connect(self.host, port=self.port,
-                                    keepalive=self.keepalive)
-                self.connected = True
-            except socket.error:
-                self.log.error("Error connecting to %s:%s",
-                               self.host, self.port)
-                self.log.debug("Exception: %s", traceback.format_exc())
-                sleep(5)
-                self.connected = False
-
-        self.log.info("Connection to MQTT is successful")
-        super().conn_is_connecting()
+    def _create_client(self,
+                       client_name:str,
+                       conn_cfg:Dict[str, Any]) -> mqtt.Client:
+        """ Creates a paho client with the TLS, login, reconnect and
+            in-flight settings of the connection.
+        """
+        if self.protocol == mqtt.MQTTv5:
+            # MQTT v5 uses clean_start of connect() instead of clean_session
+            client = mqtt.Client(client_id=client_name, protocol=mqtt.MQTTv5)
+        else:
+            client = mqtt.Client(client_id=client_name, clean_session=True)
+        #optional parameters
+        tls = conn_cfg.get("TLS", False)
+        ca_cert = conn_cfg.get("CAcert", None)
+        tls_insecure = conn_cfg.get("TLSinsecure", False)
+        if tls:
+            self.log.debug("TLS is true, CA cert is: {}".format(ca_cert))
+            if ca_cert:
+                client.tls_set(ca_cert)
+            else:
+                client.tls_set()
+            self.log.debug("TLS insecure is {}".format(tls_insecure))
+            client.tls_insecure_set(tls_insecure)
+        client.on_publish = self.on_publish
+        client.username_pw_set(conn_cfg["User"], conn_cfg["Password"])
+
+        self._set_reconnect_delay(client)
+        client.max_inflight_messages_set(
+            int(conn_cfg.get("MaxInflight", DEFAULT_MAX_INFLIGHT)))
+        return client
+
+    def _set_reconnect_delay(self,
+                             client:mqtt.Client) -> None:
+        """ paho reconnects in its network thread, doubling the delay from
+            ReconnectMin up to ReconnectMax seconds. A random minimum between
+            ReconnectMin and twice its value spreads the reconnects of many
+            clients after a broker restart. Called again on every disconnect,
+            so each connection loss gets a new random delay.
+        """
+        client.reconnect_delay_set(
+            min_delay=max(1, round(random.uniform(self.reconnect_min, 2 * self.reconnect_min))),
+            max_delay=int(self.reconnect_max))
 
     def publish(self,
                 message:str,
@@ -151,49 +330,300 @@ class MqttConnection(Connection):
                            <connection_name>:
                                 <output_name>:
         """
+        self._publish_route(message, comm_conn, output_name)
+
+    def _publish_route(self,
+                       message:str,
+                       comm_conn:Dict[str, Any],
+                       output_name:Optional[str]) -> List[Optional[mqtt.MQTTMessageInfo]]:
+        """ Publishes message to the destinations of the route of comm_conn and
+            output_name. Returns the message infos of paho, None for a
+            destination the message wasn't handed to paho. Batched outputs
+            are not included.
+        """
+        infos = []
+        route = self.get_route(comm_conn, output_name)
+        #if output_name (output) is not present in comm_conn, there is no destination
+        for full_topic in route.destinations:
+            field = self.batch_fields.get(full_topic)
+            if field is not None:
+                cast(Batch, self.batch).add(field, message)
+                continue
+            client = self._client_for(full_topic)
+            sent = time.monotonic()
+            info = self._publish_full_topic(message, full_topic, route.retain,
+                                            route.qos, client, route.expiry)
+            if info is not None and route.qos > 0:
+                self._track(client, info, sent, message, comm_conn, output_name)
+            infos.append(info)
+        return infos
+
+    def _replay_publish(self,
+                        message:str,
+                        comm_conn:Dict[str, Any],
+                        output_name:Optional[str]) -> bool:
+        """ Publishes a reading of the offline buffer and waits until paho
+            sent it, for QoS 1/2 until the broker acknowledged it. So only one
+            replayed reading is queued by paho at a time.
+            Returns False if the connection got lost meanwhile.
+        """
+        for info in self._publish_route(message, comm_conn, output_name):
+            if info is None:
+                if not self.connected:
+                    return False
+                # the error got logged, don't block the replay with this reading
+                continue
+            try:
+                while not info.is_published():
+                    if not self.connected or self.state != ConnState.ONLINE:
+                        return False
+                    info.wait_for_publish(REPLAY_WAIT)
+            # not accepted by paho, e.g. QoS 1/2 messages while not connected
+            except (RuntimeError, ValueError):
+                return False
+        return True
+
+    def _client_for(self,
+                    full_topic:str) -> mqtt.Client:
+        """ Returns the client to publish full_topic with. In split mode the
+            topic is always mapped to the same broker, so the order of its
+            messages is kept. Falls back to self.client if that broker is
+            not connected.
+        """
+        if len(self.split_clients) == 1:
+            return self.client
+        client = self.split_clients[zlib.crc32(full_topic.encode()) % len(self.split_clients)]
+        if client is not self.client and not client.is_connected():
+            return self.client
+        return client
+
+    @staticmethod
+    def _check_qos(qos:Any) -> int:
+        """ Returns qos as integer, raises ValueError if it is not 0, 1 or 2. """
+        qos = int(qos)
+        if qos not in (0, 1, 2):
+            raise ValueError(f"QoS must be 0, 1 or 2, got {qos}")
+        return qos
+
+    def _track(self,
+               client:mqtt.Client,
+               info:mqtt.MQTTMessageInfo,
+               sent:float,
+               message:str,
+               comm_conn:Dict[str, Any],
+               output_name:Optional[str]) -> None:
+        """ Remembers a published QoS 1/2 message until the broker acks it.
+            If MaxUnacked messages are tracked, the oldest is forgotten,
+            paho still sends it again after reconnecting.
+            sent is the time before the message was handed to paho.
+        """
+        key = (id(client), info.mid)
+        with self.inflight_cond:
+            # on_publish is called before paho marks the message as published,
+            # an ack arriving before the message got tracked is in early_acks
+            acked = self.early_acks.pop(key, None)
+            if acked is not None and acked < sent:
+                # ack of an older message with the same mid
+                acked = None
+            if acked is None and info.is_published():
+                acked = time.monotonic()
+            if acked is not None:
+                with self.publish_stats.lock:
+                    self.publish_stats.acked += 1
+                    self.publish_stats.ack_latency.add(acked - sent)
+                return
+            if len(self.inflight) >= self.max_unacked:
+                # dicts keep the insertion order, the first entry is the oldest
+                (_, _, old_message, _, _) = self.inflight.pop(next(iter(self.inflight)))
+                with self.publish_stats.lock:
+                    self.publish_stats.unacked += 1
+                self.log.debug("Too many unacknowledged messages, no longer tracking %s",
+                               old_message)
+            self.inflight[key] = [sent, info, message, comm_conn, output_name]
+            with self.publish_stats.lock:
+                self.publish_stats.inflight = len(self.inflight)
+
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves the full topic and retain flag of the output. """
         #if output_name is in the communication dict parse it's contents
         local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
 
         destination = local_comm.get('StateDest')
-        retain = local_comm.get('Retain', False)
-
-        #if output_name (output) is not present in comm_conn, StateDest will be None
         if destination is None:
-            return
-
-        self._publish_mqtt(message, destination, retain)
+            return Route()
+        if self.batch is not None and local_comm.get('Batch', True):
+            self.batch_fields[f"{self.root_topic}/{destination}"] = destination
+        return Route((f"{self.root_topic}/{destination}",),
+                     local_comm.get('Retain', False),
+                     self._check_qos(local_comm.get('QoS', self.default_qos)),
+                     int(local_comm.get('MessageExpiry', self.default_expiry)))
+
+    def _publish_batch(self,
+                       payload:bytes) -> bool:
+        """ Publishes the encoded batch, returns False if not connected. """
+        if not self.connected:
+            return False
+        return self._publish_full_topic(payload, self.batch_topic, False, self.default_qos,
+                                        expiry=self.default_expiry) is not None
 
     def _publish_mqtt(self,
                       message:str,
                       topic:str,
                       retain:bool) -> None:
+        """ Publishes message to topic appended to the root_topic. """
+        self._publish_full_topic(message, f"{self.root_topic}/{topic}", retain)
+
+    def _publish_full_topic(self,
+                            message:Union[str, bytes],
+                            full_topic:str,
+                            retain:bool,
+                            qos:int = 0,
+                            client:Optional[mqtt.Client] = None,
+                            expiry:int = 0) -> Optional[mqtt.MQTTMessageInfo]:
+        """ Publishes message to full_topic with client, default is self.client.
+            expiry is the message expiry interval in seconds (MQTT v5 only).
+            Returns the message info of paho, None if the message was not
+            handed to paho.
+            QoS 1/2 messages are also handed to paho while not connected,
+            paho sends them after reconnecting.
+        """
         try:
-            if not self.connected:
+            if not self.connected and qos == 0:
                 self.log.warning(
                     "MQTT is not currently connected!"
-                    " Ignoring message: %s, for topic: %s" , message, topic)
-                return
-            full_topic = "{}/{}".format(self.root_topic, topic)
-            rval = self.client.publish(
-                        full_topic, message, retain=retain, qos=0)
-            if rval[0] == mqtt.MQTT_ERR_NO_CONN:
+                    " Ignoring message: %s, for topic: %s" , message, full_topic)
+                return None
+            client = client or self.client
+            payload = message if isinstance(message, bytes) else str(message).encode()
+            if self.protocol == mqtt.MQTTv5:
+                with self.alias_lock:
+                    # a (re)connect replaces the table, so an alias of the old
+                    # session isn't recorded in the new one
+                    aliases = self.aliases.setdefault(id(client), {})
+                    (topic, properties, properties_size) = self._publish_properties(
+                        client, full_topic, qos, expiry)
+                    rval = client.publish(topic, payload, retain=retain, qos=qos,
+                                          properties=properties)
+                    new_alias = getattr(properties, "TopicAlias", None) if topic else None
+                    if new_alias is not None and rval.rc == mqtt.MQTT_ERR_SUCCESS:
+                        # the broker knows the alias only after the message was sent
+                        aliases[full_topic] = new_alias
+            else:
+                (topic, properties_size) = (full_topic, None)
+                rval = client.publish(topic, payload, retain=retain, qos=qos)
+            if rval.rc == mqtt.MQTT_ERR_NO_CONN and qos == 0:
                 self.log.error(
                     "Error puiblishing update %s to %s", message, full_topic)
-            else:
-                self.log.debug(
-                    "Published message %s to %s retain=%s", message, full_topic, retain
-                )
+                return None
+            if rval.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                self.log.error("Error publishing update %s to %s: %s",
+                               message, full_topic, mqtt.error_string(rval.rc))
+                return None
+            self.log.debug(
+                "Published message %s to %s retain=%s qos=%s",
+                message, full_topic, retain, qos
+            )
+            size = publish_size(topic, payload, qos, properties_size)
+            with self.publish_stats.lock:
+                self.publish_stats.wire_bytes += size
+                self.publish_stats.message_size.add(size)
+            return rval
         except ValueError:
             self.log.error(
                 "Unexpected error publishing MQTT message: %s", traceback.format_exc()
             )
+            return None
+
+    def _publish_properties(self,
+                            client:mqtt.Client,
+                            full_topic:str,
+                            qos:int,
+                            expiry:int) -> Tuple[str, Properties, int]:
+        """ Returns the topic to send, the MQTT v5 publish properties and
+            their size. The first message to a topic gets a topic alias, as
+            long as the broker accepts more aliases, following messages are
+            sent with the alias and an empty topic. A new alias is only
+            returned in the properties, the caller records it after the
+            message was handed to paho successfully.
+            QoS 1/2 messages are always sent with the full topic, since paho
+            resends them after a reconnect, when the broker forgot the aliases.
+        """
+        properties = Properties(PacketTypes.PUBLISH)
+        size = 0
+        if expiry > 0:
+            properties.MessageExpiryInterval = expiry
+            size += SIZE_MESSAGE_EXPIRY
+        if qos > 0:
+            return (full_topic, properties, size)
+        topic = full_topic
+        aliases = self.aliases.get(id(client), {})
+        alias = aliases.get(full_topic)
+        if alias is not None:
+            topic = ""
+        elif len(aliases) < self.alias_max.get(id(client), 0):
+            alias = len(aliases) + 1
+        if alias is not None:
+            properties.TopicAlias = alias
+            size += SIZE_TOPIC_ALIAS
+        return (topic, properties, size)
+
+    def _reset_aliases(self,
+                       client:mqtt.Client,
+                       properties:Optional[Properties]) -> None:
+        """ Forgets the topic aliases of client after (re)connecting and
+            disconnecting, and reads the number of aliases the broker accepts
+            from the CONNACK (None when disconnected).
+        """
+        self.alias_max[id(client)] = getattr(properties, "TopicAliasMaximum", 0)
+        self.aliases[id(client)] = {}
 
     def disconnect(self) -> None:
         """ Closes the connection to the MQTT broker."""
         self.log.info("Disconnecting from MQTT")
+        if self.batch is not None:
+            self.batch.stop()
         self._publish_mqtt(OFFLINE, self.lwt, True)
-        self.client.loop_stop()
-        self.client.disconnect()
+        self._wait_for_acks()
+        for client in self.split_clients:
+            client.loop_stop()
+            client.disconnect()
+        self._store_unacked()
+
+    def _wait_for_acks(self) -> None:
+        """ Waits up to ACK_TIMEOUT seconds for the acks of the in-flight messages. """
+        with self.inflight_cond:
+            if self.connected:
+                self.inflight_cond.wait_for(lambda: not self.inflight, ACK_TIMEOUT)
+
+    def _store_unacked(self,
+                       client:Optional[mqtt.Client] = None) -> None:
+        """ Hands the QoS 1/2 messages of client (default all clients) which
+            didn't get acknowledged to the offline buffer, so they are sent
+            after reconnecting or after the next start.
+        """
+        with self.inflight_cond:
+            keys = [key for key in self.inflight
+                    if client is None or key[0] == id(client)]
+            unacked = [entry for entry in (self.inflight.pop(key) for key in keys)
+                       if not entry[1].is_published()]
+            with self.publish_stats.lock:
+                self.publish_stats.inflight = len(self.inflight)
+            if not self.inflight:
+                self.inflight_cond.notify_all()
+        if not unacked:
+            return
+        with self.publish_stats.lock:
+            self.publish_stats.unacked += len(unacked)
+        if self.offline_buffer is None:
+            self.log.warning("%d messages were not acknowledged by the broker and are lost,"
+                             " configure 'OfflineBufferFile' to keep them", len(unacked))
+            return
+        self.log.info("Storing %d not acknowledged messages in the offline buffer",
+                      len(unacked))
+        for (_, _, message, comm_conn, output_name) in unacked:
+            self.offline_buffer.append(comm_conn, output_name, message)
 
     def register(self,
                  comm_conn:Dict[str, Any],
@@ -232,11 +662,13 @@ class MqttConnection(Connection):
                    client:mqtt.Client,
                    userdata:Any,
                    flags:Dict[str, int],
-                   retcode:int) -> None:
+                   retcode:int,
+                   properties:Optional[Properties] = None) -> None:
         """ Called when the client connects to the broker, resubscribe to the
             sensorReporter topic.
             Gets automatically called from self.client after connection
             got fully established (on first connect and on reconnect)
+            properties are only passed with MQTT v5.
         """
         refresh = "{}/{}".format(self.root_topic, REFRESH)
         self.log.info(
@@ -249,6 +681,7 @@ class MqttConnection(Connection):
             refresh,
         )
 
+        self._reset_aliases(client, properties)
         self.connected = True
 
         # Publish the ONLINE message to the LWT
@@ -267,7 +700,8 @@ class MqttConnection(Connection):
     def on_disconnect(self,
                       client:mqtt.Client,
                       userdata:Any,
-                      retcode:int) -> None:
+                      retcode:int,
+                      properties:Optional[Properties] = None) -> None:
         """ Called when the client disconnects from the broker. If the reason was
             not because disconnect() was called, try to reconnect.
         """
@@ -279,32 +713,123 @@ class MqttConnection(Connection):
         )
 
         self.connected = False
+        self._reset_aliases(client, None)
         super().conn_went_offline()
         if retcode != 0:
+            # before the first reconnect attempt of paho
+            self._set_reconnect_delay(client)
+            # paho reconnects automatically
             self.log.error(
                 "Unexpected disconnect code %s: %s reconnecting",
                 retcode,
                 mqtt.error_string(retcode),
             )
-            self._connect()
+            if self.offline_buffer is not None:
+                # don't depend on the session of the broker, paho may send
+                # them a second time after reconnecting
+                self._store_unacked(client)
+            self._failover()
+
+    def on_connect_fail(self,
+                        client:mqtt.Client,
+                        userdata:Any) -> None:
+        """ Called when the network thread of paho fails to connect to the
+            broker, paho will retry after the reconnect delay. Stores messages
+            in the offline buffer until the connection is established.
+        """
+        self.log.error("Error connecting to %s:%s, client %s, userdata %s",
+                       self.host, self.port, client, userdata)
+        super().conn_went_offline()
+        self._failover()
+
+    def _failover(self) -> None:
+        """ Called from the network thread of paho if the connection failed.
+            Probes the brokers in a separate thread, so the network thread
+            isn't blocked. Does nothing if a probe is already running.
+        """
+        if len(self.brokers) < 2 or self.broker_mode != BROKER_MODE_FAILOVER:
+            return
+        with self.failover_lock:
+            if self.failover_thread is not None and self.failover_thread.is_alive():
+                return
+            self.failover_thread = Thread(target=self._select_broker, daemon=True,
+                                          name=f"MqttFailover-{self.root_topic}")
+            self.failover_thread.start()
+
+    def _select_broker(self) -> None:
+        """ Selects the broker which accepts a TCP connection first, or the next
+            broker in the list if none answers. paho connects to it on the
+            next reconnect attempt.
+        """
+        index = probe_brokers(self.brokers, PROBE_TIMEOUT)
+        if index is None:
+            index = (self.brokers.index((self.host, self.port)) + 1) % len(self.brokers)
+        (self.host, self.port) = self.brokers[index]
+        self.log.info("Failover to MQTT broker at %s:%s", self.host, self.port)
+        self.client.connect_async(self.host, port=self.port, keepalive=self.keepalive)
+
+    def on_split_connect(self,
+                         client:mqtt.Client,
+                         userdata:Any,
+                         flags:Dict[str, int],
+                         retcode:int,
+                         properties:Optional[Properties] = None) -> None:
+        """ Called when an additional client of the split mode connects. """
+        self._reset_aliases(client, properties)
+        self.log.info("Split mode client %s connected with result code %s",
+                      client, retcode)
+
+    def on_split_disconnect(self,
+                            client:mqtt.Client,
+                            userdata:Any,
+                            retcode:int,
+                            properties:Optional[Properties] = None) -> None:
+        """ Called when an additional client of the split mode disconnects,
+            its topics are published by the main client until it reconnects.
+        """
+        self._reset_aliases(client, None)
+        self._set_reconnect_delay(client)
+        self.log.warning("Split mode client %s disconnected with code %s",
+                         client, retcode)
 
     def on_publish(self,
                    client:mqtt.Client,
                    userdata:Any,
-                   retcode:int) -> None:
-        """ Called when a message is published. """
+                   mid:int) -> None:
+        """ Called when a message is published, for QoS 1/2 messages
+            when the broker acknowledged the message.
+        """
         self.log.debug(
             "on_publish: Successfully published message %s, %s, %s",
             client,
             userdata,
-            retcode,
+            mid,
         )
+        with self.inflight_cond:
+            entry = self.inflight.pop((id(client), mid), None)
+            if entry is None:
+                # QoS 0 or the ack arrived before publish() tracked the message.
+                # Holding inflight_cond across client.publish() would deadlock,
+                # paho calls on_publish while holding its message mutex.
+                # re-insert, so the first entry is the oldest
+                self.early_acks.pop((id(client), mid), None)
+                self.early_acks[(id(client), mid)] = time.monotonic()
+                if len(self.early_acks) > self.max_unacked:
+                    del self.early_acks[next(iter(self.early_acks))]
+                return
+            with self.publish_stats.lock:
+                self.publish_stats.acked += 1
+                self.publish_stats.ack_latency.add(time.monotonic() - entry[0])
+                self.publish_stats.inflight = len(self.inflight)
+            if not self.inflight:
+                self.inflight_cond.notify_all()
 
     def on_subscribe(self,
                      client:mqtt.Client,
                      userdata:Any,
                      retcode:int,
-                     qos:Tuple[int]) -> None:
+                     qos:Tuple[int],
+                     properties:Optional[Properties] = None) -> None:
         """ Called when a topic is subscribed to. """
         self.log.debug(
             "on_subscribe: Successfully subscribed %s, %s, %s, %s",
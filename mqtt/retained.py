@@ -0,0 +1,125 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Collects the retained messages the broker has for a topic filter.
+
+Classes: RetainedCollector
+"""
+import logging
+import time
+import uuid
+from threading import Lock
+from typing import Any, Callable, Dict, Optional
+import paho.mqtt.client as mqtt
+from core import timers
+
+class RetainedCollector():
+    """ Subscribes to a topic filter and collects the retained messages the
+        broker sends for it. To know when the broker sent all of them, a
+        sentinel message is published to a second topic after subscribing.
+        The broker handles the subscriptions and the publish in order, so the
+        sentinel arrives after the retained messages. If it doesn't arrive
+        within the timeout, the collection ends with the messages received
+        so far.
+    """
+
+    def __init__(self,
+                 topic_filter:str,
+                 sentinel_topic:str,
+                 timeout:float,
+                 on_complete:Callable[[Dict[str, str]], None]) -> None:
+        """ Parameters:
+            - topic_filter   : the topics to collect, e.g. homie/device/#
+            - sentinel_topic : topic used for the sentinel, must be unique
+                               for the client and not match topic_filter
+            - timeout        : seconds to wait for the sentinel
+            - on_complete    : called once with the collected {topic: payload},
+                               from the network thread of paho or the timer
+                               service
+        """
+        self.log = logging.getLogger(type(self).__name__)
+        self.topic_filter = topic_filter
+        self.sentinel_topic = sentinel_topic
+        self.timeout = timeout
+        self.on_complete = on_complete
+        self.lock = Lock()
+        self.client:Optional[mqtt.Client] = None
+        self.topics:Dict[str, str] = {}
+        self.token = ""
+        self.started = 0.0
+        self.handle:Optional[timers.TimerHandle] = None
+
+    def start(self,
+              client:mqtt.Client) -> None:
+        """ Starts the collection, call it after the client connected.
+            A running collection is restarted.
+        """
+        with self.lock:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.client = client
+            self.topics = {}
+            self.token = uuid.uuid4().hex
+            self.started = time.monotonic()
+            self.handle = timers.call_later(self.timeout, self._finish, self.token, True)
+        client.message_callback_add(self.topic_filter, self._on_message)
+        client.message_callback_add(self.sentinel_topic, self._on_sentinel)
+        client.subscribe(self.topic_filter, qos=0)
+        client.subscribe(self.sentinel_topic, qos=0)
+        client.publish(self.sentinel_topic, self.token, qos=0)
+
+    #pylint: disable=unused-argument
+    def _on_message(self,
+                    client:mqtt.Client,
+                    userdata:Any,
+                    msg:mqtt.MQTTMessage) -> None:
+        """ Stores retained messages, live messages are ignored. """
+        if msg.retain:
+            self.topics[msg.topic] = msg.payload.decode("utf-8", errors="replace")
+
+    def _on_sentinel(self,
+                     client:mqtt.Client,
+                     userdata:Any,
+                     msg:mqtt.MQTTMessage) -> None:
+        """ Ends the collection when the own sentinel arrives. """
+        self._finish(msg.payload.decode("utf-8", errors="replace"), False)
+    #pylint: enable=unused-argument
+
+    def _finish(self,
+                token:str,
+                timed_out:bool) -> None:
+        """ Unsubscribes and hands the collected topics to on_complete,
+            if token belongs to the current collection.
+        """
+        with self.lock:
+            if token != self.token or self.client is None:
+                return
+            self.token = ""
+            if self.handle is not None:
+                self.handle.cancel()
+                self.handle = None
+            client = self.client
+            topics = self.topics
+        client.message_callback_remove(self.topic_filter)
+        client.message_callback_remove(self.sentinel_topic)
+        client.unsubscribe(self.topic_filter)
+        client.unsubscribe(self.sentinel_topic)
+        duration = time.monotonic() - self.started
+        if timed_out:
+            self.log.warning("Collecting retained topics of %s timed out after %.1f s,"
+                             " collected %d topics", self.topic_filter, duration, len(topics))
+        else:
+            self.log.info("Collected %d retained topics of %s in %.2f s",
+                          len(topics), self.topic_filter, duration)
+        self.on_complete(topics)
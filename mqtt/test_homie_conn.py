@@ -0,0 +1,95 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests of the Homie discovery, using a fake paho client instead of a broker.
+
+    Run from the sensor_reporter directory:
+    bin/python -m unittest mqtt.test_homie_conn
+"""
+import unittest
+from typing import Any, Dict, List, Tuple
+from unittest import mock
+from core.utils import ChanConst, ChanType, OUT
+from mqtt.homie_conn import HomieConnection
+from mqtt.mqtt_conn import MqttConnection
+from mqtt.test_mqtt_conn import FakeClient
+
+def create_connection() -> Tuple[HomieConnection, List[Tuple[str, str]]]:
+    """ Returns a connected HomieConnection with one sensor and the list
+        the (topic, payload) of the published messages get appended to.
+    """
+    client = FakeClient()
+    def create_client(conn:MqttConnection, client_name:str, conn_cfg:Any) -> FakeClient:
+        client.on_publish = conn.on_publish
+        return client
+    with mock.patch.object(MqttConnection, '_create_client', create_client):
+        conn = HomieConnection(lambda msg: None,
+                               {'Level': 'INFO', 'DeviceID': 'test',
+                                'Host': 'localhost', 'Port': 1883, 'Keepalive': 10,
+                                'User': '', 'Password': ''})
+    conn.register({'Name': 'temp', OUT: {ChanConst.DATATYPE: ChanType.FLOAT,
+                                         ChanConst.NAME: 'temperature'}}, None)
+    conn.connected = True
+    published:List[Tuple[str, str]] = []
+    def publish_mqtt(message:str, topic:str, retain:bool = False) -> None:
+        published.append((topic, message))
+    conn._publish_mqtt = publish_mqtt # type: ignore[method-assign]
+    return (conn, published)
+
+def retained_topics(conn:HomieConnection) -> Dict[str, str]:
+    """ Returns the retained topics of a complete discovery of conn. """
+    return {msg.topic: msg.payload for msg in conn.device.messages() if msg.retained}
+
+def states(published:List[Tuple[str, str]]) -> List[str]:
+    """ Returns the published $state payloads in order. """
+    return [payload for (topic, payload) in published if topic == '$state']
+
+class TestDiscoveryState(unittest.TestCase):
+    """ Tests the $state messages around the discovery. """
+
+    def test_new_device(self) -> None:
+        """ $state is init before and ready after the attributes. """
+        (conn, published) = create_connection()
+        conn._publish_discovery()
+        self.assertEqual(states(published), ['init', 'ready'])
+        self.assertEqual(published[0], ('$state', 'init'))
+        self.assertEqual(published[-1], ('$state', 'ready'))
+        self.assertIn(('temp/$name', 'temp'), published)
+
+    def test_changed_attribute(self) -> None:
+        """ A changed attribute is published between init and ready. """
+        (conn, published) = create_connection()
+        conn.existing_topics = retained_topics(conn)
+        conn.existing_topics[f"{conn.root_topic}/temp/$name"] = 'old'
+        conn._publish_discovery()
+        self.assertEqual(published, [('$state', 'init'), ('temp/$name', 'temp'),
+                                     ('$state', 'ready')])
+
+    def test_unchanged_device(self) -> None:
+        """ Nothing is published if the broker has all topics. """
+        (conn, published) = create_connection()
+        conn.existing_topics = retained_topics(conn)
+        conn._publish_discovery()
+        self.assertEqual(published, [])
+
+    def test_unchanged_device_lost(self) -> None:
+        """ Only ready is published if the last run ended with lost. """
+        (conn, published) = create_connection()
+        conn.existing_topics = retained_topics(conn)
+        conn.existing_topics[f"{conn.root_topic}/$state"] = 'lost'
+        conn._publish_discovery()
+        self.assertEqual(published, [('$state', 'ready')])
+
+if __name__ == '__main__':
+    unittest.main()
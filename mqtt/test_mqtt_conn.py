@@ -0,0 +1,186 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests of the QoS 1/2 delivery tracking and the offline buffer replay of
+    the MQTT connection, using a fake paho client instead of a broker.
+
+    Run from the sensor_reporter directory:
+    bin/python -m unittest mqtt.test_mqtt_conn
+"""
+import os
+import tempfile
+import time
+import unittest
+from typing import Any, Callable, Dict, List, Optional, cast
+from unittest import mock
+import paho.mqtt.client as mqtt
+from core.connection import ConnState
+from mqtt.mqtt_conn import MqttConnection
+
+class FakeClient():
+    """ Stands in for a paho client. publish() can deliver the ack like the
+        network thread of paho does: on_publish is called before the message
+        info is marked as published.
+    """
+
+    def __init__(self) -> None:
+        self.on_publish:Any = None
+        self.ack_in_publish = False
+        self.mid = 0
+        self.infos:Dict[int, mqtt.MQTTMessageInfo] = {}
+        self.min_delays:List[int] = []
+
+    def publish(self,
+                topic:str,
+                payload:bytes,
+                retain:bool = False,
+                qos:int = 0,
+                properties:Optional[Any] = None) -> mqtt.MQTTMessageInfo:
+        self.mid += 1
+        info = mqtt.MQTTMessageInfo(self.mid)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        self.infos[self.mid] = info
+        if self.ack_in_publish:
+            self.on_publish(self, None, self.mid)
+        return info
+
+    def ack(self,
+            mid:int) -> None:
+        """ Acknowledges a message in the order of paho. """
+        self.on_publish(self, None, mid)
+        self.infos[mid]._set_as_published() # type: ignore[attr-defined]
+
+    def reconnect_delay_set(self,
+                            min_delay:int,
+                            max_delay:int) -> None:
+        self.min_delays.append(min_delay)
+
+    def __getattr__(self, name:str) -> Any:
+        # connect_async, loop_start, subscribe, will_set, ...
+        return mock.MagicMock()
+
+def create_connection(client:FakeClient,
+                      **conn_cfg:Any) -> MqttConnection:
+    """ Returns a connected MqttConnection publishing with client. """
+    def create_client(conn:MqttConnection, client_name:str, conn_cfg:Any) -> FakeClient:
+        client.on_publish = conn.on_publish
+        return client
+    with mock.patch.object(MqttConnection, '_create_client', create_client):
+        conn = MqttConnection(lambda msg: None,
+                              {'Level': 'INFO', 'Client': 'test', 'RootTopic': 'test',
+                               'Host': 'localhost', 'Port': 1883, 'Keepalive': 10,
+                               'User': '', 'Password': '', **conn_cfg})
+    conn.connected = True
+    return conn
+
+class TestAckTracking(unittest.TestCase):
+    """ Tests of MqttConnection._track and on_publish. """
+
+    def test_ack_during_publish(self) -> None:
+        """ An ack arriving before publish() tracked the message is counted. """
+        client = FakeClient()
+        conn = create_connection(client)
+        client.ack_in_publish = True
+        conn.publish("1", {'StateDest': 'value', 'QoS': 1})
+        self.assertEqual(conn.inflight, {})
+        self.assertEqual(conn.publish_stats.acked, 1)
+        self.assertEqual(conn.early_acks, {})
+
+    def test_ack_after_publish(self) -> None:
+        """ A message stays tracked until its ack arrives. """
+        client = FakeClient()
+        conn = create_connection(client)
+        conn.publish("1", {'StateDest': 'value', 'QoS': 1})
+        self.assertEqual(len(conn.inflight), 1)
+        conn.on_publish(cast(mqtt.Client, client), None, client.mid)
+        self.assertEqual(conn.inflight, {})
+        self.assertEqual(conn.publish_stats.acked, 1)
+
+    def test_stale_ack(self) -> None:
+        """ The ack of an older message with the same mid doesn't count. """
+        client = FakeClient()
+        conn = create_connection(client)
+        conn.on_publish(cast(mqtt.Client, client), None, client.mid + 1)
+        conn.publish("1", {'StateDest': 'value', 'QoS': 1})
+        self.assertEqual(len(conn.inflight), 1)
+        self.assertEqual(conn.publish_stats.acked, 0)
+
+    def test_max_unacked(self) -> None:
+        """ Only the newest MaxUnacked messages are tracked. """
+        client = FakeClient()
+        conn = create_connection(client)
+        conn.max_unacked = 2
+        for i in range(3):
+            conn.publish(str(i), {'StateDest': 'value', 'QoS': 1})
+        self.assertEqual([entry[2] for entry in conn.inflight.values()], ['1', '2'])
+        self.assertEqual(conn.publish_stats.unacked, 1)
+
+class TestReconnectDelay(unittest.TestCase):
+    """ Tests of the random reconnect delay. """
+
+    def test_new_delay_on_disconnect(self) -> None:
+        """ Every connection loss gets a new random minimum delay. """
+        client = FakeClient()
+        conn = create_connection(client, ReconnectMin=10)
+        for _ in range(20):
+            conn.on_disconnect(cast(mqtt.Client, client), None, mqtt.MQTT_ERR_CONN_LOST)
+        self.assertEqual(len(client.min_delays), 20)
+        self.assertTrue(all(10 <= delay <= 20 for delay in client.min_delays))
+        self.assertGreater(len(set(client.min_delays)), 1)
+
+def wait_until(condition:Callable[[], bool]) -> bool:
+    """ Waits up to 2 seconds for condition. """
+    deadline = time.monotonic() + 2
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class TestReplay(unittest.TestCase):
+    """ Tests of the offline buffer replay after reconnecting. """
+
+    def test_replay_waits_for_acks(self) -> None:
+        """ The replay runs in its own thread, sends one reading at a time and
+            keeps the readings not acknowledged when the connection got lost.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            client = FakeClient()
+            conn = create_connection(client, OfflineBufferFile=os.path.join(tmp, 'buffer'))
+            assert conn.offline_buffer is not None
+            comm_conn = {'StateDest': 'value', 'QoS': 1,
+                         'ConnectionOnReconnect': {'SendReadings': True,
+                                                   'NumberOfReadings': 10}}
+            for i in range(3):
+                conn.offline_buffer.append(comm_conn, None, str(i))
+            conn.state = ConnState.OFFLINE
+
+            # returns without waiting for the acks
+            conn.conn_went_online()
+            self.assertTrue(wait_until(lambda: client.mid == 1))
+            client.ack(1)
+            self.assertTrue(wait_until(lambda: client.mid == 2))
+            self.assertEqual(len(conn.offline_buffer), 2)
+
+            # connection lost before the ack of the second reading
+            conn.connected = False
+            conn.state = ConnState.OFFLINE
+            self.assertTrue(wait_until(lambda: conn.replay_thread is None))
+            self.assertEqual(client.mid, 2)
+            self.assertEqual([msg for (_, _, msg) in conn.offline_buffer.replay(lambda c: 10)],
+                             ['1', '2'])
+            conn.offline_buffer.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,10 +15,13 @@
 Classes: ArpSensor
 """
 import subprocess
+import asyncio
 import yaml
 from core.sensor import Sensor
 from core.utils import configure_device_channel
 
+ARP_CMD = ["arp", "-n"]
+
 class ArpSensor(Sensor):
     """Scans the local arp table for the presence of a given MAC address."""
 
@@ -60,14 +63,10 @@ class ArpSensor(Sensor):
         """
         self.log.debug("%s checking arp table.", self.name)
         try:
-            cmd_args = ["arp", "-n"]
-            results = subprocess.check_output(cmd_args, shell=False,
+            results = subprocess.check_output(ARP_CMD, shell=False,
                                               universal_newlines=True,
-                                              timeout=10).rstrip().split('\n')
-            found = self.mac in [entry.split()[2].lower() for entry in results]
-            if found != self.state:
-                self.state = found
-                self.publish_state()
+                                              timeout=10)
+            self._process_results(results)
         except subprocess.CalledProcessError as ex:
             self.log.error("%s command returned an error code: %s\n%s",
                            self.name, ex.returncode, ex.output)
@@ -75,6 +74,34 @@ class ArpSensor(Sensor):
             self.log.error("%s arp call took longer than 10 seconds.",
                            self.name)
 
+    async def async_check_state(self):
+        """Asyncio version of check_state, calls arp as asyncio subprocess."""
+        self.log.debug("%s checking arp table.", self.name)
+        proc = await asyncio.create_subprocess_exec(*ARP_CMD,
+                                                    stdout=asyncio.subprocess.PIPE)
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=10)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            self.log.error("%s arp call took longer than 10 seconds.",
+                           self.name)
+            return
+        if proc.returncode:
+            self.log.error("%s command returned an error code: %s\n%s",
+                           self.name, proc.returncode, stdout.decode())
+            return
+        self._process_results(stdout.decode())
+
+    def _process_results(self, results):
+        """Looks for the MAC address in the output of arp and publishes
+        the presence if it changed."""
+        entries = results.rstrip().split('\n')
+        found = self.mac in [entry.split()[2].lower() for entry in entries]
+        if found != self.state:
+            self.state = found
+            self.publish_state()
+
     def publish_state(self):
         """Publishes ON is the MAC is present, OFF otherwise."""
         send_val = "ON" if self.state else "OFF"
@@ -0,0 +1,113 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Simple script to measure the Item updates per second of the openHAB REST
+   connection against a local stand-in for the openHAB REST API.
+   Compares one request per update (requests.put) with OpenhabREST.publish,
+   which uses a pooled keep-alive session. The connection is configured
+   without send workers, so publish returns after the PUT finished and the
+   result is the REST throughput, not the speed of the send queue.
+
+   Run from the sensor_reporter directory:
+   bin/python -m openhab_rest.benchmark_rest --count 1000
+"""
+import argparse
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from typing import Any, Callable
+from urllib.parse import urlparse
+import requests
+from openhab_rest.rest_conn import OpenhabREST
+
+stop_server = Event()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers the requests of the REST connection like openHAB does:
+        GET /rest, GET /rest/events (SSE stream without events)
+        and PUT /rest/items/<item>/state.
+    """
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        """ Handles the connection check and the SSE subscription. """
+        # the path contains the topic filter as query
+        if urlparse(self.path).path == '/rest/events':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            stop_server.wait()
+            self.close_connection = True
+            return
+        body = b'{"version":"8"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self) -> None:
+        """ Handles an Item update. """
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    #pylint: disable=redefined-builtin
+    def log_message(self, format:str, *args:Any) -> None:
+        """ Don't log every request. """
+
+def run(name:str,
+        count:int,
+        send:Callable[[str], Any]) -> None:
+    """ Calls send count times and prints the updates per second. """
+    start = time.perf_counter()
+    for i in range(count):
+        send(str(i))
+    duration = time.perf_counter() - start
+    print(f"{name:30} {count / duration:8.0f} updates/s")
+
+parser = argparse.ArgumentParser(description='Measure the Item updates per second '
+                                 'of the openHAB REST connection.')
+parser.add_argument('--count', type=int, default=1000,
+                    help='number of Item updates per run (default 1000)')
+parser.add_argument('--port', type=int, default=18080,
+                    help='port of the stand-in server (default 18080)')
+args = parser.parse_args()
+
+server = ThreadingHTTPServer(('127.0.0.1', args.port), StandInHandler)
+server.daemon_threads = True
+Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{args.port}"
+
+logging.basicConfig(level=logging.WARNING)
+conn = OpenhabREST(lambda msg: None, {'Name': 'benchmark',
+                                      'URL': url,
+                                      'RefreshItem': 'Refresh',
+                                      'openHAB-Version': 3.0,
+                                      # send synchronously, see above
+                                      'SendWorkers': 0})
+comm_conn = {'Item': 'Benchmark'}
+
+run("requests.put per update", args.count,
+    lambda msg: requests.put(f"{url}/rest/items/Benchmark/state", data=msg,
+                             headers={'Content-Type': 'text/plain'}, timeout=10))
+run("OpenhabREST.publish (pooled)", args.count,
+    lambda msg: conn.publish(msg, comm_conn))
+
+conn.disconnect()
+stop_server.set()
+server.shutdown()
+print("Finished")
@@ -15,14 +15,29 @@
 """ Communicator that publishes and subscribes to openHAB's REST API.
     Classes:
         - openhab_rest: publishes state updates to openHAB Items.
+        - OpenhabSender: sends the state updates from worker threads.
+        - OpenhabReciever: receives Item commands from the SSE feed.
 """
-from threading import Thread, Timer
-from typing import Callable, Optional, Union, Any, Dict
+from threading import Condition, Thread
+from typing import Callable, Optional, Union, Any, Dict, List, Set
 import json
+import re
+import socket
+import time
+import zlib
 import traceback
 import requests
+from requests.adapters import HTTPAdapter
 import sseclient
-from core.connection import Connection, ConnState
+from core.connection import Connection, ConnState, Route
+from core import timers
+
+# Only commands are processed, other events just reset the watchdog
+COMMAND_EVENT = '"ItemCommandEvent"'
+# Extracts the Item name from the raw event, openHAB 2.x uses 'smarthome' as prefix
+COMMAND_TOPIC = re.compile(r'"topic"\s*:\s*"(?:openhab|smarthome)/items/([^/"]+)/command"')
+# Longer topic filters are not sent to openHAB, all events are received instead
+MAX_TOPIC_FILTER = 2000
 
 class OpenhabREST(Connection):
     """ Publishes a state to a given openHAB Item. Expects there to be a URL
@@ -73,27 +88,64 @@ class OpenhabREST(Connection):
                       " TLS certificate %s",
                       self.openhab_url, self.verify_cert)
 
+        # Build the headers once, they are sent with every request of the sessions
+        auth_header:Dict[str, str] = {}
+        if self.openhab_version >= 3.0 and bool(self.api_token):
+            auth_header['Authorization'] = 'Bearer ' + self.api_token
+        # openHAB 2.x doesn't need the Content-Type header
+        self.put_header:Optional[Dict[str, str]] = None
+        if self.openhab_version >= 3.0:
+            self.put_header = {'Content-Type': 'text/plain'}
+
+        # Pooled keep-alive connections for item updates and the connection check,
+        # so not every request needs a new TCP connection and TLS handshake
+        pool_size = int(conn_cfg.get("PoolSize", 4))
+        self.session = self._create_session(auth_header, pool_size)
+        # The SSE subscription blocks its connection, so it gets a session of its own
+        self.event_session = self._create_session(auth_header, 1)
+
         self.reciever:Optional[OpenhabReciever] = None
+        # Items to receive events for: the command Items and the Items sensor_reporter
+        # publishes to, since the watchdog expects an event after each update
+        self.event_items:Set[str] = {self.refresh_item}
+        self.resubscribe:Optional[timers.TimerHandle] = None
+
+        # Send the Item updates from worker threads, so publish doesn't block
+        self.sender:Optional[OpenhabSender] = None
+        send_workers = int(conn_cfg.get("SendWorkers", 2))
+        if send_workers > 0:
+            self.sender = OpenhabSender(self, send_workers,
+                                        int(conn_cfg.get("MaxRetries", 3)))
 
         # Initiate openHAB connection by running check_connection for the first time
         self.close_connection = False   # Stops 'check_connection' on demand
-        self.conn_check:Timer
+        self.conn_check:Optional[timers.TimerHandle] = None
         self.check_connection()
 
+    def _create_session(self,
+                        header:Dict[str, str],
+                        pool_size:int) -> requests.Session:
+        """ Creates a session with a pool of up to pool_size connections,
+            which sends header with every request.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(header)
+        session.verify = self.verify_cert
+        return session
+
     def check_connection(self) -> None:
         """ Runs every 30 seconds to check if the openHAB REST-API
             is available. If yes and not connected initiate connection.
             If connected but the API is not reachable switch to offline mode.
         """
-        header = None
         conn_error = False
         conn_success = False
-        if self.openhab_version >= 3.0 and bool(self.api_token):
-            header = {'Authorization': 'Bearer ' + self.api_token }
 
         try:
-            response = requests.get(f'{self.openhab_url}/rest',
-                                  headers=header, stream=False, verify=self.verify_cert)
+            response = self.session.get(f'{self.openhab_url}/rest', timeout=10)
             self.log.debug("Connection checker: got response code: %s for URL %s/rest",
                            response.status_code, self.openhab_url)
             response.raise_for_status()
@@ -113,7 +165,7 @@ class OpenhabREST(Connection):
         if conn_success:
             if self.state in [ConnState.INIT, ConnState.OFFLINE]:
                 self.log.info("Connected to openHAB %s", self.openhab_url)
-                self.reciever = OpenhabReciever(self, header)
+                self.reciever = OpenhabReciever(self)
                 super().conn_went_online()
         elif conn_error:
             if self.state == ConnState.ONLINE:
@@ -124,8 +176,14 @@ class OpenhabREST(Connection):
                 super().conn_went_offline()
 
         if not self.close_connection:
-            self.conn_check = Timer(30, self.check_connection)
-            self.conn_check.start()
+            self.conn_check = timers.call_later(30, self._start_check)
+
+    def _start_check(self) -> None:
+        """ Called by the timer service, runs check_connection in a thread of
+            its own, since the request to openHAB would block the timer service.
+        """
+        Thread(target=self.check_connection, daemon=True,
+               name=f"{self.conn_cfg.get('Name', 'openHAB')}-check").start()
 
     def publish(self,
                 message:str,
@@ -145,33 +203,79 @@ class OpenhabREST(Connection):
                            <connection_name>:
                                 <output_name>:
         """
-        if self.reciever:
-            self.reciever.start_watchdog()
+        #if output_name (output) is not present in comm_conn, there is no destination
+        route = self.get_route(comm_conn, output_name)
+        if not route.destinations:
+            return
 
-        #if output_name is in the communication dict parse it's contents
-        local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
-        destination = local_comm.get('Item')
+        if self.sender:
+            self.sender.put(route.destinations[0], message)
+        else:
+            self.put_state(route.destinations[0], message)
 
-        #if output_name (output) is not present in comm_conn, Item will be None
-        if destination is None:
+    def event_topics(self) -> Optional[str]:
+        """ Returns the topic filter for the SSE subscription covering
+            self.event_items, None if the filter would be too long.
+        """
+        prefix = "smarthome" if self.openhab_version < 3.0 else "openhab"
+        topics = ",".join(f"{prefix}/items/{item}/*" for item in sorted(self.event_items))
+        if len(topics) > MAX_TOPIC_FILTER:
+            return None
+        return topics
+
+    def _add_event_item(self,
+                        item:str) -> None:
+        """ Adds item to the SSE topic filter. The subscription is renewed
+            one second after the last change, so many registrations at start up
+            cause only one resubscription.
+        """
+        if item in self.event_items:
+            return
+        self.event_items.add(item)
+        if self.resubscribe:
+            self.resubscribe.cancel()
+        self.resubscribe = timers.call_later(1, self._start_resubscribe)
+
+    def _start_resubscribe(self) -> None:
+        """ Called by the timer service, renews the SSE subscription in a thread
+            of its own, since the request to openHAB would block the timer service.
+        """
+        self.resubscribe = None
+        Thread(target=self._resubscribe, daemon=True,
+               name=f"{self.conn_cfg.get('Name', 'openHAB')}-subscribe").start()
+
+    def _resubscribe(self) -> None:
+        """ Replaces the SSE subscription with one using the current topic filter. """
+        if self.close_connection or self.state != ConnState.ONLINE or not self.reciever:
+            # the filter gets applied on the next connect
             return
+        self.log.debug("Renewing openHAB SSE subscription for topics %s", self.event_topics())
+        self.reciever.stop()
+        # wait for the old thread, so there is only one subscription at a time
+        self.reciever.join(5)
+        self.reciever = OpenhabReciever(self)
+
+    def put_state(self,
+                   destination:str,
+                   message:str) -> bool:
+        """ Sends the Item update, returns True if it failed and should be retried
+            (server error or timeout).
+        """
+        if self.reciever:
+            self.reciever.start_watchdog()
 
         try:
             self.log.debug("Publishing message %s to %s", message, destination)
-            # openHAB 2.x doesn't need the Content-Type header
-            header = None
-            if self.openhab_version >= 3.0:
-                # define header for OH3 communication and authentication
-                header = {'Content-Type': 'text/plain'}
-                if bool(self.api_token):
-                    header['Authorization'] = "Bearer " + self.api_token
-            response = requests.put(f'{self.openhab_url}/rest/items/{destination}/state',
-                                    headers=header, data=message,
-                                    timeout=10, verify=self.verify_cert)
+            response = self.session.put(destination, headers=self.put_header,
+                                        data=message, timeout=10)
             if response.status_code == 401:
                 # 401 = unauthorized, API-Key required
                 self.log.error("Can't publish message,"
                                " received error unauthorized! Consider to set a 'API-Token'!")
+            elif response.status_code >= 500:
+                self.log.warning("Received server error %s publishing message %s to %s",
+                                 response.status_code, message, destination)
+                return True
             else:
                 response.raise_for_status()
                 if self.reciever:
@@ -182,6 +286,7 @@ class OpenhabREST(Connection):
             super().conn_went_offline()
         except requests.exceptions.Timeout:
             self.log.error("Timed out connecting to %s", self.openhab_url)
+            return True
         except requests.exceptions.ConnectionError as ex:
             # Handles exception "[Errno 111] Connection refused"
             # which is not caught by above "ConnectionError"
@@ -189,14 +294,32 @@ class OpenhabREST(Connection):
             super().conn_went_offline()
         except requests.exceptions.HTTPError as ex:
             self.log.error("Received an unsuccessful response code %s", ex)
+        return False
+
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves the state URL of the Item of the output. """
+        #if output_name is in the communication dict parse it's contents
+        local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
+        item = local_comm.get('Item')
+        if item is None:
+            return Route()
+        self._add_event_item(item)
+        return Route((f'{self.openhab_url}/rest/items/{item}/state',))
 
     def disconnect(self) -> None:
         """ Stops the event processing loop."""
         self.log.info("Disconnecting from openHAB SSE")
         self.close_connection = True
+        if self.sender:
+            self.sender.stop()
         if self.reciever:
             self.reciever.stop()
-        self.conn_check.cancel()
+        if self.conn_check:
+            self.conn_check.cancel()
+        self.session.close()
+        self.event_session.close()
 
     def register(self,
                  comm_conn:Dict[str, Any],
@@ -208,6 +331,102 @@ class OpenhabREST(Connection):
         if handler:
             self.log.info("Registering destination %s", comm_conn['Item'])
             self.registered[comm_conn['Item']] = handler
+            self._add_event_item(comm_conn['Item'])
+
+class OpenhabSender():
+    """ Sends the Item updates of an OpenhabREST connection from a fixed
+        number of worker threads. All updates of an Item are sent by the same
+        worker, so they arrive in order. An update waiting to be sent is
+        replaced by a newer update for the same Item. Failed updates
+        (server error or timeout) are retried with exponential backoff.
+    """
+
+    def __init__(self,
+                 caller:OpenhabREST,
+                 workers:int,
+                 max_retries:int) -> None:
+        """ Starts the worker threads.
+            Parameter:
+            - caller      : The class object from the calling OpenhabREST
+            - workers     : number of worker threads
+            - max_retries : how often a failed update is retried
+        """
+        self.caller = caller
+        self.max_retries = max_retries
+        self.stop_workers = False
+        # one queue per worker: state URL -> latest message, in the order of arrival
+        self.queues:List[Dict[str, str]] = [{} for _ in range(workers)]
+        self.conds = [Condition() for _ in range(workers)]
+        self.threads = [Thread(target=self._worker, args=(i,), daemon=True,
+                               name=f"{caller.conn_cfg.get('Name', 'openHAB')}-sender{i}")
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self,
+            destination:str,
+            message:str) -> None:
+        """ Queues the update of the Item with the state URL destination. """
+        index = zlib.crc32(destination.encode()) % len(self.queues)
+        with self.conds[index]:
+            if destination in self.queues[index]:
+                # the queues have their own locks, the statistics are shared
+                with self.caller.publish_stats.lock:
+                    self.caller.publish_stats.coalesced += 1
+            self.queues[index][destination] = message
+            self.conds[index].notify()
+
+    def _worker(self,
+                index:int) -> None:
+        """ Sends the updates of queue index until stop() is called
+            and the queue is empty.
+        """
+        queue = self.queues[index]
+        cond = self.conds[index]
+        while True:
+            with cond:
+                while not queue and not self.stop_workers:
+                    cond.wait()
+                if not queue:
+                    return
+                # dicts keep the insertion order, so this is the oldest update
+                destination = next(iter(queue))
+                message = queue.pop(destination)
+
+            retry = 0
+            while self.caller.put_state(destination, message):
+                if retry >= self.max_retries or self.stop_workers:
+                    self.caller.log.error("Giving up publishing message %s to %s",
+                                          message, destination)
+                    break
+                delay = min(0.5 * 2 ** retry, 30)
+                retry += 1
+                with self.caller.publish_stats.lock:
+                    self.caller.publish_stats.retries += 1
+                deadline = time.monotonic() + delay
+                with cond:
+                    while not self.stop_workers and destination not in queue \
+                    and time.monotonic() < deadline:
+                        cond.wait(deadline - time.monotonic())
+                    newer = destination in queue
+                if newer:
+                    # a newer update arrived in the meantime, send that instead
+                    self.caller.log.debug("Dropping failed message %s to %s,"
+                                          " newer message queued", message, destination)
+                    break
+
+    def stop(self,
+             timeout:float = 5) -> None:
+        """ Stops the workers after the queued updates are sent.
+            Waits at most timeout seconds.
+        """
+        self.stop_workers = True
+        for cond in self.conds:
+            with cond:
+                cond.notify()
+        end = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(end - time.monotonic(), 0))
 
 class OpenhabReciever():
     """ Subscribes to SSE events from openHAB and
@@ -215,17 +434,20 @@ class OpenhabReciever():
     """
 
     def __init__(self,
-                 caller:OpenhabREST,
-                 header:Optional[Dict[str, str]]) -> None:
+                 caller:OpenhabREST) -> None:
         """  Parameter:
             - caller    : The class object from the calling OpenhabREST
-            - header    : HTTP header which is send to openHAB when
-                          subscribing to events
         """
         self.stop_thread = False
-        self.client = self.subscribe_to_events(caller, header)
+        self.stream = self.subscribe_to_events(caller)
+        # The type checker doesn't understand requests.response is compatible with
+        # Generator[bytes, None, None] required by SSEClient
+        self.client:Optional[sseclient.SSEClient] = None
+        if self.stream is not None:
+            self.client = sseclient.SSEClient(self.stream) # type: ignore
         self.caller = caller
-        self.watchdog:Optional[Timer] = None
+        self.thread:Optional[Thread] = None
+        self.watchdog:Optional[timers.TimerHandle] = None
         self.watchdog_activ = False
         # In case of a connection error don't start the get_messages thread
         if self.client:
@@ -233,20 +455,18 @@ class OpenhabReciever():
             self.thread.start()
 
     @staticmethod
-    def subscribe_to_events(caller:OpenhabREST,
-                            header:Optional[Dict[str, str]]) -> Optional[sseclient.SSEClient]:
-        """ Subscribe to SSE events and start processing the events
+    def subscribe_to_events(caller:OpenhabREST) -> Optional[requests.Response]:
+        """ Subscribe to SSE events and returns the event stream
             if API-Token is provided and supported then include it in the request
-            Parameter:
-                - header    : HTTP header to send to openHAB
+            (the header is set in caller.event_session).
+            Only events of the registered and published Items are requested.
         """
-        client:Optional[sseclient.SSEClient] = None
+        stream:Optional[requests.Response] = None
+        topics = caller.event_topics()
         try:
-            stream = requests.get(f'{caller.openhab_url}/rest/events',
-                                  headers=header, stream=True, verify=caller.verify_cert)
-            # The type checker doesn't understand requests.response is compatible with
-            # Generator[bytes, None, None] required by SSEClient
-            client = sseclient.SSEClient(stream)   # type: ignore
+            stream = caller.event_session.get(f'{caller.openhab_url}/rest/events',
+                                              params={'topics': topics} if topics else None,
+                                              stream=True)
 
         except requests.exceptions.Timeout:
             caller.log.error("Timed out connecting to %s", caller.openhab_url)
@@ -255,7 +475,7 @@ class OpenhabReciever():
         except requests.exceptions.HTTPError as ex:
             caller.log.error("Received and unsuccessful response code %s", ex)
 
-        return client
+        return stream
 
     def _get_messages(self,
                       caller:OpenhabREST) -> None:
@@ -263,6 +483,21 @@ class OpenhabReciever():
             SSE subscription and if it's a command to a registered Item, call's that
             Item's handler.
         """
+        if self.client is None:
+            return
+        try:
+            self._handle_events(caller)
+        except (requests.exceptions.RequestException, OSError, ValueError, AttributeError):
+            # stop() closes the stream while the thread waits for the next event
+            if not self.stop_thread:
+                raise
+            caller.log.debug("Old openHab connection closed")
+
+    def _handle_events(self,
+                       caller:OpenhabREST) -> None:
+        """ Loops through the events of the SSE subscription until the
+            stream ends or stop is set to True.
+        """
         if self.client is None:
             return
         for event in self.client.events():
@@ -276,20 +511,18 @@ class OpenhabReciever():
                 return
 
             # See if this is an event we care about. Commands on registered Items.
+            # Check the raw event first, so other events don't get decoded
+            if COMMAND_EVENT not in event.data:
+                continue
+            match = COMMAND_TOPIC.search(event.data)
+            if match is None or match.group(1) not in caller.registered:
+                continue
+            item = match.group(1)
             decoded = json.loads(event.data)
-            if decoded["type"] == "ItemCommandEvent":
-                # openHAB 2.x locates the items on a different url
-                if caller.openhab_version < 3.0:
-                    item = decoded["topic"].replace("smarthome/items/",
-                                                    "").replace("/command", "")
-                else:
-                    item = decoded["topic"].replace("openhab/items/",
-                                                    "").replace("/command", "")
-                if item in caller.registered:
-                    payload = json.loads(decoded["payload"])
-                    msg = payload["value"]
-                    caller.log.info("Received command from %s: %s", item, msg)
-                    caller.registered[item](msg)
+            payload = json.loads(decoded["payload"])
+            msg = payload["value"]
+            caller.log.info("Received command from %s: %s", item, msg)
+            caller.registered[item](msg)
         caller.log.debug("Connection interrupted: old openHab connection closed")
         self.client.close()
 
@@ -315,8 +548,7 @@ class OpenhabReciever():
         if self.watchdog:
             self.watchdog.cancel()
         self.watchdog_activ = False
-        self.watchdog = Timer(2, self._wd_timeout)
-        self.watchdog.start()
+        self.watchdog = timers.call_later(2, self._wd_timeout)
 
     def activate_watchdog(self) -> None:
         """ Enable watchdog after msg was successful send (no exception due to connection error)
@@ -325,7 +557,28 @@ class OpenhabReciever():
         self.watchdog_activ = True
 
     def stop(self) -> None:
-        """ Sets a flag to stop the _get_messages thread and to close the openHAB connection.
-            Since the thread itself blocks until a message is received we won't wait for it
+        """ Sets a flag to stop the _get_messages thread and closes the openHAB
+            connection, so the thread returns even if it waits for an event.
+            Doesn't wait for the thread, see join().
         """
         self.stop_thread = True
+        if self.stream is None:
+            return
+        try:
+            raw = self.stream.raw
+            if hasattr(raw, 'shutdown'):
+                # urllib3 >= 2.3, interrupts a read of another thread
+                raw.shutdown()
+            else:
+                sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.stream.close()
+
+    def join(self,
+             timeout:float) -> None:
+        """ Waits at most timeout seconds for the _get_messages thread to end. """
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,269 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Communicator that publishes and subscribes to openHAB's WebSocket API
+    (openHAB 3.4 and newer).
+    Classes:
+        - OpenhabWebSocket: publishes state updates to openHAB Items and receives
+                            Item commands over one persistent WebSocket.
+"""
+from threading import Event, Thread
+from typing import Callable, Optional, Any, Dict
+import json
+import ssl
+import traceback
+import websocket
+from core.connection import Connection, Route
+
+# Topics of the openHAB WebSocket API
+TOPIC_HEARTBEAT = "openhab/websocket/heartbeat"
+TOPIC_FILTER_TYPE = "openhab/websocket/filter/type"
+TOPIC_FILTER_SOURCE = "openhab/websocket/filter/source"
+TOPIC_FILTER_TOPIC = "openhab/websocket/filter/topic"
+TYPE_WEBSOCKET = "WebSocketEvent"
+TYPE_COMMAND = "ItemCommandEvent"
+TYPE_STATE = "ItemStateEvent"
+# openHAB closes idle WebSockets, so a heartbeat is sent regularly
+HEARTBEAT_INTERVAL = 5
+RECONNECT_DELAY = 5
+
+def state_type(message:str) -> str:
+    """ Returns the openHAB state type for message. Unlike the REST API the
+        WebSocket API doesn't parse plain strings, the type has to be sent
+        with the state.
+    """
+    if message in ("ON", "OFF"):
+        return "OnOff"
+    if message in ("OPEN", "CLOSED"):
+        return "OpenClosed"
+    try:
+        float(message)
+        return "Decimal"
+    except ValueError:
+        return "String"
+
+class OpenhabWebSocket(Connection):
+    """ Publishes states to openHAB Items and receives commands for the
+        registered Items over the WebSocket API of openHAB. Expects a URL
+        parameter set to the base URL of the openHAB instance.
+    """
+
+    def __init__(self,
+                 msg_processor:Callable[[str], None],
+                 conn_cfg:Dict[str, Any]) -> None:
+        """ Starts the WebSocket thread and registers for commands on
+            RefreshItem. Expects the following params:
+            - "URL": base URL of the openHAB instance, http(s)://host:port
+            - "RefreshItem": Name of the openHAB Item that, when it receives a
+                             command will cause sensor_reporter to publish
+                             the most recent states of all the sensors.
+            - "API-Token": optional API token
+            - "CAcert": optional path to the CA certificate
+            - "TLSinsecure": optional, disables the certificate verification
+            - msg_processor: message handler for command to the RefreshItem
+        """
+        super().__init__(msg_processor, conn_cfg)
+        self.log.info("Initializing openHAB WebSocket Connection...")
+
+        self.openhab_url = conn_cfg["URL"]
+        self.refresh_item = conn_cfg["RefreshItem"]
+        self.registered[self.refresh_item] = msg_processor
+        self.source = f"sensor_reporter.{conn_cfg.get('Name', 'openHAB')}"
+
+        # http://host:8080 => ws://host:8080/ws, https => wss
+        ws_url = self.openhab_url.replace("http", "ws", 1).rstrip('/') + "/ws"
+        api_token = conn_cfg.get("API-Token", "")
+        if api_token:
+            ws_url += f"?accessToken={api_token}"
+        else:
+            self.log.info("No API-Token specified,"
+                          " connecting to openHAB without authentication")
+
+        self.sslopt:Dict[str, Any] = {}
+        if conn_cfg.get("TLSinsecure", False):
+            self.sslopt = {"cert_reqs": ssl.CERT_NONE, "check_hostname": False}
+        elif conn_cfg.get("CAcert"):
+            self.sslopt = {"ca_certs": conn_cfg["CAcert"]}
+
+        self.log.info("Attempting to connect to openHAB WebSocket at %s", self.openhab_url)
+        self.socket = websocket.WebSocketApp(ws_url,
+                                             on_open=self._on_open,
+                                             on_message=self._on_message,
+                                             on_error=self._on_error,
+                                             on_close=self._on_close)
+        self.connected = False
+        # set when the WebSocket is closed, replaced on every connect
+        self.heartbeat_stop = Event()
+        self.close_connection = Event()
+        self.thread = Thread(target=self._run, daemon=True,
+                             name=f"{conn_cfg.get('Name', 'openHAB')}-ws")
+        self.thread.start()
+
+    def _run(self) -> None:
+        """ Keeps the WebSocket connected until disconnect() is called. """
+        while not self.close_connection.is_set():
+            try:
+                self.socket.run_forever(sslopt=self.sslopt)
+            # keep the connection thread alive on unexpected errors
+            except:
+                self.log.error("Unexpected WebSocket error: %s", traceback.format_exc())
+            if not self.close_connection.wait(RECONNECT_DELAY):
+                self.log.debug("Reconnecting to %s", self.openhab_url)
+
+    def _send_event(self,
+                    event_type:str,
+                    topic:str,
+                    payload:str) -> bool:
+        """ Sends an event to openHAB, returns False if not connected. """
+        try:
+            self.socket.send(json.dumps({"type": event_type,
+                                         "topic": topic,
+                                         "payload": payload,
+                                         "source": self.source}))
+            return True
+        except (websocket.WebSocketException, OSError, AttributeError) as ex:
+            # AttributeError: socket not opened yet
+            self.log.error("Failed to send event to %s: %s", topic, ex)
+            return False
+
+    def _send_filter(self) -> None:
+        """ Requests only the commands of the registered Items, without the
+            events caused by sensor_reporter.
+        """
+        self._send_event(TYPE_WEBSOCKET, TOPIC_FILTER_TYPE, json.dumps([TYPE_COMMAND]))
+        self._send_event(TYPE_WEBSOCKET, TOPIC_FILTER_SOURCE, json.dumps([self.source]))
+        self._send_event(TYPE_WEBSOCKET, TOPIC_FILTER_TOPIC,
+                         json.dumps([f"openhab/items/{item}/command"
+                                     for item in sorted(self.registered)]))
+
+    def _send_heartbeat(self,
+                        stop:Event) -> None:
+        """ Heartbeat thread of one connect, keeps the WebSocket open until
+            stop is set. The shared timer service isn't used, a stalled socket
+            would block all timers.
+        """
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            self._send_event(TYPE_WEBSOCKET, TOPIC_HEARTBEAT, "PING")
+
+    #pylint: disable=unused-argument
+    def _on_open(self,
+                 socket:websocket.WebSocketApp) -> None:
+        """ Called when the WebSocket is connected. """
+        self.log.info("Connected to openHAB %s", self.openhab_url)
+        self.connected = True
+        self._send_filter()
+        self.heartbeat_stop = Event()
+        Thread(target=self._send_heartbeat, args=(self.heartbeat_stop,), daemon=True,
+               name=f"{self.thread.name}-heartbeat").start()
+        # send messages which got collected while connection was offline
+        super().conn_went_online()
+
+    def _on_message(self,
+                    socket:websocket.WebSocketApp,
+                    raw:str) -> None:
+        """ Called for every received event, calls the handler of commands to
+            registered Items.
+        """
+        # Check the raw event first, so heartbeat responses don't get decoded
+        if TYPE_COMMAND not in raw:
+            return
+        try:
+            event = json.loads(raw)
+            item = event["topic"].split("/")[2]
+            if event["type"] == TYPE_COMMAND and item in self.registered:
+                msg = json.loads(event["payload"])["value"]
+                self.log.info("Received command from %s: %s", item, msg)
+                self.registered[item](msg)
+        except (ValueError, KeyError, IndexError):
+            self.log.error("Invalid event received: %s", raw)
+
+    def _on_error(self,
+                  socket:websocket.WebSocketApp,
+                  error:Exception) -> None:
+        """ Called on connection errors, run_forever returns afterwards. """
+        self.log.error("openHAB WebSocket error: %s", error)
+
+    def _on_close(self,
+                  socket:websocket.WebSocketApp,
+                  status:Optional[int],
+                  reason:Optional[str]) -> None:
+        """ Called when the WebSocket is closed. """
+        self.log.info("Disconnected from openHAB %s, status %s %s",
+                      self.openhab_url, status, reason)
+        self.connected = False
+        self.heartbeat_stop.set()
+        super().conn_went_offline()
+    #pylint: enable=unused-argument
+
+    def publish(self,
+                message:str,
+                comm_conn:Dict[str, Any],
+                output_name:Optional[str] = None) -> None:
+        """ Publishes the passed in message to the passed in destination as an update.
+
+        Arguments:
+        - message:     the message to process / publish, expected type <string>
+        - comm_conn:   dictionary containing only the parameters for the called connection,
+                       e. g. information where to publish
+        - output_name: optional, the output channel to publish the message to,
+                       defines the sub-directory in comm_conn to look for the return topic.
+                       When defined the output_name must be present
+                       in the sensor YAML configuration:
+                       Connections:
+                           <connection_name>:
+                                <output_name>:
+        """
+        #if output_name (output) is not present in comm_conn, there is no destination
+        route = self.get_route(comm_conn, output_name)
+        if not route.destinations:
+            return
+        if not self.connected:
+            self.log.warning("openHAB WebSocket is not connected!"
+                             " Ignoring message: %s, for %s", message, route.destinations[0])
+            return
+        self.log.debug("Publishing message %s to %s", message, route.destinations[0])
+        self._send_event(TYPE_STATE, route.destinations[0],
+                         json.dumps({"type": state_type(message), "value": message}))
+
+    def _build_route(self,
+                     comm_conn:Dict[str, Any],
+                     output_name:Optional[str]) -> Route:
+        """ Resolves the state topic of the Item of the output. """
+        #if output_name is in the communication dict parse it's contents
+        local_comm = comm_conn[output_name] if output_name in comm_conn else comm_conn
+        item = local_comm.get('Item')
+        if item is None:
+            return Route()
+        return Route((f"openhab/items/{item}/state",))
+
+    def disconnect(self) -> None:
+        """ Closes the WebSocket and stops the connection thread. """
+        self.log.info("Disconnecting from openHAB WebSocket")
+        self.close_connection.set()
+        self.heartbeat_stop.set()
+        self.socket.close()
+        self.thread.join(RECONNECT_DELAY)
+
+    def register(self,
+                 comm_conn:Dict[str, Any],
+                 handler:Optional[Callable[[str], None]]) -> None:
+        """ Set up the passed in handler to be called for any command to the
+            Item. Updates the event filter if already connected.
+        """
+        #handler can be None if a sensor registers it's outputs
+        if handler:
+            self.log.info("Registering destination %s", comm_conn['Item'])
+            self.registered[comm_conn['Item']] = handler
+            if self.connected:
+                self._send_filter()
@@ -0,0 +1,147 @@
+# Copyright 2020 Richard Koshak
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Simple stand-in for the openHAB WebSocket API to test the
+   openhab_rest.ws_conn.OpenhabWebSocket connection without openHAB.
+   Prints the received state updates, answers heartbeats and sends an
+   Item command to all clients periodically.
+
+   Run from the sensor_reporter directory:
+   bin/python -m openhab_rest.ws_standin --port 8080 --command Test_Refresh=ON
+   and set 'URL: http://localhost:8080' in the connection section.
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import socket
+import socketserver
+import struct
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, Set
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+clients:Set[socket.socket] = set()
+clients_lock = Lock()
+
+def send_frame(sock:socket.socket, text:str) -> None:
+    """ Sends text as unmasked WebSocket text frame. """
+    data = text.encode()
+    header = bytes([0x81])
+    if len(data) < 126:
+        header += bytes([len(data)])
+    elif len(data) < 65536:
+        header += bytes([126]) + struct.pack('>H', len(data))
+    else:
+        header += bytes([127]) + struct.pack('>Q', len(data))
+    sock.sendall(header + data)
+
+def recv_exact(rfile:io.BufferedIOBase, size:int) -> bytes:
+    """ Reads exactly size bytes, raises ConnectionError if the client closed the connection. """
+    data = rfile.read(size)
+    if len(data) < size:
+        raise ConnectionError("client closed the connection")
+    return data
+
+class WebSocketHandler(socketserver.StreamRequestHandler):
+    """ Handles one WebSocket client. """
+
+    def handle(self) -> None:
+        headers = {}
+        request = self.rfile.readline().decode().strip()
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                break
+            (name, value) = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            headers['sec-websocket-key'].encode() + WS_GUID).digest()).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                          "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        print(f"Client connected: {request}")
+        with clients_lock:
+            clients.add(self.request)
+        try:
+            self._read_frames()
+        except ConnectionError:
+            pass
+        finally:
+            with clients_lock:
+                clients.discard(self.request)
+            print("Client disconnected")
+
+    def _read_frames(self) -> None:
+        while True:
+            (head, length) = recv_exact(self.rfile, 2)
+            opcode = head & 0x0F
+            length &= 0x7F
+            if length == 126:
+                (length,) = struct.unpack('>H', recv_exact(self.rfile, 2))
+            elif length == 127:
+                (length,) = struct.unpack('>Q', recv_exact(self.rfile, 8))
+            mask = recv_exact(self.rfile, 4)
+            data = bytes(b ^ mask[i % 4] for (i, b) in enumerate(recv_exact(self.rfile, length)))
+            if opcode == 0x8:
+                self.request.sendall(bytes([0x88, 0]))
+                return
+            if opcode == 0x9:
+                self.request.sendall(bytes([0x8A, len(data)]) + data)
+                continue
+            if opcode == 0x1:
+                self._on_event(json.loads(data))
+
+    def _on_event(self, event:Dict[str, Any]) -> None:
+        """ Answers heartbeats and prints the other events. """
+        if event['topic'] == 'openhab/websocket/heartbeat':
+            send_frame(self.request, json.dumps({'type': 'WebSocketEvent',
+                                                 'topic': event['topic'],
+                                                 'payload': 'PONG'}))
+        else:
+            print(f"{event['type']:20} {event['topic']:40} {event['payload']}")
+
+def send_commands(item:str, value:str, interval:float) -> None:
+    """ Sends the command to all clients every interval seconds. """
+    while True:
+        time.sleep(interval)
+        event = json.dumps({'type': 'ItemCommandEvent',
+                            'topic': f'openhab/items/{item}/command',
+                            'payload': json.dumps({'type': 'OnOff', 'value': value})})
+        with clients_lock:
+            for sock in list(clients):
+                send_frame(sock, event)
+        print(f"Sent command {value} to {item}")
+
+parser = argparse.ArgumentParser(description='Stand-in for the openHAB WebSocket API.')
+parser.add_argument('--port', type=int, default=8080,
+                    help='port to listen on (default 8080)')
+parser.add_argument('--command', default=None,
+                    help='Item command to send periodically, e.g. Test_Refresh=ON')
+parser.add_argument('--interval', type=float, default=10,
+                    help='seconds between the commands (default 10)')
+args = parser.parse_args()
+
+if args.command:
+    (cmd_item, cmd_value) = args.command.split('=', 1)
+    Thread(target=send_commands, args=(cmd_item, cmd_value, args.interval),
+           daemon=True).start()
+
+socketserver.ThreadingTCPServer.allow_reuse_address = True
+with socketserver.ThreadingTCPServer(('', args.port), WebSocketHandler) as server:
+    server.daemon_threads = True
+    print(f"Listening on port {args.port}, stop with Ctrl-C")
+    server.serve_forever()
@@ -21,6 +21,7 @@ Classes:
 """
 import socket
 import re
+import asyncio
 import yaml
 from core.sensor import Sensor
 
@@ -57,27 +58,58 @@ class RokuAddressSensor(Sensor):
         """Issues the request and waits for 19 seconds for responses from Rokus.
         The current states are published on every poll.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock = self._open_socket()
         sock.sendto(SSDP_REQUEST, ("239.255.255.250", 1900))
         while True:
             try:
-                resp = str(sock.recv(1024))
-                match = re.match(r'.*USN: uuid:roku:ecp:([\w\d]{12}).*LOCATION: (http://.*/).*',
-                                 resp, re.S)
-                name = match.group(1)
-                ip = match.group(2)
-                if name not in sorted(self.ips.keys()) or self.ips[name] != ip:
-                    self.log.info("%s: %s is now at %s", self.name, name, ip)
-                    self.ips[name] = ip
-                else:
-                    self.log.debug("%s: %s is still at %s", self.name, name, ip)
+                self._process_response(str(sock.recv(1024)))
             except socket.timeout:
                 break
         sock.close()
         self.publish_state()
 
+    async def async_check_state(self):
+        """Asyncio version of check_state, waits for the responses without
+        blocking a thread.
+        """
+        loop = asyncio.get_running_loop()
+        sock = self._open_socket()
+        sock.setblocking(False)
+        sock.sendto(SSDP_REQUEST, ("239.255.255.250", 1900))
+        try:
+            while True:
+                try:
+                    resp = await asyncio.wait_for(loop.sock_recv(sock, 1024), 10)
+                except asyncio.TimeoutError:
+                    break
+                self._process_response(str(resp))
+        finally:
+            sock.close()
+        self.publish_state()
+
+    @staticmethod
+    def _open_socket():
+        """Creates the UDP socket for the SSDP request."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        return sock
+
+    def _process_response(self, resp):
+        """Parses a SSDP response and remembers the URL of the Roku."""
+        match = re.match(r'.*USN: uuid:roku:ecp:([\w\d]{12}).*LOCATION: (http://.*/).*',
+                         resp, re.S)
+        if not match:
+            self.log.debug("%s: ignoring unexpected response %s", self.name, resp)
+            return
+        name = match.group(1)
+        ip = match.group(2)
+        if name not in sorted(self.ips.keys()) or self.ips[name] != ip:
+            self.log.info("%s: %s is now at %s", self.name, name, ip)
+            self.ips[name] = ip
+        else:
+            self.log.debug("%s: %s is still at %s", self.name, name, ip)
+
     def publish_state(self):
         """Publishes the URL using the Roku device name as the destination."""
         for (name, ip) in self.ips.items():
@@ -273,8 +273,12 @@ def create_poll_manager(config_file:str) -> PollManager:
     for conn in connections.values():
         conn.publish_device_properties()
 
+    #resolve the destinations of all registered devices once
+    for conn in connections.values():
+        conn.compile_routes()
+
     logger.debug("Creating polling manager")
-    poll_mgr = PollManager(connections, sensors, actuators)
+    poll_mgr = PollManager(connections, sensors, actuators, config.get("PollManager"))
     logger.debug("Created, returning polling manager")
     return poll_mgr
 